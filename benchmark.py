@@ -0,0 +1,522 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import metrics
+import mock_bemsoft
+import synthetic
+
+log = applog.get_logger("benchmark")
+
+# Métricas comparadas por --compare: (chave em "results", maior é melhor)
+_COMPARE_KEYS = (
+    ("items_per_second", True),
+    ("groups_per_second", True),
+    ("post_ms.p50", False),
+    ("post_ms.p99", False),
+    ("payload_build_ms.p50", False),
+    ("payload_build_ms.total", False),
+    ("payload_bytes.mean", False),
+    ("fetch_ms.p50", False),
+    ("peak_rss_mb", False),
+    ("tracemalloc_peak_mb", False),
+    ("wall_seconds", False),
+)
+
+
+_DEFAULT_LAB = "DIAGNÓSTICO DO BRASIL - DB"
+
+
+def _labs(value: str):
+    labs = list(dict.fromkeys(v.strip() for v in value.split(",") if v.strip()))
+    if not labs:
+        raise argparse.ArgumentTypeError("informe ao menos um terceirizado")
+    return labs
+
+
+def _range(value: str):
+    lo, _, hi = value.partition("-")
+    lo_i = int(lo)
+    hi_i = int(hi) if hi else lo_i
+    if lo_i < 1 or hi_i < lo_i:
+        raise argparse.ArgumentTypeError("use N ou MIN-MAX (>= 1)")
+    return lo_i, hi_i
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description="Benchmark ponta a ponta: base SQLite sintética -> poll_once -> API Bemsoft simulada."
+    )
+    g = p.add_argument_group("base sintética")
+    g.add_argument("--solicitacoes", type=int, default=5000, help="solicitações geradas (padrão 5000)")
+    g.add_argument("--items", type=_range, default=(1, 5), help="itens por solicitação, N ou MIN-MAX (padrão 1-5)")
+    g.add_argument("--exams", type=int, default=200, help="exames no texame, no /tests e na planilha (padrão 200)")
+    g.add_argument("--foreign-ratio", dest="foreign_ratio", type=float, default=0.2,
+                   help="fração de itens de um terceirizado fora do filtro (padrão 0.2)")
+    g.add_argument("--seed", type=int, default=42, help="semente da base e do servidor simulado (padrão 42)")
+
+    g = p.add_argument_group("API simulada")
+    g.add_argument("--latency-ms", dest="latency_ms", type=float, default=20.0, help="latência de cada POST (padrão 20)")
+    g.add_argument("--jitter-ms", dest="jitter_ms", type=float, default=5.0, help="variação da latência (padrão 5)")
+    g.add_argument("--error-rate", dest="error_rate", type=float, default=0.0, help="fração de POSTs com 500 (padrão 0)")
+    g.add_argument("--commit-error-rate", dest="commit_error_rate", type=float, default=0.0,
+                   help="fração de POSTs gravados pela API que mesmo assim respondem 500 (padrão 0)")
+    g.add_argument("--conflict-rate", dest="conflict_rate", type=float, default=0.0,
+                   help="fração de POSTs com 409 (padrão 0)")
+    g.add_argument("--burst-every", dest="burst_every", type=int, default=0,
+                   help="a cada N POSTs inicia uma rajada de 503 (padrão 0 = sem rajadas)")
+    g.add_argument("--burst-len", dest="burst_len", type=int, default=0, help="POSTs por rajada de 503 (padrão 0)")
+    g.add_argument("--rate-limit", dest="rate_limit", type=int, default=0,
+                   help="POSTs aceitos por segundo; acima disso 429 com Retry-After (padrão 0 = sem cota)")
+    g.add_argument("--capacity", type=int, default=0,
+                   help="POSTs em voo sem degradar a latência (padrão 0 = ilimitado)")
+
+    g = p.add_argument_group("monitor")
+    g.add_argument("--workers", type=int, default=config.MAX_WORKERS, help="BEMSOFT_MAX_WORKERS (padrão do .env)")
+    g.add_argument("--page-size", dest="page_size", type=int, default=config.FETCH_PAGE_SIZE,
+                   help="FETCH_PAGE_SIZE (padrão do .env)")
+    g.add_argument("--batch-max-orders", dest="batch_max_orders", type=int, default=config.BATCH_MAX_ORDERS,
+                   help="BEMSOFT_BATCH_MAX_ORDERS (padrão do .env)")
+    g.add_argument("--transport", choices=("sync", "async"), default=config.HTTP_TRANSPORT,
+                   help="BEMSOFT_HTTP_TRANSPORT (padrão do .env)")
+    g.add_argument("--rate", type=float, default=config.RATE_PER_SECOND,
+                   help="BEMSOFT_RATE_PER_SECOND (padrão do .env)")
+    g.add_argument("--adaptive", type=int, choices=(0, 1), default=int(config.ADAPTIVE_CONCURRENCY),
+                   help="BEMSOFT_ADAPTIVE_CONCURRENCY (padrão do .env)")
+    g.add_argument("--json-backend", dest="json_backend", choices=("auto", "orjson", "json"),
+                   default=config.JSON_BACKEND, help="JSON_BACKEND (padrão do .env)")
+    g.add_argument("--retry-base", dest="retry_base", type=float, default=0.5,
+                   help="BEMSOFT_RETRY_BASE_SECONDS durante o benchmark (padrão 0.5)")
+    g.add_argument("--breaker-cooldown", dest="breaker_cooldown", type=float, default=1.0,
+                   help="BEMSOFT_BREAKER_COOLDOWN durante o benchmark (padrão 1)")
+
+    g = p.add_argument_group("modo do monitor")
+    g.add_argument("--terceiros", type=_labs, default=list(config.TERCEIROS) or [_DEFAULT_LAB],
+                   help="TERCEIROS, separados por vírgula (padrão do .env); os itens são divididos entre eles")
+    g.add_argument("--outbox", type=int, choices=(0, 1), default=0,
+                   help="OUTBOX_ENABLED: envio pelo outbox durável (padrão 0)")
+    g.add_argument("--failed-store", dest="failed_store", choices=("files", "log"), default="files",
+                   help="FAILED_STORE: falhas em arquivos JSON ou no log segmentado (padrão files)")
+    g.add_argument("--shard-count", dest="shard_count", type=int, default=0,
+                   help="SHARD_MODE=hash com N partições em um único worker (padrão 0 = SHARD_MODE=off)")
+    g.add_argument("--lab-pipelines", dest="lab_pipelines", type=int, choices=(0, 1), default=0,
+                   help="LAB_PIPELINES: um pipeline (thread) por laboratório de --terceiros (padrão 0)")
+
+    g = p.add_argument_group("execução")
+    g.add_argument("--max-seconds", dest="max_seconds", type=float, default=600.0,
+                   help="interrompe a medição após N segundos (padrão 600)")
+    g.add_argument("--tracemalloc", action="store_true",
+                   help="mede o pico de alocações Python (mais preciso que o RSS, porém mais lento)")
+    g.add_argument("--workdir", default=None, help="pasta da base/falhas/caches (padrão: temporária, removida no fim)")
+    g.add_argument("--label", default="", help="rótulo livre gravado no resultado")
+    g.add_argument("--out", default=None, help="arquivo JSON do resultado (padrão completo/bench/bench-<data>.json)")
+    g.add_argument("--compare", default=None, help="resultado anterior (JSON) para imprimir as diferenças")
+    g.add_argument("--log-level", dest="log_level", default="WARNING", help="LOG_LEVEL do monitor (padrão WARNING)")
+    args = p.parse_args(argv)
+    # Mesmas combinações que o config.validate() recusa no monitor
+    if args.shard_count < 0:
+        p.error("--shard-count deve ser >= 0")
+    if args.shard_count and args.outbox:
+        p.error("--shard-count exige --outbox 0")
+    if args.lab_pipelines and (args.outbox or args.shard_count):
+        p.error("--lab-pipelines 1 exige --outbox 0 e --shard-count 0")
+    return args
+
+
+def percentiles(samples, scale=1000.0):
+    """Resumo (em ms) de uma lista de durações em segundos: p50/p90/p99 por posto mais próximo."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def rank(q):
+        return round(ordered[min(n - 1, max(0, int(q * n + 0.5) - 1))] * scale, 3)
+
+    return {
+        "count": n,
+        "mean": round(sum(ordered) / n * scale, 3),
+        "p50": rank(0.50),
+        "p90": rank(0.90),
+        "p99": rank(0.99),
+        "max": round(ordered[-1] * scale, 3),
+        "total": round(sum(ordered) * scale, 3),
+    }
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB no Linux, bytes no macOS
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(config.ROOT_DIR),
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _configure(args, workdir: str, db_path: str, base_url: str):
+    """Aponta o monitor para a base sintética e para a API simulada (antes de importar `main`)."""
+    # Atribui direto em `config`: o .env é carregado com override e venceria variáveis de ambiente
+    overrides = {
+        "DB_BACKEND": "sqlite",
+        "SQLITE_PATH": db_path,
+        "SOURCE_DRIVER": "watermark",
+        "OUTBOX_ENABLED": bool(args.outbox),
+        "SHARD_MODE": "hash" if args.shard_count else "off",
+        "SHARD_COUNT": max(1, args.shard_count),
+        "LAB_PIPELINES": bool(args.lab_pipelines),
+        # Todos os laboratórios usam a mesma API simulada
+        "LAB_SCOPED_IDS": bool(args.lab_pipelines) and len(args.terceiros) > 1,
+        "LAB_OVERRIDES": {},
+        "LAB_RATE_PER_SECOND": 0.0,
+        "DEBOUNCE_SECONDS": 0,
+        "ITEMSOL_INDEX_BOOTSTRAP": "off",
+        "TERCEIROS": list(args.terceiros),
+        "FETCH_PAGE_SIZE": max(1, args.page_size),
+        "MAX_WORKERS": max(1, args.workers),
+        "HTTP_POOL_SIZE": max(10, args.workers),
+        "BATCH_MAX_ORDERS": max(1, args.batch_max_orders),
+        "HTTP_TRANSPORT": args.transport,
+        "RATE_PER_SECOND": max(0.0, args.rate),
+        "ADAPTIVE_CONCURRENCY": bool(args.adaptive),
+        "JSON_BACKEND": args.json_backend,
+        "BASE_URL": base_url,
+        "REQS_ENDPOINT": "/requests",
+        "TOKEN": "benchmark",
+        "DRY_RUN": False,
+        "RETRIES_BACKOFF": 0.05,
+        "RETRY_BASE_SECONDS": args.retry_base,
+        "RETRY_MAX_SECONDS": max(args.retry_base, 5.0),
+        "BREAKER_COOLDOWN_SECONDS": args.breaker_cooldown,
+        "BREAKER_MAX_COOLDOWN_SECONDS": max(args.breaker_cooldown, 10.0),
+        "FAILED_STORE": args.failed_store,
+        "FAILED_DIR": os.path.join(workdir, "failed_events"),
+        "FAILED_LOG_DIR": os.path.join(workdir, "failed_events", "log"),
+        "TESTS_CACHE_PATH": os.path.join(workdir, "tests_index.json"),
+        "GOOGLE_SHEET_ID": "benchmark",
+        "GOOGLE_API_KEY": "benchmark",
+        "GOOGLE_SHEETS_API_URL": base_url + mock_bemsoft.SHEETS_PREFIX,
+        "GOOGLE_SHEET_CACHE_PATH": os.path.join(workdir, "sheets_snapshot.json"),
+        "GOOGLE_SHEET_REFRESH_SECONDS": 0,
+        "METRICS_PORT": 0,
+    }
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    config.TERCEIRO = config.TERCEIROS[0]
+    os.makedirs(config.FAILED_DIR, exist_ok=True)
+
+
+class _Lane:
+    """
+    Um fluxo do monitor medido como o main.py o roda: o pipeline padrão (com as partições do
+    sharding, se houver) ou o de um laboratório. `targets` é o checkpoint alvo (maior
+    CodItemSol elegível) de cada origem; None é a origem do próprio pipeline.
+    """
+
+    def __init__(self, monitor, pipeline, targets):
+        self.monitor = monitor
+        self.pipeline = pipeline
+        self.targets = targets
+        self.cycles = 0
+        self.timed_out = False
+        self.error = None
+
+    def checkpoints(self):
+        return [self.pipeline.lag["last_id"] if source is None else source.last for source in self.targets]
+
+    def caught_up(self) -> bool:
+        return all(last >= target for last, target in zip(self.checkpoints(), self.targets.values()))
+
+    def retrying(self) -> bool:
+        if len(self.pipeline.retry_queue):
+            return True
+        if config.OUTBOX_ENABLED:
+            import outbox
+            return outbox.pending_count() + outbox.retrying_count() > 0
+        return False
+
+    def poll(self, sess_http):
+        monitor = self.monitor
+        if len(self.pipeline.retry_queue):
+            monitor._drain_retry_queue(sess_http, self.pipeline)
+        shards = monitor.SHARDS if self.pipeline is monitor.PIPELINE else None
+        for source in (shards.rebalance() if shards else [None]):
+            monitor.poll_once(sess_http, source, self.pipeline)
+        self.cycles += 1
+
+    def run(self, sess_http, started: float, max_seconds: float):
+        try:
+            while True:
+                self.poll(sess_http)
+                caught_up = self.caught_up()
+                retrying = self.retrying()
+                if caught_up and not retrying:
+                    return
+                if time.perf_counter() - started > max_seconds:
+                    self.timed_out = True
+                    log.warning("tempo máximo atingido (%.0fs) em %s: checkpoints %s de %s", max_seconds,
+                                self.pipeline.name, self.checkpoints(), list(self.targets.values()))
+                    return
+                if self.pipeline.breaker.is_open() or (caught_up and retrying):
+                    # Circuito aberto ou só retentativas pendentes: espera como o loop real faria
+                    time.sleep(0.05)
+        except BaseException as e:
+            self.error = e
+
+
+def _lanes(monitor, database):
+    """Fluxos do modo configurado, com o checkpoint alvo de cada origem."""
+    if monitor.LAB_PIPELINES:
+        flows = [(p, [None]) for p in monitor.LAB_PIPELINES]
+    elif monitor.SHARDS:
+        flows = [(monitor.PIPELINE, monitor.SHARDS.partitions)]
+    else:
+        flows = [(monitor.PIPELINE, [None])]
+    lanes = []
+    with database.get_engine().connect() as conn:
+        for pipeline, sources in flows:
+            targets = {}
+            for source in sources:
+                target, _ = (source or pipeline.source).fetch_lag(conn, 0, pipeline.terceiros)
+                targets[source] = int(target or 0)
+            lanes.append(_Lane(monitor, pipeline, targets))
+    return lanes
+
+
+def run(args) -> dict:
+    own_workdir = args.workdir is None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bemsoft-bench-")
+    db_path = os.path.join(workdir, "bench.sqlite")
+    proc = None
+    try:
+        terceiros = list(args.terceiros)
+        seeded = synthetic.generate(
+            db_path, args.solicitacoes, items_per_sol=args.items, terceiros=terceiros,
+            exams=args.exams, foreign_ratio=args.foreign_ratio, seed=args.seed, reset=True,
+        )
+        mock_options = {
+            "exams": args.exams, "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate, "commit_error_rate": args.commit_error_rate,
+            "conflict_rate": args.conflict_rate,
+            "burst_every": args.burst_every, "burst_len": args.burst_len, "seed": args.seed,
+            "rate_limit": args.rate_limit, "capacity": args.capacity,
+        }
+        proc, base_url = mock_bemsoft.start_process(mock_options)
+        _configure(args, workdir, db_path, base_url)
+
+        # Origem, fila e breaker do monitor são montados por configure() com o config ajustado acima
+        import database
+        import main as monitor
+        import bemsoft_api
+        import async_http
+        import jsoncodec
+
+        import failstore
+        import outbox
+
+        # Mesma sequência de bootstrap do main.py
+        monitor.configure()
+        monitor.SOURCE.bootstrap_state()
+        for pipeline in monitor.LAB_PIPELINES:
+            pipeline.bootstrap_state()
+        if monitor.SHARDS:
+            monitor.SHARDS.start()
+        if config.OUTBOX_ENABLED:
+            outbox.bootstrap()
+        with database.get_engine().connect() as conn:
+            target, _ = database.fetch_lag(conn, 0, config.TERCEIROS)
+        target = int(target or 0)
+        lanes = _lanes(monitor, database)
+
+        post_samples, build_samples, fetch_samples, bytes_samples = [], [], [], []
+        metrics.POST_SECONDS.capture(post_samples)
+        metrics.PAYLOAD_BYTES.capture(bytes_samples)
+        metrics.PAYLOAD_BUILD_SECONDS.capture(build_samples)
+        metrics.FETCH_SECONDS.capture(fetch_samples)
+        sess_http = bemsoft_api._build_session()
+        if args.tracemalloc:
+            tracemalloc.start()
+
+        # Warm-up fora da medição: catálogo /tests e planilha (o monitor real carrega do snapshot)
+        warm_start = time.perf_counter()
+        bemsoft_api._get_tests_index().ensure_loaded(sess_http)
+        import sheets_client
+        sheets_client.get_test_info(synthetic.exam_code(1))
+        warmup_seconds = time.perf_counter() - warm_start
+
+        log.warning("medindo: %d itens elegíveis (CodItemSol <= %d), workers=%d, página=%d, transporte=%s, "
+                    "fluxos=%d", seeded["itens"], target, config.MAX_WORKERS, config.FETCH_PAGE_SIZE,
+                    config.HTTP_TRANSPORT, len(lanes))
+        started = time.perf_counter()
+        if len(lanes) == 1:
+            lanes[0].run(sess_http, started, args.max_seconds)
+        else:
+            # Pipelines por laboratório: uma thread por laboratório, como no main.py
+            threads = [threading.Thread(target=lane.run, args=(sess_http, started, args.max_seconds),
+                                        name=f"bench-{lane.pipeline.name}") for lane in lanes]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        wall = time.perf_counter() - started
+        if monitor.SHARDS:
+            monitor.SHARDS.stop()
+        for lane in lanes:
+            if lane.error is not None:
+                raise lane.error
+        timed_out = any(lane.timed_out for lane in lanes)
+
+        traced_peak = None
+        if args.tracemalloc:
+            traced_peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            tracemalloc.stop()
+        for hist in (metrics.POST_SECONDS, metrics.PAYLOAD_BUILD_SECONDS, metrics.FETCH_SECONDS, metrics.PAYLOAD_BYTES):
+            hist.capture(None)
+
+        items = int(metrics.ITEMS_FETCHED.value())
+        groups = {r: int(metrics.GROUPS_SENT.value(result=r)) for r in ("ok", "failed")}
+        sent = sum(groups.values())
+        statuses = {}
+        for label in ("200", "201", "409", "400", "401", "429", "5xx", "other", "exception"):
+            count = int(metrics.SEND_STATUS.value(status=label))
+            if count:
+                statuses[label] = count
+        failed_files = monitor._failed_backlog_size()
+        if config.FAILED_STORE == "log":
+            failstore.get_store().close()
+        try:
+            mock_stats = sess_http.get(base_url + "/__stats", timeout=5).json()
+        except Exception as e:
+            mock_stats = {"error": str(e)}
+        if config.HTTP_TRANSPORT == "async":
+            async_http.close_transport()
+
+        return {
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "params": {
+                "solicitacoes": args.solicitacoes, "items": list(args.items), "exams": args.exams,
+                "foreign_ratio": args.foreign_ratio, "seed": args.seed,
+                "workers": config.MAX_WORKERS, "page_size": config.FETCH_PAGE_SIZE,
+                "batch_max_orders": config.BATCH_MAX_ORDERS, "transport": config.HTTP_TRANSPORT,
+                "rate": config.RATE_PER_SECOND, "adaptive": config.ADAPTIVE_CONCURRENCY,
+                "json_backend": jsoncodec.backend(),
+                "terceiros": list(config.TERCEIROS), "outbox": config.OUTBOX_ENABLED,
+                "failed_store": config.FAILED_STORE,
+                "shard_count": config.SHARD_COUNT if config.SHARD_MODE == "hash" else 0,
+                "lab_pipelines": config.LAB_PIPELINES,
+                "mock": mock_options,
+            },
+            "results": {
+                "completed": not timed_out,
+                "wall_seconds": round(wall, 3),
+                "warmup_seconds": round(warmup_seconds, 3),
+                "cycles": sum(lane.cycles for lane in lanes),
+                "items": items,
+                "items_seeded": seeded["itens"],
+                # Maior checkpoint alcançado entre as origens (todas chegam ao próprio alvo)
+                "checkpoint": max(max(lane.checkpoints()) for lane in lanes),
+                "target_checkpoint": target,
+                "items_per_second": round(items / wall, 1) if wall else None,
+                "groups_per_second": round(sent / wall, 1) if wall else None,
+                "groups": groups,
+                "send_status": statuses,
+                "retries": {r: int(metrics.RETRIES.value(result=r)) for r in ("ok", "retry", "gave_up", "failed")},
+                "throttled": {r: int(metrics.HTTP_THROTTLED.value(reason=r))
+                              for r in ("retry_after", "quota", "overload", "latency")},
+                "throttle_wait_seconds": round(metrics.HTTP_THROTTLE_WAIT.value(), 3),
+                "failed_files": failed_files,
+                "post_ms": percentiles(post_samples),
+                "payload_build_ms": percentiles(build_samples),
+                "payload_bytes": percentiles(bytes_samples, scale=1.0),
+                "fetch_ms": percentiles(fetch_samples),
+                "peak_rss_mb": _peak_rss_mb(),
+                "tracemalloc_peak_mb": traced_peak,
+            },
+            "mock_stats": mock_stats,
+        }
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.join(5)
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _lookup(data: dict, dotted: str):
+    for part in dotted.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def compare(previous: dict, current: dict):
+    """Imprime a variação das métricas principais em relação a um resultado anterior."""
+    print(f"comparação com {previous.get('revision')} ({previous.get('timestamp')}) {previous.get('label') or ''}")
+    for key, higher_is_better in _COMPARE_KEYS:
+        old = _lookup(previous.get("results", {}), key)
+        new = _lookup(current.get("results", {}), key)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            continue
+        delta = (new - old) / old * 100 if old else 0.0
+        worse = delta < 0 if higher_is_better else delta > 0
+        flag = "pior" if worse and abs(delta) >= 5 else ""
+        print(f"  {key:<24} {old:>12} -> {new:>12}  ({delta:+.1f}%) {flag}")
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    applog.setup_logging(level=args.log_level, force=True)
+    log.setLevel("INFO")
+    result = run(args)
+
+    out = args.out or os.path.join(
+        config.ROOT_DIR, "completo", "bench", f"bench-{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    r = result["results"]
+    print(json.dumps(r, ensure_ascii=False, indent=2))
+    print(f"resultado gravado em {out}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), result)
+    return 0 if r["completed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from datetime import datetime
+from pathlib import Path
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import mock_bemsoft
+import synthetic
+from benchmark import _git_revision, _range
+
+log = applog.get_logger("benchmark_payload")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(
+        description="Micro-benchmark da montagem e serialização de payload, sem rede e sem POST."
+    )
+    p.add_argument("--solicitacoes", type=int, default=2000, help="solicitações geradas (padrão 2000)")
+    p.add_argument("--items", type=_range, default=(1, 5), help="itens por solicitação, N ou MIN-MAX (padrão 1-5)")
+    p.add_argument("--exams", type=int, default=200, help="exames no catálogo /tests e na planilha (padrão 200)")
+    p.add_argument("--seed", type=int, default=42, help="semente da base sintética (padrão 42)")
+    p.add_argument("--rounds", type=int, default=10, help="passadas medidas sobre todas as solicitações (padrão 10)")
+    p.add_argument("--cold", action="store_true",
+                   help="descarta o memo de exames e o cache de datas antes de cada order (pior caso)")
+    p.add_argument("--json-backend", dest="json_backend", choices=("auto", "orjson", "json"),
+                   default=config.JSON_BACKEND, help="JSON_BACKEND da serialização (padrão do .env)")
+    p.add_argument("--label", default="", help="rótulo livre gravado no resultado")
+    p.add_argument("--out", default=None, help="arquivo JSON do resultado (opcional)")
+    return p.parse_args(argv)
+
+
+def _configure(db_path: str, json_backend: str):
+    """Base sintética no SQLite; catálogo e planilha ficam em memória (nenhum acesso à rede)."""
+    overrides = {
+        "DB_BACKEND": "sqlite",
+        "SQLITE_PATH": db_path,
+        "SOURCE_DRIVER": "watermark",
+        "OUTBOX_ENABLED": False,
+        "ITEMSOL_INDEX_BOOTSTRAP": "off",
+        "TERCEIROS": list(config.TERCEIROS) or ["DIAGNÓSTICO DO BRASIL - DB"],
+        "TOKEN": "benchmark",
+        "DRY_RUN": False,
+        "METRICS_PORT": 0,
+        "JSON_BACKEND": json_backend,
+    }
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    config.TERCEIRO = config.TERCEIROS[0]
+
+
+def _load_catalogs(exams: int):
+    """Publica o catálogo /tests e a planilha sintéticos (os mesmos do mock_bemsoft) direto nos caches."""
+    import bemsoft_api
+    import sheets_client
+
+    index = bemsoft_api.TestsIndex("http://benchmark.invalid", "benchmark", 5, snapshot_path="", ttl=0)
+    index.cache = bemsoft_api._parse_catalog(mock_bemsoft.catalog(exams))
+    index.loaded_at = time.time()
+    bemsoft_api._TESTS_INDEX = index
+
+    rows = mock_bemsoft.sheet_values(exams)["values"]
+    sheets = sheets_client.SheetsCache("benchmark", "Sheet1!A:C", "benchmark", snapshot_path="", refresh_seconds=0)
+    sheets.cache = {r[0].upper(): {"TEST_NAME": r[1], "SUPPORT_LAB_DESCMAT": r[2]} for r in rows[1:]}
+    sheets.loaded_at = time.time()
+    sheets._loaded = True
+    sheets_client._SHEETS_CACHE = sheets
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bemsoft-payload-")
+    try:
+        db_path = os.path.join(workdir, "payload.sqlite")
+        terceiros = list(config.TERCEIROS) or ["DIAGNÓSTICO DO BRASIL - DB"]
+        synthetic.generate(db_path, args.solicitacoes, items_per_sol=args.items, terceiros=terceiros,
+                           exams=args.exams, foreign_ratio=0.0, seed=args.seed, reset=True)
+        _configure(db_path, args.json_backend)
+
+        import database
+        import main as monitor
+        import bemsoft_api
+        import jsoncodec
+
+        _load_catalogs(args.exams)
+        with database.get_engine().connect() as conn:
+            rows = database.iter_items(conn, 0, config.TERCEIROS, limit=10 ** 9)
+            _count, groups = database.group_rows(rows)
+        events = [monitor._group_event(g) for g in groups.values()]
+        items = sum(len(ev["itens"]) for ev in events)
+
+        reset = getattr(bemsoft_api, "reset_payload_cache", None)
+        if args.cold and reset is None:
+            raise SystemExit("--cold requer bemsoft_api.reset_payload_cache")
+        sess = bemsoft_api._build_session()
+
+        # Passada de aquecimento fora da medição (resolução inicial de cada exame, imports, alocações)
+        for ev in events:
+            bemsoft_api.build_payload(ev, session=sess)
+
+        log.warning("medindo: %d solicitações, %d itens, %d passada(s)%s",
+                    len(events), items, args.rounds, " (frio)" if args.cold else "")
+        # Por passada: montagem (wall e CPU) e, em seguida, a serialização dos mesmos payloads
+        per_round, serialize_round, build_cpu, serialize_cpu = [], [], [], []
+        body_bytes = 0
+        for _ in range(max(1, args.rounds)):
+            started, cpu_started = time.perf_counter(), time.process_time()
+            payloads = []
+            for ev in events:
+                if args.cold:
+                    reset()
+                payloads.append(bemsoft_api.build_payload(ev, session=sess))
+            built, cpu_built = time.perf_counter(), time.process_time()
+            body_bytes = sum(len(jsoncodec.dumps(payload)) for payload in payloads)
+            per_round.append(built - started)
+            serialize_round.append(time.perf_counter() - built)
+            build_cpu.append(cpu_built - cpu_started)
+            serialize_cpu.append(time.process_time() - cpu_built)
+
+        best = min(per_round)
+        median = statistics.median(per_round)
+        n = len(events)
+        return {
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "python": sys.version.split()[0],
+            "params": {
+                "solicitacoes": args.solicitacoes, "items": list(args.items), "exams": args.exams,
+                "seed": args.seed, "rounds": args.rounds, "cold": args.cold,
+                "json_backend": jsoncodec.backend(),
+            },
+            "results": {
+                "orders": len(events),
+                "items": items,
+                "orders_per_second": round(n / median, 1),
+                "orders_per_second_best": round(n / best, 1),
+                "items_per_second": round(items / median, 1),
+                "us_per_order": round(median / n * 1e6, 2),
+                "serialize_us_per_order": round(statistics.median(serialize_round) / n * 1e6, 2),
+                "cpu_us_per_order": {
+                    "build": round(statistics.median(build_cpu) / n * 1e6, 2),
+                    "serialize": round(statistics.median(serialize_cpu) / n * 1e6, 2),
+                },
+                "bytes_per_order": round(body_bytes / n, 1),
+                "round_seconds": [round(s, 4) for s in per_round],
+            },
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    applog.setup_logging(level="WARNING", force=True)
+    result = run(args)
+    print(json.dumps(result["results"], ensure_ascii=False, indent=2))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"resultado gravado em {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
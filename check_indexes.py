@@ -0,0 +1,53 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import index_advisor
+
+log = applog.get_logger("indexes")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Verifica/cria o índice de cobertura do ItemSol e mostra o plano real da leitura.")
+    p.add_argument("--create", action="store_true", help="cria o índice sugerido se não houver um de cobertura")
+    p.add_argument("--ddl", action="store_true", help="apenas imprime o CREATE INDEX sugerido")
+    p.add_argument("--filtered", action="store_true", default=config.ITEMSOL_INDEX_FILTERED,
+                   help="índice filtrado pelos TERCEIROS (padrão ITEMSOL_INDEX_FILTERED)")
+    p.add_argument("--no-explain", dest="explain", action="store_false", help="não executa a leitura para obter o plano")
+    p.add_argument("--last", type=int, default=None, help="CodItemSol inicial da leitura (padrão: checkpoint atual)")
+    p.add_argument("--json", action="store_true", help="imprime o resumo do plano em JSON")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.ddl:
+        print(index_advisor.build_create_index(config.TERCEIROS, filtered=args.filtered))
+        return 0
+    if args.filtered:
+        # Mesmo efeito de ITEMSOL_INDEX_FILTERED=1: a leitura precisa de OPTION (RECOMPILE)
+        config.ITEMSOL_INDEX_FILTERED = config.FETCH_RECOMPILE = True
+    result = index_advisor.ensure_index(create=args.create)
+    if not args.explain:
+        return 0 if result["covered"] else 1
+    summary = index_advisor.explain_fetch(last=args.last)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        index_advisor.log_plan(summary)
+    return 0 if result["covered"] and summary["seek"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
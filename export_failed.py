@@ -0,0 +1,46 @@
+import sys
+import argparse
+from pathlib import Path
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import failstore
+
+log = applog.get_logger("export")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Exporta o log de falhas (FAILED_STORE=log) para o formato legado.")
+    p.add_argument("--log-dir", dest="log_dir", default=config.FAILED_LOG_DIR, help="diretório do log (padrão FAILED_LOG_DIR)")
+    p.add_argument("--out", default=config.FAILED_DIR, help="destino dos arquivos <ts>_<cod>.json (padrão FAILED_DIR)")
+    p.add_argument("--resolve", action="store_true", help="remove do log as falhas exportadas")
+    p.add_argument("--compact", action="store_true", help="compacta o log (só entradas em aberto) antes de exportar")
+    p.add_argument("--list", action="store_true", help="apenas lista as falhas em aberto")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    store = failstore.FailureLog(args.log_dir)
+    if args.compact:
+        store.compact()
+    if args.list:
+        for item in store.pending():
+            log.info("cod=%s ts=%s tentativas=%s motivo=%s", item["cod"], item["ts"], item["count"], item["reason"])
+        return 0
+    count = store.export_legacy(args.out, resolve=args.resolve)
+    store.close()
+    log.info("%d falha(s) exportada(s) para %s", count, args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,17 @@
+import threading
+import time
+
+# Referência do tempo de startup (imports + configuração + bootstrap), logado no main()
+_PROCESS_START = time.perf_counter()
+
 import os
 import sys
-import time
-import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from datetime import date, datetime, time as dt_time
-import dotenv
-from dotenv import load_dotenv
 
 # Detecta se está rodando como executável PyInstaller
 if getattr(sys, 'frozen', False):
@@ -23,10 +27,70 @@ else:
 import config
 import database
 import bemsoft_api
+import outbox
+import change_tracking
+import index_advisor
+import failstore
+import jsoncodec
+import retryq
+import async_http
+import sheets_client
+import applog
+import metrics
+import preflight
+import sharding
+import pipelines
+from filelock import FileLock
 
+log = applog.get_logger(__name__)
+
+_IMPORTS_DONE = time.perf_counter()
 
 PENDING_SOLICITACOES: Dict[Any, float] = {}
 
+# Métricas de atraso (lag) do monitor, atualizadas a cada ciclo
+LAG_METRICS: Dict[str, Any] = pipelines.new_lag_metrics()
+
+# Estado montado por configure() a partir do config (não no import, que não lê o .env):
+# SOURCE: origem das mudanças no modo direto, keyset por CodItemSol (`database`) ou Change
+#   Tracking; os dois módulos expõem bootstrap_state/claim_groups/commit_checkpoint/fetch_lag.
+# SHARDS: sharding entre processos (SHARD_MODE=hash), partições com checkpoint e lease próprios.
+# RETRY_QUEUE/BREAKER: retentativas em memória (falhas transitórias) e circuit breaker.
+# PIPELINE: pipeline padrão, todos os TERCEIROS em um só fluxo.
+# LAB_PIPELINES: um fluxo isolado por terceirizado (LAB_PIPELINES=1), cada um em thread própria.
+SOURCE: Any = None
+SHARDS: Optional[sharding.Coordinator] = None
+RETRY_QUEUE: Optional[retryq.RetryQueue] = None
+BREAKER: Optional[retryq.CircuitBreaker] = None
+PIPELINE: Optional[pipelines.Pipeline] = None
+LAB_PIPELINES: List[pipelines.LabPipeline] = []
+_CONFIGURE_LOCK = threading.Lock()
+
+
+def configure() -> pipelines.Pipeline:
+    """Monta origem, sharding, retentativas, breaker e pipelines a partir do config (uma vez)."""
+    global SOURCE, SHARDS, RETRY_QUEUE, BREAKER, PIPELINE, LAB_PIPELINES
+    with _CONFIGURE_LOCK:
+        if PIPELINE is not None:
+            return PIPELINE
+        direct = not config.OUTBOX_ENABLED
+        source = change_tracking if config.SOURCE_DRIVER == "changetracking" and direct else database
+        shards = (
+            sharding.Coordinator.from_config()
+            if config.SHARD_MODE == "hash" and source is database and direct
+            else None
+        )
+        RETRY_QUEUE = pipelines.new_retry_queue()
+        BREAKER = pipelines.new_breaker()
+        LAB_PIPELINES = (
+            pipelines.build_lab_pipelines()
+            if config.LAB_PIPELINES and source is database and direct and shards is None
+            else []
+        )
+        SOURCE, SHARDS = source, shards
+        PIPELINE = pipelines.Pipeline("default", SOURCE, BREAKER, RETRY_QUEUE, PENDING_SOLICITACOES, LAG_METRICS)
+        return PIPELINE
+
 
 def _normalize_value(value: Any) -> Any:
     if isinstance(value, datetime):
@@ -47,14 +111,46 @@ def _json_default(value: Any) -> Any:
     return normalized
 
 
-def persist_failed(event: Dict[str, Any], reason: str = ""):
+def failed_lock_path() -> str:
+    """Lock compartilhado entre o monitor e o retry_failed.py sobre FAILED_DIR."""
+    return os.path.join(config.FAILED_DIR, config.FAILED_LOCK_NAME)
+
+
+def persist_failed(event: Dict[str, Any], reason: str = "") -> Any:
+    """Grava a falha no armazenamento configurado; retorna um handle para discard_failed()."""
+    event = _persistable(event)
+    if config.FAILED_STORE == "log":
+        key = failstore.failure_key(event)
+        ts = failstore.get_store().append(event, reason, default=_json_default)
+        log.warning("falha registrada no log de falhas: cod=%s ts=%s", key, ts)
+        # Com os itens deste evento: a retentativa não resolve um registro unido a falhas anteriores
+        return (key, ts, failstore.item_ids(event))
     ts = datetime.now().strftime("%Y%m%dT%H%M%S%f")
-    key = event.get("solicitacao", {}).get("codsolicitacao", "unknown")
+    # Mesma chave do log de falhas: orders de laboratórios diferentes não se superam no retry_failed.py
+    key = failstore.failure_key(event)
     path = os.path.join(config.FAILED_DIR, f"{ts}_{key}.json")
-    data = {"reason": reason, "event": event}
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=2, default=_json_default))
-    print(f"[fail] salvo para retry manual: {path}")
+    # Serializado uma vez, compacto, fora do lock
+    data = jsoncodec.dumps({"reason": reason, "event": event}, default=_json_default)
+    # Escrita atômica sob o lock de FAILED_DIR: o retry_failed.py nunca lê arquivo pela metade
+    tmp = path + ".tmp"
+    with FileLock(failed_lock_path()):
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    log.warning("falha salva para retry manual: %s", path)
+    return path
+
+
+def discard_failed(handle: Any):
+    """Remove uma falha gravada por persist_failed() que acabou entregue por uma retentativa."""
+    if not handle:
+        return
+    if isinstance(handle, tuple):
+        failstore.get_store().resolve(*handle)
+        return
+    with FileLock(failed_lock_path()):
+        if os.path.exists(handle):
+            os.remove(handle)
 
 
 def row_to_item(r: Dict[str, Any]) -> Dict[str, Any]:
@@ -77,7 +173,16 @@ def row_to_item(r: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def build_group_event(head_row: Dict[str, Any], items: List[Dict[str, Any]]) -> Dict[str, Any]:
+def _persistable(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Evento com os itens em dicts (row_to_item) para gravar em JSON: os grupos guardam as linhas (ItemRow)."""
+    items = event.get("itens") or []
+    if not any(isinstance(it, database.ItemRow) for it in items):
+        return event
+    return dict(event, itens=[row_to_item(it) if isinstance(it, database.ItemRow) else it for it in items])
+
+
+def build_group_event(head_row: Dict[str, Any], items: List[Dict[str, Any]], revision: Any = None,
+                      lab: Optional[str] = None) -> Dict[str, Any]:
     solicitacao = {
         "codsolicitacao": _normalize_value(head_row["CodSolicitacao"]),
         "codpaciente": _normalize_value(head_row["codpaciente"]),
@@ -99,132 +204,841 @@ def build_group_event(head_row: Dict[str, Any], items: List[Dict[str, Any]]) ->
         "sexo": _normalize_value(head_row.get("PacienteSexo")),
         "codpaciente": _normalize_value(head_row.get("codpaciente")),
     }
-    return {"solicitacao": solicitacao, "paciente": paciente, "itens": items}
+    event = {"solicitacao": solicitacao, "paciente": paciente, "itens": items}
+    if revision:
+        # Solicitação alterada (Change Tracking): entra na Idempotency-Key do reenvio
+        event["revisao"] = revision
+    if lab:
+        # Pipeline por laboratório (LAB_PIPELINES=1): define endpoint/token e a chave da falha
+        # (na Idempotency-Key só com LAB_SCOPED_IDS=1)
+        event["lab"] = lab
+    return event
 
 
-def poll_once(sess_http: Optional[bemsoft_api.Session]) -> int:
-    """Lê last_id, busca novos itens, debounce, agrupa por solicitação e envia 1 payload por grupo."""
-    poll_start = datetime.now()
+def _group_event(g: Dict[str, Any]) -> Dict[str, Any]:
+    return build_group_event(g["head"], g["items"], g.get("revisao"), g.get("lab"))
 
-    with database.ENGINE.begin() as conn:
-        query_start = datetime.now()
-        last = conn.execute(database.SQL_GET_LAST).scalar() or 0
-        rows = database.fetch_items(conn, last, config.TERCEIROS)
-        query_end = datetime.now()
-        query_duration = (query_end - query_start).total_seconds()
 
-        if not rows:
-            return last
+def _record_failure(cod: Any, g: Dict[str, Any], event: Dict[str, Any], status: Optional[int],
+                    error: Any, exc: Optional[BaseException] = None,
+                    pipeline: Optional[pipelines.Pipeline] = None) -> bool:
+    """
+    Grava a falha no armazenamento de falhas e, se for transitória, agenda uma retentativa
+    em memória (a falha gravada é descartada se a retentativa entregar). 400/401 e erros de
+    montagem do payload ficam só no armazenamento. Retorna True se foi para a fila.
+    No outbox, a retentativa fica na própria linha (NextAttemptAt) e a falha só é gravada
+    quando não há mais retentativa.
+    """
+    retry_queue = (pipeline or configure()).retry_queue
+    reason = f"HTTP {status}: {error}" if status else str(error)
+    if "outbox_items" in g:
+        # Outbox: a retentativa é durável (NextAttemptAt na linha, gravado por mark_results);
+        # a falha só vai para o armazenamento quando não há mais retentativa
+        attempts = g.get("outbox_attempts", 0)
+        if outbox.retry_delay(attempts, retryq.is_transient(status, exc)) is not None:
+            log.warning("solicitação %s: falha transitória (status=%s), o outbox retenta (%d/%d)",
+                        cod, status, attempts + 1, config.RETRY_MAX_ATTEMPTS)
+            return False
+        persist_failed(event, reason=reason)
+        return False
+    handle = persist_failed(event, reason=reason)
+    if not retry_queue.enabled or not retryq.is_transient(status, exc):
+        return False
+    entry = retry_queue.schedule(cod, g, error=error, handle=handle)
+    log.warning(
+        "solicitação %s: falha transitória (status=%s), retentativa %d/%d em ~%.0fs",
+        cod, status, entry.attempts, retry_queue.max_attempts, entry.next_at - time.monotonic(),
+    )
+    return True
+
 
-        print(f"[{query_end.strftime('%Y-%m-%d %H:%M:%S')}] Encontrados {len(rows)} itens em {query_duration:.2f}s")
+def _send_group(cod: Any, g: Dict[str, Any], sess_http: Optional[bemsoft_api.Session],
+                pipeline: Optional[pipelines.Pipeline] = None) -> Dict[str, Any]:
+    """
+    Monta e envia o payload de uma solicitação; falhas de envio vão para FAILED_DIR
+    (e as transitórias também para a fila de retentativas).
+    Retorna {"ok", "status", "error", "transient"} com o resultado do envio.
+    """
+    event = _group_event(g)
+    send_start = datetime.now()
+    log.debug("enviando solicitação %s com %d item(ns)", cod, len(g["items"]))
 
-        # Agrupa por solicitação
-        groups: Dict[Any, Dict[str, Any]] = {}
-        for r in rows:
-            k = r["CodSolicitacao"]
-            if k not in groups:
-                groups[k] = {"head": r, "items": []}
-            groups[k]["items"].append(row_to_item(r))
+    try:
+        result = bemsoft_api.send_to_bemsoft(event, session=sess_http, print_payload=True)
+    except Exception as e:
+        return _finish_send(cod, g, event, None, (datetime.now() - send_start).total_seconds(), exc=e,
+                            pipeline=pipeline)
+    return _finish_send(cod, g, event, result, (datetime.now() - send_start).total_seconds(), pipeline=pipeline)
 
-        now_ts = time.time()
-        ready_groups: List[Tuple[Any, Dict[str, Any]]] = []
-        pending_count = 0
 
-        if config.DEBOUNCE_SECONDS > 0:
-            stale = [k for k in list(PENDING_SOLICITACOES.keys()) if k not in groups]
-            for key in stale:
-                PENDING_SOLICITACOES.pop(key, None)
-
-        for cod, g in groups.items():
-            if config.DEBOUNCE_SECONDS > 0:
-                first_seen = PENDING_SOLICITACOES.setdefault(cod, now_ts)
-                wait_remaining = config.DEBOUNCE_SECONDS - (now_ts - first_seen)
-                if wait_remaining > 0:
-                    pending_count += 1
-                    if first_seen == now_ts or wait_remaining <= config.POLL_SECONDS:
-                        seconds_left = int(wait_remaining)
-                        if seconds_left < 1:
-                            seconds_left = 1
-                        print(
-                            f"[debounce] solicitação {cod} aguardando {seconds_left}s antes do envio."
-                        )
-                    continue
-            ready_groups.append((cod, g))
-
-        if not ready_groups:
-            if pending_count:
-                print(
-                    f"[debounce] aguardando {pending_count} solicitação(ões) na fila"
-                    f" (janela {config.DEBOUNCE_SECONDS}s)."
-                )
-            return last
-
-        new_last = last
-        for cod, g in ready_groups:
-            event = build_group_event(g["head"], g["items"])
-            send_start = datetime.now()
-            print(f"[{send_start.strftime('%Y-%m-%d %H:%M:%S')}] Enviando solicitação {cod} com {len(g['items'])} item(ns)...")
+def _finish_send(cod: Any, g: Dict[str, Any], event: Dict[str, Any], result: Optional[Dict[str, Any]],
+                 send_duration: float, exc: Optional[BaseException] = None,
+                 pipeline: Optional[pipelines.Pipeline] = None) -> Dict[str, Any]:
+    """Loga o resultado do envio de uma solicitação e grava/agenda a falha, se houver."""
+    if exc is not None:
+        log.error("solicitação %s exceção ao enviar (tempo: %.2fs): %s", cod, send_duration, exc)
+        _record_failure(cod, g, event, None, str(exc), exc=exc, pipeline=pipeline)
+        return {"ok": False, "status": None, "error": str(exc), "transient": retryq.is_transient(None, exc)}
 
+    result = result or {}
+    ok = result.get("ok")
+    status = result.get("status")
+    if ok:
+        log.info("solicitação %s entregue (status=%s, %d item(ns), tempo: %.2fs)", cod, status, len(g["items"]), send_duration)
+    else:
+        log.error("solicitação %s erro (status=%s, tempo: %.2fs): %s", cod, status, send_duration, result.get("error"))
+        _record_failure(cod, g, event, status, result.get("error"), pipeline=pipeline)
+    transient = not ok and retryq.is_transient(status)
+    return {"ok": bool(ok), "status": status, "error": result.get("error"), "transient": transient}
+
+
+def _dispatch_async(
+    ready_groups: List[Tuple[Any, Dict[str, Any]]],
+    sess_http: Any,
+    complete: Callable[[List[Tuple[Any, Dict[str, Any]]]], None],
+    pipeline: Optional[pipelines.Pipeline] = None,
+) -> None:
+    """
+    Transporte assíncrono: monta os payloads na thread principal e agenda todos os POSTs no
+    event loop do transporte; a concorrência real fica a cargo do pool aiohttp (limite por host).
+    """
+    log.info("enviando %d solicitação(ões) pelo transporte assíncrono", len(ready_groups))
+    futures: Dict[Any, Tuple[Any, Dict[str, Any], Dict[str, Any], float]] = {}
+    for cod, g in ready_groups:
+        event = _group_event(g)
+        if pipeline is not None:
+            pipeline.throttle()
+        send_start = time.monotonic()
+        try:
+            fut = bemsoft_api.submit_to_bemsoft(event, session=sess_http, print_payload=True)
+        except Exception as e:
+            complete([(cod, _finish_send(cod, g, event, None, 0.0, exc=e, pipeline=pipeline))])
+            continue
+        futures[fut] = (cod, g, event, send_start)
+
+    for fut in as_completed(futures):
+        cod, g, event, send_start = futures[fut]
+        send_duration = time.monotonic() - send_start
+        try:
+            outcome = _finish_send(cod, g, event, fut.result(), send_duration, pipeline=pipeline)
+        except Exception as e:
+            outcome = _finish_send(cod, g, event, None, send_duration, exc=e, pipeline=pipeline)
+        complete([(cod, outcome)])
+
+
+def _send_batch(
+    unit: List[Tuple[Any, Dict[str, Any]]],
+    sess_http: Optional[bemsoft_api.Session],
+    pipeline: Optional[pipelines.Pipeline] = None,
+) -> List[Tuple[Any, Dict[str, Any]]]:
+    """
+    Envia várias solicitações em POSTs multi-order e atribui o resultado a cada CodSolicitacao;
+    as que falharem vão individualmente para FAILED_DIR.
+    Com o circuit breaker aberto nada é enviado e as solicitações voltam como "skipped".
+    """
+    pipeline = pipeline or configure()
+    if not pipeline.breaker.allow():
+        return [(cod, {"ok": False, "status": None, "error": "circuito aberto", "skipped": True}) for cod, _ in unit]
+    pipeline.throttle()
+    if len(unit) == 1:
+        cod, g = unit[0]
+        return [(cod, _send_group(cod, g, sess_http, pipeline))]
+
+    events = [_group_event(g) for _, g in unit]
+    send_start = datetime.now()
+    log.debug("enviando lote com %d solicitação(ões)", len(unit))
+    batch_exc: Optional[BaseException] = None
+    try:
+        results = bemsoft_api.send_batch_to_bemsoft(events, session=sess_http, print_payload=True)
+    except Exception as e:
+        batch_exc = e
+        results = [{"ok": False, "status": None, "error": str(e)} for _ in unit]
+    send_duration = (datetime.now() - send_start).total_seconds()
+
+    outcomes: List[Tuple[Any, Dict[str, Any]]] = []
+    for (cod, g), event, result in zip(unit, events, results):
+        ok = result.get("ok")
+        status = result.get("status")
+        # Exceção no POST do lote desta solicitação (os demais lotes têm o próprio resultado)
+        exc = result.get("exception") or batch_exc
+        if ok:
+            log.info("solicitação %s entregue (status=%s, lote: %.2fs)", cod, status, send_duration)
+        else:
+            log.error("solicitação %s erro (status=%s): %s", cod, status, result.get("error"))
+            _record_failure(cod, g, event, status, result.get("error"), exc=exc, pipeline=pipeline)
+        transient = not ok and retryq.is_transient(status, exc)
+        outcomes.append((cod, {"ok": bool(ok), "status": status, "error": result.get("error"), "transient": transient}))
+    return outcomes
+
+
+def _dispatch_groups(
+    ready_groups: List[Tuple[Any, Dict[str, Any]]],
+    sess_http: Optional[bemsoft_api.Session],
+    on_done: Optional[Callable[[Any, Dict[str, Any]], None]] = None,
+    pipeline: Optional[pipelines.Pipeline] = None,
+) -> Set[Any]:
+    """
+    Envia os grupos prontos e retorna as solicitações concluídas (entregues ou salvas em FAILED_DIR).
+    Com BEMSOFT_MAX_WORKERS > 1 usa um pool de threads sobre a mesma sessão HTTP e, com
+    BEMSOFT_BATCH_MAX_ORDERS > 1, cada worker envia um lote de até N solicitações por POST.
+    `on_done(cod, resultado)` é chamado na thread principal a cada solicitação concluída.
+    """
+    pipeline = pipeline or configure()
+    breaker = pipeline.breaker
+    done: Set[Any] = set()
+    size = config.BATCH_MAX_ORDERS
+    units = [ready_groups[i:i + size] for i in range(0, len(ready_groups), size)]
+    workers = min(pipeline.max_workers, len(units))
+
+    def _complete(outcomes: List[Tuple[Any, Dict[str, Any]]]) -> None:
+        for cod, outcome in outcomes:
+            if outcome.get("skipped"):
+                # Circuito aberto: não foi enviada nem gravada; fica para um próximo ciclo
+                continue
+            if outcome.get("transient"):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            metrics.GROUPS_SENT.inc(result="ok" if outcome.get("ok") else "failed")
+            metrics.SEND_STATUS.inc(status=metrics.status_label(outcome.get("status")))
+            done.add(cod)
+            if on_done:
+                on_done(cod, outcome)
+
+    # Transporte assíncrono com o circuito fechado: todos os POSTs em voo no event loop
+    if (
+        size == 1
+        and isinstance(getattr(sess_http, "transport", None), async_http.AsyncTransport)
+        and breaker.state == retryq.STATE_CLOSED
+    ):
+        _dispatch_async(ready_groups, sess_http, _complete, pipeline)
+        return done
+
+    if workers <= 1:
+        for unit in units:
             try:
-                result = bemsoft_api.send_to_bemsoft(event, session=sess_http, print_payload=True)
-                send_end = datetime.now()
-                send_duration = (send_end - send_start).total_seconds()
-
-                ok = result.get("ok")
-                status = result.get("status")
-                if ok:
-                    print(f"[{send_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] entregue com sucesso (status={status}, tempo: {send_duration:.2f}s).")
-                else:
-                    print(f"[{send_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] erro (status={status}, tempo: {send_duration:.2f}s): {result.get('error')}")
-                    persist_failed(event, reason=f"HTTP {status}: {result.get('error')}")
+                outcomes = _send_batch(unit, sess_http, pipeline)
             except Exception as e:
-                send_end = datetime.now()
-                send_duration = (send_end - send_start).total_seconds()
-                print(f"[{send_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] exceção ao enviar (tempo: {send_duration:.2f}s): {e}")
-                persist_failed(event, reason=str(e))
+                # Não conseguiu nem persistir a falha: para aqui para não pular itens
+                log.exception("solicitação(ões) %s não concluída(s): %s", [cod for cod, _ in unit], e)
+                breaker.record_failure()
+                break
+            _complete(outcomes)
+        return done
+
+    log.info("enviando %d solicitação(ões) em %d envio(s) com %d worker(s)", len(ready_groups), len(units), workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bemsoft") as pool:
+        futures = {pool.submit(_send_batch, unit, sess_http, pipeline): unit for unit in units}
+        for fut in as_completed(futures):
+            unit = futures[fut]
+            try:
+                outcomes = fut.result()
+            except Exception as e:
+                log.exception("solicitação(ões) %s não concluída(s): %s", [cod for cod, _ in unit], e)
+                breaker.record_failure()
+                continue
+            _complete(outcomes)
+    return done
+
+
+def _group_positions(g: Dict[str, Any]) -> List[int]:
+    """Posição de cada item no checkpoint: CodItemSol, ou a versão da mudança no Change Tracking."""
+    return g.get("positions") or [i["CodItemSol"] for i in g["items"]]
+
+
+def _contiguous_checkpoint(
+    last: int,
+    ready_groups: List[Tuple[Any, Dict[str, Any]]],
+    done: Set[Any],
+) -> int:
+    """
+    Calcula o novo last_id avançando apenas pelo prefixo contínuo de grupos concluídos
+    (em ordem de CodItemSol). O checkpoint nunca passa do primeiro item de um grupo
+    não concluído, então um crash no meio do envio não pula itens; no pior caso um
+    grupo já entregue é reenviado (a Idempotency-Key faz a API responder 409).
+    """
+    ordered = sorted(ready_groups, key=lambda cg: min(_group_positions(cg[1])))
+    new_last = last
+    for cod, g in ordered:
+        ids = _group_positions(g)
+        if cod not in done:
+            new_last = min(new_last, min(ids) - 1)
+            break
+        new_last = max(new_last, max(ids))
+    return max(last, new_last)
+
+
+class _CheckpointTracker:
+    """
+    Acompanha as solicitações concluídas de um ciclo e grava o checkpoint em pequenos
+    commits incrementais (a cada CHECKPOINT_EVERY_GROUPS grupos ou CHECKPOINT_EVERY_SECONDS),
+    para que o progresso sobreviva a um crash no meio do lote.
+    """
 
-            group_max = max(i["CodItemSol"] for i in g["items"])
-            new_last = max(new_last, group_max)
-            PENDING_SOLICITACOES.pop(cod, None)
+    def __init__(self, last: int, ready_groups: List[Tuple[Any, Dict[str, Any]]], source: Any = None):
+        self.committed = last
+        self.ready_groups = ready_groups
+        self.source = source or configure().source
+        self.done: Set[Any] = set()
+        self._pending = 0
+        self._last_flush = time.monotonic()
 
-        update_start = datetime.now()
-        conn.execute(database.SQL_SET_LAST, {"last": new_last})
-        update_end = datetime.now()
-        print(f"[{update_end.strftime('%Y-%m-%d %H:%M:%S')}] Estado atualizado para last_id={new_last}")
+    def mark_done(self, cod: Any, outcome: Optional[Dict[str, Any]] = None) -> None:
+        self.done.add(cod)
+        self._pending += 1
+        elapsed = time.monotonic() - self._last_flush
+        if self._pending >= config.CHECKPOINT_EVERY_GROUPS or elapsed >= config.CHECKPOINT_EVERY_SECONDS:
+            self.flush()
 
-        poll_end = datetime.now()
-        poll_duration = (poll_end - poll_start).total_seconds()
-        print(f"[{poll_end.strftime('%Y-%m-%d %H:%M:%S')}] Ciclo concluído em {poll_duration:.2f}s\n")
+    def flush(self) -> int:
+        new_last = _contiguous_checkpoint(self.committed, self.ready_groups, self.done)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        if new_last > self.committed:
+            self.source.commit_checkpoint(new_last)
+            self.committed = new_last
+            log.info("estado atualizado para last_id=%s", new_last)
+        return self.committed
+
+
+class _OutboxTracker:
+    """Acumula os resultados de envio do outbox e grava em pequenos commits incrementais."""
+
+    def __init__(self, items_by_cod: Dict[Any, str], attempts_by_cod: Dict[Any, int]):
+        self.items_by_cod = items_by_cod
+        self.attempts_by_cod = attempts_by_cod
+        self._buffer: List[Dict[str, Any]] = []
+        self._last_flush = time.monotonic()
+
+    def mark_done(self, cod: Any, outcome: Optional[Dict[str, Any]] = None) -> None:
+        outcome = outcome or {}
+        ok = outcome.get("ok")
+        self._buffer.append({
+            "cod": cod,
+            "items": self.items_by_cod[cod],
+            "status": outbox.STATUS_SENT if ok else outbox.STATUS_FAILED,
+            "http_status": outcome.get("status"),
+            "error": outcome.get("error"),
+            "retry_in": None if ok else outbox.retry_delay(self.attempts_by_cod[cod], bool(outcome.get("transient"))),
+        })
+        elapsed = time.monotonic() - self._last_flush
+        if len(self._buffer) >= config.CHECKPOINT_EVERY_GROUPS or elapsed >= config.CHECKPOINT_EVERY_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        buffer, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if buffer:
+            outbox.mark_results(buffer)
+
+
+def _send_retry(entry: retryq.RetryEntry, sess_http: Optional[bemsoft_api.Session],
+                pipeline: Optional[pipelines.Pipeline] = None) -> Dict[str, Any]:
+    """Retentativa de uma solicitação da fila (sem gravar falha: ela já está no armazenamento)."""
+    pipeline = pipeline or configure()
+    if not pipeline.breaker.allow():
+        return {"skipped": True}
+    pipeline.throttle()
+    g = entry.group
+    event = _group_event(g)
+    try:
+        result = bemsoft_api.send_to_bemsoft(event, session=sess_http, print_payload=True)
+    except Exception as e:
+        return {"ok": False, "status": None, "error": str(e), "event": event,
+                "transient": retryq.is_transient(None, e)}
+    ok = bool(result.get("ok"))
+    status = result.get("status")
+    return {"ok": ok, "status": status, "error": result.get("error"), "event": event,
+            "transient": not ok and retryq.is_transient(status)}
+
+
+def _finish_retry(entry: retryq.RetryEntry, outcome: Dict[str, Any],
+                  pipeline: Optional[pipelines.Pipeline] = None) -> None:
+    pipeline = pipeline or configure()
+    retry_queue, breaker = pipeline.retry_queue, pipeline.breaker
+    cod = entry.cod
+    if outcome.get("skipped"):
+        retry_queue.defer(entry, breaker.opened_until)
+        return
+    status = outcome.get("status")
+    metrics.SEND_STATUS.inc(status=metrics.status_label(status))
+    if outcome.get("ok"):
+        breaker.record_success()
+        retry_queue.done(entry)
+        discard_failed(entry.handle)
+        metrics.RETRIES.inc(result="ok")
+        log.info("solicitação %s entregue na retentativa %d (status=%s)", cod, entry.attempts, status)
+        return
+    if outcome.get("transient"):
+        breaker.record_failure()
+        if retry_queue.retry_later(entry, error=outcome.get("error")):
+            metrics.RETRIES.inc(result="retry")
+            log.warning(
+                "solicitação %s: retentativa falhou (status=%s), próxima %d/%d em ~%.0fs",
+                cod, status, entry.attempts, retry_queue.max_attempts, entry.next_at - time.monotonic(),
+            )
+        else:
+            metrics.RETRIES.inc(result="gave_up")
+            log.error("solicitação %s: desistindo após %d tentativa(s); permanece no armazenamento de falhas",
+                      cod, entry.attempts)
+        return
+    # Erro permanente (400/401...): substitui a falha gravada pelo motivo atual
+    breaker.record_success()
+    retry_queue.done(entry)
+    metrics.RETRIES.inc(result="failed")
+    log.error("solicitação %s erro permanente na retentativa (status=%s): %s", cod, status, outcome.get("error"))
+    reason = f"HTTP {status}: {outcome.get('error')}" if status else str(outcome.get("error"))
+    persist_failed(outcome["event"], reason=reason)
+    discard_failed(entry.handle)
+
+
+def _drain_retry_queue(sess_http: Optional[bemsoft_api.Session], pipeline: Optional[pipelines.Pipeline] = None) -> int:
+    """Reenvia as solicitações da fila de retentativas cujo horário já venceu."""
+    pipeline = pipeline or configure()
+    if pipeline.breaker.is_open():
+        return 0
+    due = pipeline.retry_queue.pop_due()
+    if not due:
+        return 0
+    log.info("retentando %d solicitação(ões) (fila: %d)", len(due), len(pipeline.retry_queue))
+    workers = min(pipeline.max_workers, len(due))
+    if workers <= 1:
+        for entry in due:
+            _finish_retry(entry, _send_retry(entry, sess_http, pipeline), pipeline)
+        return len(due)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bemsoft-retry") as pool:
+        futures = {pool.submit(_send_retry, entry, sess_http, pipeline): entry for entry in due}
+        for fut in as_completed(futures):
+            entry = futures[fut]
+            try:
+                outcome = fut.result()
+            except Exception as e:
+                outcome = {"ok": False, "status": None, "error": str(e), "transient": True}
+                log.exception("retentativa da solicitação %s falhou: %s", entry.cod, e)
+            _finish_retry(entry, outcome, pipeline)
+    return len(due)
 
+
+_OUTBOX_LAST_PURGE = 0.0
+
+
+def _poll_outbox(sess_http: Optional[bemsoft_api.Session]) -> int:
+    """
+    Modo outbox: ingere a próxima página no dbo._MonitorOutbox (junto com LastItemId) e
+    envia as solicitações cuja janela de debounce venceu, selecionadas em uma única consulta.
+    """
+    global _OUTBOX_LAST_PURGE
+    poll_start = datetime.now()
+
+    query_start = datetime.now()
+    last, count, new_last = outbox.ingest_page(config.TERCEIROS, config.FETCH_PAGE_SIZE)
+    query_end = datetime.now()
+    query_duration = (query_end - query_start).total_seconds()
+    metrics.FETCH_SECONDS.observe(query_duration)
+
+    LAG_METRICS["page_rows"] = count
+    metrics.ITEMS_FETCHED.inc(count)
+    LAG_METRICS["advanced"] = new_last > last
+    LAG_METRICS["last_id"] = new_last
+
+    if count:
+        log.info("encontrados %d itens em %.2fs (outbox, last_id=%s)", count, query_duration, new_last)
+
+    if time.monotonic() - _OUTBOX_LAST_PURGE >= 3600:
+        _OUTBOX_LAST_PURGE = time.monotonic()
+        purged = outbox.purge()
+        if purged:
+            log.info("outbox: %d solicitação(ões) enviadas removidas (retenção %dd)", purged, config.OUTBOX_RETENTION_DAYS)
+
+    if configure().breaker.is_open():
+        log.debug("circuito aberto: envio do outbox pausado")
+        return new_last
+
+    ready = outbox.load_ready(config.TERCEIROS, config.FETCH_PAGE_SIZE, config.DEBOUNCE_SECONDS)
+    if not ready:
+        if count and config.DEBOUNCE_SECONDS > 0:
+            log.info(
+                "debounce: aguardando %d solicitação(ões) no outbox (janela %ds).",
+                outbox.pending_count(), config.DEBOUNCE_SECONDS,
+            )
         return new_last
 
+    ready_groups: List[Tuple[Any, Dict[str, Any]]] = []
+    items_by_cod: Dict[Any, str] = {}
+    attempts_by_cod: Dict[Any, int] = {}
+    missing: List[Dict[str, Any]] = []
+    for cod, item_ids, revision, attempts, rows in ready:
+        if not rows:
+            missing.append({"cod": cod, "items": item_ids, "status": outbox.STATUS_FAILED,
+                            "error": "itens não encontrados no ItemSol"})
+            continue
+        items_by_cod[cod] = item_ids
+        attempts_by_cod[cod] = attempts
+        ready_groups.append((cod, {"head": rows[0], "items": rows, "outbox_items": item_ids,
+                                   "outbox_attempts": attempts, "revisao": revision}))
+    if missing:
+        outbox.mark_results(missing)
+
+    tracker = _OutboxTracker(items_by_cod, attempts_by_cod)
+    done: Set[Any] = set()
+    try:
+        done = _dispatch_groups(ready_groups, sess_http, on_done=tracker.mark_done)
+    finally:
+        tracker.flush()
+        # Não enviadas (circuito aberto, erro no meio do ciclo): outro ciclo ou monitor as pega já
+        outbox.release(cod for cod in items_by_cod if cod not in done)
+
+    poll_end = datetime.now()
+    poll_duration = (poll_end - poll_start).total_seconds()
+    log.info("ciclo concluído em %.2fs", poll_duration)
+    return new_last
+
+
+def poll_once(sess_http: Optional[bemsoft_api.Session], source: Any = None,
+              pipeline: Optional[pipelines.Pipeline] = None) -> int:
+    """
+    Lê last_id, busca novos itens, debounce, agrupa por solicitação e envia 1 payload por grupo.
+    Pipeline em transações curtas: reivindica a página (lock só durante a leitura), envia sem
+    conexão aberta e grava o checkpoint em commits incrementais.
+    Com OUTBOX_ENABLED=1 o envio é dirigido pelo outbox durável (ver _poll_outbox).
+    `source` é uma partição do sharding (padrão: a origem do pipeline, checkpoint único);
+    `pipeline` é o pipeline de um laboratório (padrão: PIPELINE, todos os TERCEIROS).
+    """
+    if config.OUTBOX_ENABLED:
+        return _poll_outbox(sess_http)
+
+    pipeline = pipeline or configure()
+    lag = pipeline.lag
+    if pipeline.breaker.is_open():
+        # Sem reivindicar página: o checkpoint fica parado até a API voltar
+        log.debug("circuito aberto: leitura/envio pausados (%s)", pipeline.name)
+        lag["page_rows"] = 0
+        lag["advanced"] = False
+        return lag["last_id"]
+
+    poll_start = datetime.now()
+
+    query_start = datetime.now()
+    # Leitura em streaming já agrupada por solicitação; os itens ficam como as linhas lidas
+    # (ItemRow), normalizadas só na montagem do payload (build_order)
+    pending = pipeline.pending if source is None else source.pending
+    source = source or pipeline.source
+    last, row_count, groups = source.claim_groups(pipeline.terceiros, config.FETCH_PAGE_SIZE)
+    query_end = datetime.now()
+    query_duration = (query_end - query_start).total_seconds()
+    metrics.FETCH_SECONDS.observe(query_duration)
+
+    lag["page_rows"] = row_count
+    metrics.ITEMS_FETCHED.inc(row_count)
+    lag["advanced"] = False
+    lag["last_id"] = last
+
+    if not row_count:
+        return last
+
+    log.info("encontrados %d itens (%d solicitação(ões)) em %.2fs", row_count, len(groups), query_duration)
+
+    now_ts = time.time()
+    ready_groups: List[Tuple[Any, Dict[str, Any]]] = []
+    pending_count = 0
+
+    if config.DEBOUNCE_SECONDS > 0:
+        stale = [k for k in list(pending.keys()) if k not in groups]
+        for key in stale:
+            pending.pop(key, None)
+
+    for cod, g in groups.items():
+        if config.DEBOUNCE_SECONDS > 0:
+            first_seen = pending.setdefault(cod, now_ts)
+            wait_remaining = config.DEBOUNCE_SECONDS - (now_ts - first_seen)
+            if wait_remaining > 0:
+                pending_count += 1
+                if first_seen == now_ts or wait_remaining <= config.POLL_SECONDS:
+                    seconds_left = int(wait_remaining)
+                    if seconds_left < 1:
+                        seconds_left = 1
+                    log.debug("debounce: solicitação %s aguardando %ds antes do envio.", cod, seconds_left)
+                continue
+        ready_groups.append((cod, g))
+
+    if not ready_groups:
+        if pending_count:
+            log.info(
+                "debounce: aguardando %d solicitação(ões) na fila (janela %ds).",
+                pending_count, config.DEBOUNCE_SECONDS,
+            )
+        return last
 
-def main():
-    print("Monitor ItemSol -> Bemsoft iniciado.")
+    checkpoint = _CheckpointTracker(last, ready_groups, source)
+    try:
+        done = _dispatch_groups(ready_groups, sess_http, on_done=checkpoint.mark_done, pipeline=pipeline)
+    finally:
+        # Grava o que já foi concluído mesmo se o ciclo for interrompido
+        new_last = checkpoint.flush()
+    for cod in done:
+        pending.pop(cod, None)
+    lag["advanced"] = new_last > last
+    lag["last_id"] = new_last
+
+    poll_end = datetime.now()
+    poll_duration = (poll_end - poll_start).total_seconds()
+    log.info("ciclo concluído em %.2fs", poll_duration)
+
+    return new_last
+
+
+def _failed_backlog_size() -> int:
+    """Quantidade de arquivos aguardando reprocessamento em FAILED_DIR."""
+    if config.FAILED_STORE == "log":
+        return len(failstore.get_store())
+    with os.scandir(config.FAILED_DIR) as it:
+        return sum(1 for entry in it if entry.is_file() and entry.name.endswith(".json"))
+
+
+def _debounce_size() -> int:
+    return (
+        len(PENDING_SOLICITACOES)
+        + (sum(len(p.pending) for p in SHARDS.partitions) if SHARDS else 0)
+        + sum(len(p.pending) for p in LAB_PIPELINES)
+    )
+
+
+def _breaker_state() -> int:
+    """Estado do breaker exportado em /metrics: com pipelines por laboratório, o pior deles."""
+    return max([BREAKER.state_value()] + [p.breaker.state_value() for p in LAB_PIPELINES])
+
+
+def update_lag_metrics(sources: Optional[List[Any]] = None, pipeline: Optional[pipelines.Pipeline] = None) -> None:
+    """
+    Mede o atraso atual (em itens e em segundos) em relação ao checkpoint. Com sharding,
+    `sources` são as partições deste worker: vale a mais atrasada (menor checkpoint,
+    maior distância e item pendente mais antigo). Com pipelines por laboratório, o atraso
+    de cada um vai para as métricas com label `lab` e as globais ficam com o pior deles.
+    """
+    pipeline = pipeline or configure()
+    lag = pipeline.lag
+    if sources is None:
+        sources, lasts = [pipeline.source], [lag["last_id"]]
+    else:
+        lasts = [s.last for s in sources]
+    max_id, lag_items, oldest = 0, 0, None
+    if sources:
+        with database.get_engine().connect() as conn:
+            for source, source_last in zip(sources, lasts):
+                source_max, source_oldest = source.fetch_lag(conn, source_last, pipeline.terceiros)
+                source_max = int(source_max or 0)
+                max_id = max(max_id, source_max)
+                lag_items = max(lag_items, source_max - source_last)
+                if source_oldest is not None and (oldest is None or source_oldest < oldest):
+                    oldest = source_oldest
+    last = min(lasts) if lasts else lag["last_id"]
+    lag["last_id"] = last
+    lag["max_item_id"] = max_id
+    lag["lag_items"] = lag_items
+    lag_seconds = 0.0
+    if isinstance(oldest, datetime):
+        lag_seconds = max(0.0, (datetime.now() - oldest).total_seconds())
+    elif isinstance(oldest, date):
+        lag_seconds = max(0.0, (datetime.now() - datetime.combine(oldest, dt_time())).total_seconds())
+    lag["lag_seconds"] = lag_seconds
+    lag["sheets_snapshot_age"] = sheets_client.get_snapshot_age()
+    if pipeline is not PIPELINE:
+        metrics.LAB_CHECKPOINT.set(last, lab=pipeline.name)
+        metrics.LAB_LAG_ITEMS.set(lag_items, lab=pipeline.name)
+        metrics.LAB_LAG_SECONDS.set(lag_seconds, lab=pipeline.name)
+        metrics.LAB_BREAKER_STATE.set(pipeline.breaker.state_value(), lab=pipeline.name)
+        lags = [p.lag for p in LAB_PIPELINES]
+        last = min(m["last_id"] for m in lags)
+        lag_items = max(m["lag_items"] for m in lags)
+        lag_seconds = max(m["lag_seconds"] for m in lags)
+    metrics.CHECKPOINT.set(last)
+    metrics.LAG_ITEMS.set(lag_items)
+    metrics.LAG_SECONDS.set(lag_seconds)
+    if config.OUTBOX_ENABLED:
+        metrics.DEBOUNCE_QUEUE.set(outbox.pending_count())
+
+
+def run_cycle(sess_http: Optional[bemsoft_api.Session], pipeline: Optional[pipelines.Pipeline] = None) -> bool:
+    """
+    Ciclo em modo catch-up: repete poll_once (keyset em CodItemSol) enquanto as páginas
+    voltarem cheias e o checkpoint avançar, até CATCHUP_MAX_PAGES páginas (por partição,
+    com sharding). `pipeline` é o de um laboratório (LAB_PIPELINES=1); padrão: PIPELINE.
+    Retorna True se o monitor continua atrasado (o próximo ciclo começa sem sleep).
+    """
+    pipeline = pipeline or configure()
+    lag = pipeline.lag
+    if len(pipeline.retry_queue):
+        try:
+            _drain_retry_queue(sess_http, pipeline)
+        except Exception as e:
+            log.exception("falha ao processar a fila de retentativas: %s", e)
+
+    # Com sharding, o catch-up alterna uma página por partição deste worker e rebalanceia as
+    # leases a cada rodada (um worker que entrou recebe sua cota sem esperar o ciclo acabar)
+    shards = SHARDS if pipeline is PIPELINE else None
+    sources = shards.rebalance() if shards else [None]
+    active = list(sources)
+    pages = 0
+    for rounds in range(1, config.CATCHUP_MAX_PAGES + 1):
+        still_behind = []
+        for source in active:
+            pages += 1
+            poll_once(sess_http, source, pipeline)
+            if lag["page_rows"] >= config.FETCH_PAGE_SIZE and lag["advanced"]:
+                still_behind.append(source)
+        active = still_behind
+        if active and shards and rounds < config.CATCHUP_MAX_PAGES:
+            sources = shards.rebalance()
+            active = [s for s in active if s in sources]
+        if not active:
+            break
+    behind = bool(active)
+
+    try:
+        update_lag_metrics(sources if shards else None, pipeline)
+    except Exception as e:
+        log.warning("falha ao medir atraso: %s", e)
+    else:
+        if behind or lag["lag_items"]:
+            log.info(
+                "%slag: last_id=%s max_id=%s atraso=%s item(ns) / %.0fs (páginas neste ciclo: %d)",
+                "" if pipeline is PIPELINE else f"[{pipeline.name}] ",
+                lag["last_id"], lag["max_item_id"], lag["lag_items"], lag["lag_seconds"], pages,
+                extra={"fields": {
+                    "lag_items": lag["lag_items"],
+                    "lag_seconds": lag["lag_seconds"],
+                    "pages": pages,
+                    **({} if pipeline is PIPELINE else {"lab": pipeline.name}),
+                }},
+            )
+    return behind
+
+
+def _run_lab(sess_http: Optional[bemsoft_api.Session], pipeline: pipelines.LabPipeline,
+             stop: threading.Event) -> None:
+    """Laço de um pipeline de laboratório (thread própria): uma falha não derruba os demais."""
+    while not stop.is_set():
+        behind = False
+        try:
+            behind = run_cycle(sess_http, pipeline)
+        except Exception as e:
+            log.exception("ciclo do laboratório %s falhou: %s", pipeline.lab, e)
+        stop.wait(0 if behind else config.POLL_SECONDS)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Monitor ItemSol -> Bemsoft.")
+    p.add_argument("--check", action="store_true",
+                   help="valida a configuração e a conectividade (banco, Bemsoft, Sheets, FAILED_DIR) e sai")
+    return p.parse_args(argv)
+
+
+def check() -> int:
+    """Modo --check: roda o preflight, imprime uma linha por etapa e o tempo de startup."""
+    results = preflight.run()
+    ok = preflight.report(results)
+    print(f"imports em {(_IMPORTS_DONE - _PROCESS_START) * 1000:.0f} ms; "
+          f"total {(time.perf_counter() - _PROCESS_START) * 1000:.0f} ms")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.check:
+        return check()
+
+    settings = config.get_settings()
+    # Valor inválido no .env (SOURCE_DRIVER, FAILED_STORE...) para aqui, em vez de cair no padrão
+    problems = settings.validate()
+    if problems:
+        for problem in problems:
+            log.error("configuração inválida: %s", problem)
+        return 1
+    configure()
+    log.info("Monitor ItemSol -> Bemsoft iniciado.")
+    if settings.ENV_FILES:
+        log.info("Carregado .env de: %s", ", ".join(settings.ENV_FILES))
+    else:
+        log.warning("Arquivo .env não encontrado em: %s (copie o .env para o mesmo diretório do executável)", config.env_path)
     filtro = ", ".join(config.TERCEIROS) if config.TERCEIROS else "<sem filtro>"
-    print(
-        f"Filtro TERCEIROS='{filtro}' | Poll={config.POLL_SECONDS}s | "
-        f"Debounce={config.DEBOUNCE_SECONDS}s | DRY_RUN={config.DRY_RUN}"
+    log.info(
+        "Filtro TERCEIROS='%s' | Poll=%ss | Debounce=%ss | Workers=%s | "
+        "Página=%s (catch-up até %s) | Outbox=%s | Fonte=%s | Sharding=%s | Pipelines=%s | JSON=%s | DRY_RUN=%s",
+        filtro, config.POLL_SECONDS, config.DEBOUNCE_SECONDS, config.MAX_WORKERS,
+        config.FETCH_PAGE_SIZE, config.CATCHUP_MAX_PAGES, config.OUTBOX_ENABLED,
+        "changetracking" if SOURCE is change_tracking else "watermark",
+        SHARDS.describe() if SHARDS else "off",
+        f"{len(LAB_PIPELINES)} laboratório(s)" if LAB_PIPELINES else "off", jsoncodec.backend(), config.DRY_RUN,
     )
-    if not config.DRY_RUN and not config.TOKEN:
-        print(
-            "[warn] BEMSOFT_TOKEN ausente. Ative DRY_RUN=1 ou configure o token."
-        )
+    os.makedirs(config.FAILED_DIR, exist_ok=True)
+    # Endpoint /metrics opcional (METRICS_PORT > 0)
+    metrics.FAILED_BACKLOG.set_function(_failed_backlog_size)
+    metrics.SHEETS_AGE.set_function(sheets_client.get_snapshot_age)
+    metrics.RETRY_QUEUE_SIZE.set_function(lambda: len(RETRY_QUEUE) + sum(len(p.retry_queue) for p in LAB_PIPELINES))
+    metrics.BREAKER_STATE.set_function(_breaker_state)
+    if not config.OUTBOX_ENABLED:
+        metrics.DEBOUNCE_QUEUE.set_function(_debounce_size)
+    metrics.start_server(config.METRICS_PORT, config.METRICS_ADDR)
+
     # Bootstrap estado
-    database.bootstrap_state()
+    if config.SOURCE_DRIVER == "changetracking" and config.OUTBOX_ENABLED:
+        log.warning("SOURCE_DRIVER=changetracking é ignorado com OUTBOX_ENABLED=1 (outbox lê por CodItemSol)")
+    SOURCE.bootstrap_state()
+    if SOURCE is database and SHARDS is None and not LAB_PIPELINES:
+        pipelines.warn_if_downgraded()
+    for pipeline in LAB_PIPELINES:
+        pipeline.bootstrap_state()
+        log.info("pipeline %s", pipeline.describe())
+    if SHARDS:
+        SHARDS.start()
+    if config.OUTBOX_ENABLED:
+        outbox.bootstrap()
+    # Índice de cobertura da leitura (opcional): verifica/cria e loga o plano real
+    if config.ITEMSOL_INDEX_BOOTSTRAP in ("check", "create"):
+        try:
+            index_advisor.bootstrap(create=config.ITEMSOL_INDEX_BOOTSTRAP == "create")
+        except Exception as e:
+            log.warning("falha ao verificar o índice do ItemSol: %s", e)
     # Sessão HTTP única (reuso/keep-alive)
     sess_http = bemsoft_api._build_session() if not config.DRY_RUN else None
 
+    startup = time.perf_counter() - _PROCESS_START
+    metrics.STARTUP_SECONDS.set(startup)
+    log.info("startup em %.0f ms (imports %.0f ms)", startup * 1000, (_IMPORTS_DONE - _PROCESS_START) * 1000)
+
+    stop = threading.Event()
+    lab_threads = [
+        threading.Thread(target=_run_lab, args=(sess_http, p, stop), name=f"lab-{p.slug}", daemon=True)
+        for p in LAB_PIPELINES
+    ]
     try:
+        for t in lab_threads:
+            t.start()
         while True:
+            if lab_threads:
+                # Pipelines por laboratório: os ciclos rodam nas threads; aqui só aguarda o Ctrl+C
+                time.sleep(1)
+                continue
+            behind = False
             try:
-                poll_once(sess_http)
+                behind = run_cycle(sess_http)
             except Exception as e:
-                print(f"[ERRO] ciclo falhou: {e}")
-            time.sleep(config.POLL_SECONDS)
+                log.exception("ciclo falhou: %s", e)
+            # Sleep adaptativo: zero enquanto atrasado, POLL_SECONDS quando em dia
+            time.sleep(0 if behind else config.POLL_SECONDS)
     except KeyboardInterrupt:
-        print("\nEncerrado pelo usuário.")
+        log.info("encerrado pelo usuário.")
+    finally:
+        stop.set()
+        for t in lab_threads:
+            t.join(timeout=config.POLL_SECONDS + 5)
+        if SHARDS:
+            SHARDS.stop()
+        if config.FAILED_STORE == "log":
+            failstore.get_store().close()
+        if config.HTTP_TRANSPORT == "async":
+            async_http.close_transport()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,427 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import bemsoft_api
+import failstore
+from filelock import FileLock
+
+log = applog.get_logger("retry")
+
+JOURNAL_NAME = ".retry_journal.jsonl"
+RETRY_LOCK_NAME = ".retry.lock"
+
+# Resultados terminais no journal: o arquivo não é reprocessado em execuções seguintes
+TERMINAL = {"ok", "superseded"}
+
+
+# =========================
+# Journal de progresso
+# =========================
+class Journal:
+    """
+    Journal append-only (JSON-lines) em <dir>/.retry_journal.jsonl com o resultado
+    de cada arquivo. Permite retomar uma execução interrompida e saber qual foi o
+    último envio bem-sucedido de cada solicitação. No fim de cada execução é
+    compactado (compact), para não crescer com arquivos que já saíram do diretório.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Entradas no arquivo (decide se a compactação vale a reescrita)
+        self.lines = 0
+        self.by_file: Dict[str, Dict[str, Any]] = {}
+        # cod -> [(timestamp do arquivo, CodItemSol enviados)] dos envios ok (None: journal antigo, sem itens)
+        self.ok_sends: Dict[str, List[Tuple[str, Optional[Set[str]]]]] = {}
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # linha truncada por um crash: ignora
+                    self._apply(entry)
+                    self.lines += 1
+
+    def _apply(self, entry: Dict[str, Any]):
+        self.by_file[entry["file"]] = entry
+        if entry.get("result") == "ok" and entry.get("cod") is not None:
+            items = entry.get("items")
+            self.ok_sends.setdefault(str(entry["cod"]), []).append(
+                (entry.get("ts", ""), set(items) if items is not None else None)
+            )
+
+    def sent_later(self, cod: str, ts: str) -> bool:
+        """Se houve envio ok da solicitação com falha posterior a `ts` (candidato a superar o arquivo)."""
+        return any(ok_ts > ts for ok_ts, _ in self.ok_sends.get(cod, ()))
+
+    def covers(self, cod: str, ts: str, items: Set[str]) -> bool:
+        """Se um envio ok posterior a `ts` levou todos os `items` (CodItemSol)."""
+        return any(
+            ok_ts > ts and ok_items is not None and items <= ok_items
+            for ok_ts, ok_items in self.ok_sends.get(cod, ())
+        )
+
+    def is_done(self, name: str) -> bool:
+        entry = self.by_file.get(name)
+        return bool(entry and entry.get("result") in TERMINAL)
+
+    def record(self, name: str, cod: Any, ts: str, result: str, **extra: Any):
+        entry = {"file": name, "cod": cod, "ts": ts, "result": result,
+                 "at": datetime.now().isoformat(timespec="seconds")}
+        entry.update(extra)
+        self._apply(entry)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.lines += 1
+
+    def compact(self, present: Set[str]) -> int:
+        """
+        Reescreve o journal só com o que ainda decide algo: a última entrada de cada arquivo
+        ainda no diretório (`present`, nomes) e os envios ok de chaves que ainda têm arquivo
+        lá (podem superar uma falha mais antiga). Entradas de arquivos que já saíram
+        (movidos por --move-ok ou removidos) são descartadas. Retorna quantas saíram.
+        """
+        cods = {_file_cod(name) for name in present}
+        keep = [
+            entry for name, entry in self.by_file.items()
+            if name in present or (entry.get("result") == "ok" and str(entry.get("cod")) in cods)
+        ]
+        dropped = self.lines - len(keep)
+        if dropped <= 0:
+            return 0
+        # Reescrita atômica: um crash no meio deixa o journal anterior intacto
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in keep:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.by_file, self.ok_sends = {}, {}
+        for entry in keep:
+            self._apply(entry)
+        self.lines = len(keep)
+        return dropped
+
+
+# =========================
+# Seleção de arquivos
+# =========================
+def _file_ts(name: str, path: str) -> str:
+    """Timestamp do arquivo de falha (prefixo YYYYmmddTHHMMSSffffff do nome, ou mtime)."""
+    prefix = name.split("_", 1)[0]
+    if len(prefix) >= 15 and prefix[8:9] == "T" and prefix[:8].isdigit():
+        return prefix
+    return datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y%m%dT%H%M%S%f")
+
+
+def _file_cod(name: str) -> str:
+    """Chave da falha no nome do arquivo (<ts>_<chave>.json): solicitação, revisão e laboratório."""
+    base = name[:-5] if name.endswith(".json") else name
+    return base.split("_", 1)[1] if "_" in base else base
+
+
+def _file_items(path: str) -> Optional[Set[str]]:
+    """CodItemSol do evento gravado no arquivo (None se o arquivo não puder ser lido)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return failstore.item_ids(json.load(f).get("event") or {})
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def plan(paths: List[str], journal: Journal) -> Tuple[List[Tuple[str, str, str, List[str]]], List[Tuple[str, str, str]]]:
+    """
+    Decide o que reenviar. Retorna (a_enviar, superados): a_enviar como (path, cod, ts,
+    anteriores) e superados como (path, cod, ts).
+    Os arquivos são agrupados pela chave da falha (a mesma order: solicitação, revisão e
+    laboratório). Um arquivo só é superado por uma falha mais nova da mesma chave (ou por um envio
+    bem-sucedido posterior registrado no journal) que contenha todos os seus CodItemSol.
+    Falhas mais antigas com itens que a mais nova não tem (itens chegados em ciclos
+    diferentes) vão em `anteriores`: seus itens seguem no reenvio da mais nova, em um único
+    POST (dois envios com a mesma Idempotency-Key fariam o segundo voltar 409).
+    """
+    by_cod: Dict[str, List[Tuple[str, str, str]]] = {}
+    for path in paths:
+        name = os.path.basename(path)
+        if journal.is_done(name):
+            continue
+        cod = _file_cod(name)
+        by_cod.setdefault(cod, []).append((path, cod, _file_ts(name, path)))
+
+    items: Dict[str, Optional[Set[str]]] = {}
+
+    def items_of(path: str) -> Optional[Set[str]]:
+        if path not in items:
+            items[path] = _file_items(path)
+        return items[path]
+
+    to_send: List[Tuple[str, str, str, List[str]]] = []
+    superseded: List[Tuple[str, str, str]] = []
+    for cod, files in by_cod.items():
+        files.sort(key=lambda f: (f[2], f[0]))
+        chain: List[Tuple[str, str, str]] = []
+        for path, _, ts in files:
+            if journal.sent_later(cod, ts):
+                ids = items_of(path)
+                if ids is not None and journal.covers(cod, ts, ids):
+                    superseded.append((path, cod, ts))
+                    continue
+            if len(files) > 1 and items_of(path) is None:
+                to_send.append((path, cod, ts, []))  # ilegível: vai sozinho e falha no envio
+                continue
+            chain.append((path, cod, ts))
+        if not chain:
+            continue
+        newest = chain[-1]
+        older: List[str] = []
+        for path, _, ts in chain[:-1]:
+            if items_of(path) <= items_of(newest[0]):  # type: ignore[operator]
+                superseded.append((path, cod, ts))
+            else:
+                older.append(path)
+        to_send.append(newest + (older,))
+    to_send.sort(key=lambda x: x[2])
+    return to_send, superseded
+
+
+def _failure_names(base_dir: str) -> List[str]:
+    """Arquivos de falha (<ts>_<chave>.json) no diretório."""
+    return [n for n in os.listdir(base_dir) if n.endswith(".json") and not n.startswith(".")]
+
+
+def _move(path: str, dest_dir: Optional[str]):
+    if not dest_dir:
+        return
+    os.makedirs(dest_dir, exist_ok=True)
+    shutil.move(path, os.path.join(dest_dir, os.path.basename(path)))
+
+
+def _send_file(path: str, session, verbose: bool, older: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Reenvia o evento do arquivo acrescido dos itens das falhas `older` (mesma solicitação)."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    event = data.get("event") or {}
+    for older_path in older or []:
+        with open(older_path, "r", encoding="utf-8") as f:
+            event = failstore.merge_events(json.load(f).get("event") or {}, event)
+    result = bemsoft_api.send_to_bemsoft(event, session=session, print_payload=verbose)
+    result["items"] = sorted(failstore.item_ids(event))
+    return result
+
+
+def _send_record(store: failstore.FailureLog, cod: str, session, verbose: bool) -> Dict[str, Any]:
+    rec = store.read(cod)
+    if rec is None:
+        return {"ok": True, "status": None, "skipped": True}
+    result = bemsoft_api.send_to_bemsoft(rec.get("event") or {}, session=session, print_payload=verbose)
+    result["ts"] = rec["ts"]
+    return result
+
+
+def run_log(args) -> int:
+    """Reprocessa o log de falhas (FAILED_STORE=log): cada solicitação aparece uma única vez."""
+    store = failstore.FailureLog(args.dir or config.FAILED_LOG_DIR)
+    instance_lock = FileLock(os.path.join(store.dir, RETRY_LOCK_NAME))
+    if not instance_lock.acquire(blocking=False):
+        log.error("outro retry_failed.py já está processando %s", store.dir)
+        return 2
+
+    try:
+        pending = store.pending()
+        if args.limit:
+            pending = pending[:args.limit]
+        if not pending:
+            log.info("nada a reprocessar em %s", store.dir)
+            return 0
+
+        mode = "ENVIO" if args.send else "DRY_RUN"
+        log.info("reprocessando %d solicitação(ões) de %s com %d worker(s) [%s]", len(pending), store.dir, args.workers, mode)
+        session = bemsoft_api._build_session() if not config.DRY_RUN else None
+
+        ok_count = fail_count = 0
+        with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="retry") as pool:
+            futures = {pool.submit(_send_record, store, item["cod"], session, args.verbose): item for item in pending}
+            for fut in as_completed(futures):
+                cod = futures[fut]["cod"]
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    fail_count += 1
+                    log.error("cod=%s: exceção ao reenviar: %s", cod, e)
+                    continue
+                if result.get("skipped"):
+                    continue
+                if result.get("ok"):
+                    ok_count += 1
+                    # Só resolve a versão enviada: uma falha mais nova gravada no meio continua aberta
+                    if args.send and store.resolve(cod, result["ts"]):
+                        log.info("cod=%s: reenviado (status=%s)", cod, result.get("status"))
+                    elif not args.send:
+                        log.info("cod=%s: payload válido (dry-run, não enviado)", cod)
+                else:
+                    fail_count += 1
+                    log.warning("cod=%s: falhou novamente (status=%s): %s", cod, result.get("status"), result.get("error"))
+
+        log.info("concluído: %d ok, %d falha(s)", ok_count, fail_count)
+        return 0 if fail_count == 0 else 1
+    finally:
+        # Grava o índice também quando não havia nada a reprocessar ou o envio foi interrompido
+        store.close()
+        instance_lock.release()
+
+
+def run(args) -> int:
+    if args.source == "log":
+        return run_log(args)
+    base_dir = args.dir or config.FAILED_DIR
+    os.makedirs(base_dir, exist_ok=True)
+
+    # Apenas um reprocessador por diretório
+    instance_lock = FileLock(os.path.join(base_dir, RETRY_LOCK_NAME))
+    if not instance_lock.acquire(blocking=False):
+        log.error("outro retry_failed.py já está processando %s", base_dir)
+        return 2
+
+    journal = None
+    try:
+        journal = Journal(os.path.join(base_dir, JOURNAL_NAME))
+        if args.file:
+            paths = [args.file]
+        else:
+            paths = [os.path.join(base_dir, n) for n in _failure_names(base_dir)]
+
+        to_send, superseded = plan(paths, journal)
+        failed_lock = os.path.join(base_dir, config.FAILED_LOCK_NAME)
+
+        for path, cod, ts in superseded:
+            with FileLock(failed_lock):
+                journal.record(os.path.basename(path), cod, ts, "superseded")
+                if os.path.exists(path):
+                    _move(path, args.move_ok)
+        if superseded:
+            log.info("%d arquivo(s) superado(s) por falha mais nova ou envio posterior", len(superseded))
+
+        if args.limit:
+            to_send = to_send[:args.limit]
+        if not to_send:
+            log.info("nada a reprocessar em %s", base_dir)
+            return 0
+
+        mode = "ENVIO" if args.send else "DRY_RUN"
+        log.info("reprocessando %d arquivo(s) de %s com %d worker(s) [%s]", len(to_send), base_dir, args.workers, mode)
+        session = bemsoft_api._build_session() if not config.DRY_RUN else None
+
+        ok_count = fail_count = 0
+        with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="retry") as pool:
+            futures = {
+                pool.submit(_send_file, path, session, args.verbose, older): (path, cod, ts, older)
+                for path, cod, ts, older in to_send
+            }
+            for fut in as_completed(futures):
+                path, cod, ts, older = futures[fut]
+                name = os.path.basename(path)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    fail_count += 1
+                    journal.record(name, cod, ts, "error", error=str(e))
+                    log.error("%s: exceção ao reenviar: %s", name, e)
+                    continue
+
+                status = result.get("status")
+                if result.get("ok") and args.send:
+                    ok_count += 1
+                    with FileLock(failed_lock):
+                        journal.record(name, cod, ts, "ok", status=status, items=result.get("items"))
+                        _move(path, args.move_ok)
+                        # Falhas anteriores cujos itens foram junto neste envio
+                        for older_path in older:
+                            older_name = os.path.basename(older_path)
+                            journal.record(older_name, cod, _file_ts(older_name, older_path), "ok",
+                                           status=status, items=result.get("items"), merged_into=name)
+                            if os.path.exists(older_path):
+                                _move(older_path, args.move_ok)
+                    if older:
+                        log.info("%s: reenviado com os itens de %d falha(s) anterior(es) (status=%s)",
+                                 name, len(older), status)
+                    else:
+                        log.info("%s: reenviado (status=%s)", name, status)
+                elif result.get("ok"):
+                    ok_count += 1
+                    log.info("%s: payload válido (dry-run, não enviado)", name)
+                else:
+                    fail_count += 1
+                    journal.record(name, cod, ts, "failed", status=status, error=result.get("error"))
+                    log.warning("%s: falhou novamente (status=%s): %s", name, status, result.get("error"))
+
+        log.info("concluído: %d ok, %d falha(s)", ok_count, fail_count)
+        return 0 if fail_count == 0 else 1
+    finally:
+        if journal is not None:
+            _compact_journal(journal, base_dir)
+        instance_lock.release()
+
+
+def _compact_journal(journal: Journal, base_dir: str):
+    try:
+        dropped = journal.compact(set(_failure_names(base_dir)))
+    except OSError as e:
+        log.warning("falha ao compactar o journal %s: %s", journal.path, e)
+        return
+    if dropped:
+        log.info("journal compactado: %d entrada(s) de arquivos já resolvidos removida(s)", dropped)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Reprocessa eventos salvos em FAILED_DIR.")
+    p.add_argument("--dir", help="diretório de falhas (padrão FAILED_DIR)")
+    p.add_argument("--file", help="reprocessa apenas este arquivo")
+    p.add_argument("--send", action="store_true", help="envia de fato (força BEMSOFT_DRY_RUN=0 neste processo)")
+    p.add_argument("--move-ok", dest="move_ok", help="move os arquivos enviados/superados para este diretório")
+    p.add_argument("--limit", type=int, default=0, help="processa no máximo N arquivos")
+    p.add_argument("--workers", type=int, default=config.MAX_WORKERS, help="envios em paralelo (padrão BEMSOFT_MAX_WORKERS)")
+    p.add_argument("--source", choices=("files", "log"), default=config.FAILED_STORE,
+                   help="origem das falhas: arquivos legados ou log de segmentos (padrão FAILED_STORE)")
+    p.add_argument("--verbose", action="store_true", help="loga payloads e respostas (DEBUG)")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.verbose:
+        os.environ["LOG_PAYLOAD_SAMPLE"] = "1"
+        applog.setup_logging(level="DEBUG", force=True)
+    # Sem --send nunca envia, independente do .env
+    config.DRY_RUN = not args.send
+    if args.file:
+        args.source = "files"
+    if args.file and not args.dir:
+        args.dir = os.path.dirname(os.path.abspath(args.file))
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
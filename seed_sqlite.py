@@ -0,0 +1,57 @@
+import sys
+import argparse
+from pathlib import Path
+
+# Detecta se está rodando como executável PyInstaller
+if not getattr(sys, 'frozen', False):
+    # Rodando em desenvolvimento - adiciona src/ ao path
+    ROOT_DIR = Path(__file__).resolve().parent
+    SRC_DIR = ROOT_DIR / "src"
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+import config
+import applog
+import synthetic
+
+log = applog.get_logger("seed")
+
+
+def _range(value: str):
+    lo, _, hi = value.partition("-")
+    lo_i = int(lo)
+    hi_i = int(hi) if hi else lo_i
+    if lo_i < 1 or hi_i < lo_i:
+        raise argparse.ArgumentTypeError("use N ou MIN-MAX (>= 1)")
+    return lo_i, hi_i
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Gera uma base SQLite sintética (ItemSol/solicitacao/paciente/texame) para DB_BACKEND=sqlite.")
+    p.add_argument("--path", default=config.SQLITE_PATH, help="arquivo SQLite (padrão SQLITE_PATH)")
+    p.add_argument("--solicitacoes", type=int, default=10000, help="solicitações a gerar (padrão 10000)")
+    p.add_argument("--items", type=_range, default=(1, 5), help="itens por solicitação, N ou MIN-MAX (padrão 1-5)")
+    p.add_argument("--exams", type=int, default=200, help="exames no texame (códigos EX0001..; padrão 200)")
+    p.add_argument("--terceiros", default=",".join(config.TERCEIROS),
+                   help="terceirizados dos itens, separados por vírgula (padrão TERCEIROS)")
+    p.add_argument("--foreign-ratio", dest="foreign_ratio", type=float, default=0.2,
+                   help="fração de itens de um terceirizado fora do filtro (padrão 0.2)")
+    p.add_argument("--seed", type=int, default=42, help="semente do gerador (padrão 42)")
+    p.add_argument("--reset", action="store_true", help="apaga as tabelas (inclusive o estado do monitor) antes de gerar")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    terceiros = [t.strip() for t in args.terceiros.split(",") if t.strip()]
+    counts = synthetic.generate(
+        args.path, args.solicitacoes, items_per_sol=args.items, terceiros=terceiros,
+        exams=args.exams, foreign_ratio=args.foreign_ratio, seed=args.seed, reset=args.reset,
+    )
+    log.info("itens a partir de CodItemSol=%s; rode o monitor com DB_BACKEND=sqlite SQLITE_PATH=%s",
+             counts["primeiro_item"], args.path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
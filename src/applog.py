@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import random
+import logging
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+# =========================
+# Logging da aplicação
+# =========================
+# Todos os módulos logam via `get_logger(__name__)`. Configuração por ambiente:
+#   LOG_LEVEL               DEBUG | INFO | WARNING | ERROR (padrão INFO)
+#   LOG_FORMAT              text | json (JSON-lines, um objeto por linha)
+#   LOG_PAYLOAD_SAMPLE      fração (0..1) dos payloads/respostas despejados em DEBUG (padrão 0)
+#   LOG_PAYLOAD_MAX_CHARS   trunca payloads/respostas despejados (padrão 2000)
+# Este módulo não importa `config` (é configurado por ele logo após carregar o .env).
+
+_ROOT_NAME = "bemsoft"
+_CONFIGURED = False
+
+PAYLOAD_SAMPLE = 0.0
+PAYLOAD_MAX_CHARS = 2000
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Uma linha JSON por evento: ts, level, logger, msg e campos extras (`extra={"fields": {...}}`)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: Optional[str] = None, fmt: Optional[str] = None, force: bool = False):
+    """Configura o logger raiz da aplicação (idempotente)."""
+    global _CONFIGURED, PAYLOAD_SAMPLE, PAYLOAD_MAX_CHARS
+    if _CONFIGURED and not force:
+        return
+    level = (level or os.getenv("LOG_LEVEL") or "INFO").upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT") or "text").lower()
+    PAYLOAD_SAMPLE = min(1.0, max(0.0, float(os.getenv("LOG_PAYLOAD_SAMPLE", "0") or 0)))
+    PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000") or 2000)
+
+    handler = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S"))
+
+    root = logging.getLogger(_ROOT_NAME)
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level, logging.INFO))
+    root.propagate = False
+    _CONFIGURED = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger filho do logger da aplicação (ex.: get_logger(__name__) -> 'bemsoft.main')."""
+    if name == "__main__":
+        name = "main"
+    return logging.getLogger(f"{_ROOT_NAME}.{name}")
+
+
+def _truncate(text: str) -> str:
+    if PAYLOAD_MAX_CHARS > 0 and len(text) > PAYLOAD_MAX_CHARS:
+        return text[:PAYLOAD_MAX_CHARS] + f"... (+{len(text) - PAYLOAD_MAX_CHARS} chars)"
+    return text
+
+
+def log_payload(logger: logging.Logger, title: str, payload: Any, **fields: Any):
+    """
+    Despeja um payload/resposta em DEBUG, amostrado por LOG_PAYLOAD_SAMPLE e truncado
+    por LOG_PAYLOAD_MAX_CHARS. A serialização só acontece se o evento for de fato logado.
+    """
+    if PAYLOAD_SAMPLE <= 0 or not logger.isEnabledFor(logging.DEBUG):
+        return
+    if PAYLOAD_SAMPLE < 1 and random.random() >= PAYLOAD_SAMPLE:
+        return
+    if isinstance(payload, (dict, list)):
+        text = json.dumps(payload, ensure_ascii=False, default=str)
+    elif isinstance(payload, (bytes, bytearray)):
+        # Corpo já serializado (o mesmo enviado no POST)
+        text = bytes(payload).decode("utf-8", "replace")
+    else:
+        text = str(payload)
+    logger.debug("%s: %s", title, _truncate(text), extra={"fields": fields} if fields else None)
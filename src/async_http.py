@@ -0,0 +1,201 @@
+import json
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, Awaitable, Dict, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import applog
+import config
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Transporte HTTP assíncrono (BEMSOFT_HTTP_TRANSPORT=async)
+# =========================
+# Um event loop asyncio dedicado (thread daemon) com uma única aiohttp.ClientSession:
+# pool de conexões com keep-alive, limite total e por host. Chamadores síncronos usam
+# `SessionAdapter` (mesma interface get/post de requests.Session, devolvendo respostas com
+# status_code/headers/content/text/json()), então send_to_bemsoft, TestsIndex e SheetsCache
+# funcionam sem mudança e mantêm o mesmo tratamento de status. Para concorrência de verdade,
+# `submit()` agenda corrotinas no loop e devolve concurrent.futures.Future.
+# Retentativas equivalentes às de `_build_session`: BEMSOFT_RETRIES tentativas extras em
+# 502/503/504 e em erros de conexão/timeout, backoff exponencial BEMSOFT_BACKOFF e Retry-After.
+
+RETRY_STATUS = (502, 503, 504)
+BACKOFF_MAX = 120.0
+
+
+class AsyncResponse:
+    """Resposta já lida por completo, compatível com o que o código usa de requests.Response."""
+
+    def __init__(self, status: int, headers: Dict[str, str], content: bytes, url: str):
+        self.status_code = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+def _backoff(attempt: int) -> float:
+    # Mesma fórmula do urllib3: backoff_factor * 2^(n-1)
+    return min(BACKOFF_MAX, config.RETRIES_BACKOFF * (2 ** (attempt - 1)))
+
+
+def _retry_after(headers: CaseInsensitiveDict) -> Optional[float]:
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class AsyncTransport:
+    def __init__(self, pool_size: Optional[int] = None, per_host: Optional[int] = None,
+                 keepalive: Optional[float] = None, verify: Optional[bool] = None):
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("BEMSOFT_HTTP_TRANSPORT=async requer o pacote aiohttp (pip install aiohttp)") from e
+        self.pool_size = pool_size or config.HTTP_POOL_SIZE
+        self.per_host = per_host or config.HTTP_PER_HOST
+        self.keepalive = config.HTTP_KEEPALIVE_SECONDS if keepalive is None else keepalive
+        self.verify = config.VERIFY_TLS if verify is None else verify
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="bemsoft-async", daemon=True)
+        self._thread.start()
+        self._session = self.run(self._create_session())
+
+    async def _create_session(self):
+        import aiohttp
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.per_host,
+            keepalive_timeout=self.keepalive,
+            ssl=None if self.verify else False,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    # ===== Ponte sync -> loop =====
+    def submit(self, coro: Awaitable[Any]) -> "concurrent.futures.Future[Any]":
+        """Agenda a corrotina no loop do transporte (pode ser chamado de qualquer thread)."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)  # type: ignore[arg-type]
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        """Executa a corrotina e bloqueia a thread atual até o resultado."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("chamada síncrona de dentro do loop do transporte assíncrono")
+        return self.submit(coro).result()
+
+    def session(self) -> "SessionAdapter":
+        return SessionAdapter(self)
+
+    # ===== Requisição com retentativas =====
+    async def request(self, method: str, url: str, *, headers: Optional[Dict[str, str]] = None,
+                      json_body: Any = None, data: Optional[bytes] = None,
+                      timeout: Optional[float] = None,
+                      retry_status: Tuple[int, ...] = RETRY_STATUS) -> AsyncResponse:
+        import aiohttp
+        client_timeout = aiohttp.ClientTimeout(total=timeout or config.TIMEOUT)
+        if json_body is not None:
+            data = json.dumps(json_body, ensure_ascii=False).encode("utf-8")
+            headers = dict(headers or {})
+            headers.setdefault("Content-Type", "application/json")
+
+        attempt = 0
+        while True:
+            try:
+                async with self._session.request(method, url, headers=headers, data=data,
+                                                 timeout=client_timeout) as resp:
+                    content = await resp.read()
+                    response = AsyncResponse(resp.status, dict(resp.headers), content, str(resp.url))
+            except asyncio.TimeoutError as e:
+                if attempt >= config.RETRIES_TOTAL:
+                    raise requests.Timeout(f"{method} {url}: timeout após {attempt + 1} tentativa(s)") from e
+                error: Optional[BaseException] = e
+                response = None
+            except aiohttp.ClientError as e:
+                if attempt >= config.RETRIES_TOTAL:
+                    raise requests.ConnectionError(f"{method} {url}: {e}") from e
+                error = e
+                response = None
+            else:
+                if response.status_code not in retry_status or attempt >= config.RETRIES_TOTAL:
+                    return response
+                error = None
+
+            attempt += 1
+            delay = _backoff(attempt)
+            if response is not None:
+                retry_after = _retry_after(response.headers)
+                if retry_after is not None:
+                    delay = min(BACKOFF_MAX, retry_after)
+            log.debug("%s %s: retentativa %d/%d em %.2fs (%s)", method, url, attempt, config.RETRIES_TOTAL,
+                      delay, error or f"status {response.status_code if response else '?'}")
+            await asyncio.sleep(delay)
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        try:
+            self.run(self._session.close())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop.close()
+
+
+class SessionAdapter:
+    """Interface síncrona (get/post) estilo requests.Session sobre o transporte assíncrono."""
+
+    def __init__(self, transport: AsyncTransport):
+        self.transport = transport
+        self.verify = transport.verify
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None,
+            **_: Any) -> AsyncResponse:
+        return self.transport.run(self.transport.request("GET", url, headers=headers, timeout=timeout))
+
+    def post(self, url: str, json: Any = None, data: Optional[bytes] = None,
+             headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None, **_: Any) -> AsyncResponse:
+        return self.transport.run(
+            self.transport.request("POST", url, headers=headers, json_body=json, data=data, timeout=timeout)
+        )
+
+    def close(self):
+        # A sessão é compartilhada pelo processo; fechada só em close_transport()
+        pass
+
+
+_TRANSPORT: Optional[AsyncTransport] = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_transport() -> AsyncTransport:
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            _TRANSPORT = AsyncTransport()
+            log.info(
+                "transporte HTTP assíncrono ativo (pool=%d, por host=%d, keep-alive=%.0fs)",
+                _TRANSPORT.pool_size, _TRANSPORT.per_host, _TRANSPORT.keepalive,
+            )
+        return _TRANSPORT
+
+
+def close_transport():
+    global _TRANSPORT
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is not None:
+            _TRANSPORT.close()
+            _TRANSPORT = None
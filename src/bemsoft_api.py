@@ -1,7 +1,15 @@
 import os
 import json
+import asyncio
 import uuid
-from typing import Any, Dict, List, Optional, Tuple
+import logging
+import threading
+import time
+import concurrent.futures
+import functools
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from datetime import datetime, date, timezone, timedelta
 
 import requests
@@ -9,132 +17,387 @@ from requests import Session
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+import applog
+import async_http
 import config
+import jsoncodec
+import metrics
+import ratelimit
 import sheets_client
 
+log = applog.get_logger(__name__)
+
 # ===== Cache de /tests =====
+def _parse_catalog(data: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Converte a resposta de GET /tests em {test_id: [variantes]}."""
+    cache: Dict[str, List[Dict[str, Any]]] = {}
+    for t in (data.get("tests") or []):
+        tid = (t.get("id") or "").strip()
+        if not tid:
+            continue
+        specimen = t.get("specimen", {}) or {}
+        specimen_id = specimen.get("id")
+        specimen_name = specimen.get("name")
+
+        # Adiciona à lista de variantes deste test_id
+        if tid not in cache:
+            cache[tid] = []
+
+        cache[tid].append({
+            "name": t.get("name"),
+            "specimen_id": specimen_id,
+            "specimen_name": specimen_name
+        })
+    return cache
+
+def _normalize_specimen(name: Optional[str]) -> str:
+    """Normaliza nome de material: minúsculas e sem prefixo numérico (ex: "0.Soro" -> "soro")."""
+    normalized = (name or "").lower().strip()
+    # Remove padrão "número.palavra" -> "palavra"
+    if '.' in normalized:
+        parts = normalized.split('.', 1)
+        if parts[0].isdigit():
+            normalized = parts[1].strip()
+    return normalized
+
+def _build_specimen_index(cache: Dict[str, List[Dict[str, Any]]]) -> Dict[Tuple[str, str], Tuple[Optional[str], int]]:
+    """Pré-compila {(test_id, material normalizado): (specimen_id, nº de variantes com esse material)}."""
+    index: Dict[Tuple[str, str], Tuple[Optional[str], int]] = {}
+    for tid, variants in cache.items():
+        if len(variants) < 2:
+            continue
+        for variant in variants:
+            key = (tid, _normalize_specimen(variant.get("specimen_name")))
+            if not key[1]:
+                continue
+            if key in index:
+                first, count = index[key]
+                index[key] = (first, count + 1)
+            else:
+                index[key] = (variant.get("specimen_id"), 1)
+    return index
+
 class TestsIndex:
-    def __init__(self, base_url: str, token: str, timeout: int):
+    """
+    Catálogo GET /tests em memória, com snapshot local (warm start instantâneo),
+    refresh em background ao vencer o TTL (If-None-Match/If-Modified-Since) e
+    troca atômica do dict. Um test_id desconhecido dispara no máximo um refresh
+    por TESTS_MISS_REFRESH_SECONDS.
+    """
+
+    def __init__(self, base_url: str, token: str, timeout: int,
+                 snapshot_path: Optional[str] = None, ttl: Optional[float] = None,
+                 miss_refresh_interval: Optional[float] = None):
         self.base_url = base_url.rstrip("/")
         self.token = token
         self.timeout = timeout
+        self.snapshot_path = snapshot_path if snapshot_path is not None else config.TESTS_CACHE_PATH
+        self.ttl = config.TESTS_CACHE_TTL if ttl is None else ttl
+        self.miss_refresh_interval = (
+            config.TESTS_MISS_REFRESH_SECONDS if miss_refresh_interval is None else miss_refresh_interval
+        )
         # Cache agora armazena lista de variantes para cada test_id
         # {test_id: [{"name": "...", "specimen_id": "...", "specimen_name": "..."}, ...]}
-        self.cache: Dict[str, List[Dict[str, Any]]] = {}
+        # Catálogo + índice pré-compilado + LRU do fallback fuzzy, trocados juntos (atômico)
+        self._catalog: Tuple[Dict[str, List[Dict[str, Any]]], Dict[Tuple[str, str], Tuple[Optional[str], int]], "OrderedDict[Tuple[str, str], Dict[str, Any]]"] = ({}, {}, OrderedDict())
+        self._memo_lock = threading.Lock()
+        # Última resolução relatada por test_id (log uma vez por test_id/estratégia)
+        self.resolutions: Dict[str, Dict[str, Any]] = {}
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.loaded_at = 0.0  # epoch do último download/validação do catálogo
+        self._last_miss_refresh = 0.0
+        # Evita downloads duplicados quando vários workers pedem o catálogo ao mesmo tempo
+        self._lock = threading.Lock()
+        self._bg_thread: Optional[threading.Thread] = None
+        self._snapshot_checked = False
+        # Incrementado a cada troca do catálogo (invalida o memo de resolução por exame)
+        self.generation = 0
 
-    def ensure_loaded(self, session: Session):
-        if self.cache:
+    @property
+    def cache(self) -> Dict[str, List[Dict[str, Any]]]:
+        return self._catalog[0]
+
+    @cache.setter
+    def cache(self, value: Dict[str, List[Dict[str, Any]]]):
+        self._catalog = (value, _build_specimen_index(value), OrderedDict())
+        self.resolutions = {}
+        self.generation += 1
+
+    # --- snapshot local ---
+    def _load_snapshot(self) -> bool:
+        self._snapshot_checked = True
+        if not self.snapshot_path or not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f) or {}
+        except Exception as e:
+            log.warning("snapshot de /tests inválido em %s: %s", self.snapshot_path, e)
+            return False
+        cache = snap.get("tests") or {}
+        if not cache:
+            return False
+        self.etag = snap.get("etag")
+        self.last_modified = snap.get("last_modified")
+        self.loaded_at = float(snap.get("fetched_at") or 0)
+        self.cache = cache
+        log.info("catálogo /tests carregado do snapshot (%d testes, idade %.0fs)", len(cache), time.time() - self.loaded_at)
+        return True
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
             return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+            tmp = f"{self.snapshot_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({
+                    "etag": self.etag,
+                    "last_modified": self.last_modified,
+                    "fetched_at": self.loaded_at,
+                    "tests": self.cache,
+                }, f, ensure_ascii=False)
+            os.replace(tmp, self.snapshot_path)
+        except Exception as e:
+            log.warning("falha ao gravar snapshot de /tests %s: %s", self.snapshot_path, e)
+
+    # --- download ---
+    def refresh(self, session: Session) -> bool:
+        """
+        Baixa o catálogo (GET condicional). Retorna True se o conteúdo mudou.
+        O dict novo só é publicado completo (troca atômica da referência).
+        """
+        headers = {"Authorization": f"Bearer {self.token}"}
+        if self.cache:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
         url = f"{self.base_url}/tests"
-        resp = session.get(url, headers={"Authorization": f"Bearer {self.token}"}, timeout=self.timeout)
+        resp = session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and self.cache:
+            self.loaded_at = time.time()
+            self._save_snapshot()
+            return False
         if resp.status_code != 200:
             raise RuntimeError(f"Falha ao carregar /tests ({resp.status_code}): {resp.text}")
-        data = resp.json() or {}
-        for t in (data.get("tests") or []):
-            tid = (t.get("id") or "").strip()
-            if not tid:
-                continue
-            specimen = t.get("specimen", {}) or {}
-            specimen_id = specimen.get("id")
-            specimen_name = specimen.get("name")
+        cache = _parse_catalog(resp.json() or {})
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = resp.headers.get("Last-Modified")
+        self.loaded_at = time.time()
+        self.cache = cache
+        self._save_snapshot()
+        log.info("catálogo /tests atualizado (%d testes)", len(cache))
+        return True
 
-            # Adiciona à lista de variantes deste test_id
-            if tid not in self.cache:
-                self.cache[tid] = []
+    def _refresh_in_background(self, session: Session):
+        def _run():
+            try:
+                with self._lock:
+                    self.refresh(session)
+            except Exception as e:
+                # Mantém o catálogo atual; nova tentativa no próximo acesso após o TTL
+                self.loaded_at = time.time()
+                log.warning("refresh de /tests em background falhou, mantendo catálogo atual: %s", e)
 
-            self.cache[tid].append({
-                "name": t.get("name"),
-                "specimen_id": specimen_id,
-                "specimen_name": specimen_name
-            })
+        if self._bg_thread and self._bg_thread.is_alive():
+            return
+        self._bg_thread = threading.Thread(target=_run, name="tests-refresh", daemon=True)
+        self._bg_thread.start()
 
-    def specimen_for(self, session: Session, support_test_id: Optional[str], descmat_hint: Optional[str] = None) -> Optional[str]:
+    def expired(self) -> bool:
+        """True se o catálogo está vazio ou passou do TTL (o próximo ensure_loaded baixa/atualiza)."""
+        return not self.cache or (self.ttl > 0 and time.time() - self.loaded_at > self.ttl)
+
+    def ensure_loaded(self, session: Session):
+        if self.cache:
+            if self.expired():
+                self._refresh_in_background(session)
+            return
+        with self._lock:
+            if self.cache:
+                return
+            if not self._snapshot_checked and self._load_snapshot():
+                return
+            self.refresh(session)
+
+    def _refresh_on_miss(self, session: Session) -> bool:
+        """Refresh síncrono e limitado por taxa quando um test_id não está no catálogo."""
+        now = time.time()
+        if now - self._last_miss_refresh < self.miss_refresh_interval:
+            return False
+        with self._lock:
+            if now - self._last_miss_refresh < self.miss_refresh_interval:
+                return False
+            self._last_miss_refresh = now
+            try:
+                return self.refresh(session)
+            except Exception as e:
+                log.warning("refresh de /tests por test_id desconhecido falhou: %s", e)
+                return False
+
+    def resolve(self, session: Session, support_test_id: Optional[str], descmat_hint: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
-        Retorna specimen_id para um test_id.
-        Se descmat_hint for fornecido e houver múltiplas variantes, tenta matching por nome do material.
+        Resolve o specimen de um test_id. Retorna {"specimen_id", "strategy", "ambiguous", "variants"}
+        ou None se o test_id não está no catálogo. Estratégias: "single" (uma variante),
+        "exact" (material normalizado no índice), "fuzzy" (substring, memoizado em LRU) e
+        "first" (sem match: usa a primeira variante).
         """
         if not support_test_id:
             return None
         self.ensure_loaded(session)
-        variants = self.cache.get(support_test_id)
+        cache, exact, memo = self._catalog
+        variants = cache.get(support_test_id)
+
+        if not variants and self._refresh_on_miss(session):
+            cache, exact, memo = self._catalog
+            variants = cache.get(support_test_id)
 
         if not variants:
             return None
 
         # Se só há uma variante, retorna direto
         if len(variants) == 1:
-            return variants[0].get("specimen_id")
-
-        # Se há múltiplas variantes e temos hint do DESCMAT, tenta matching
-        if descmat_hint:
-            # Normaliza o hint: remove prefixos numéricos e pontos (ex: "0.Soro" -> "soro")
-            hint_normalized = descmat_hint.lower().strip()
-            # Remove padrão "número.palavra" -> "palavra"
-            if '.' in hint_normalized:
-                parts = hint_normalized.split('.', 1)
-                if parts[0].isdigit():
-                    hint_normalized = parts[1].strip()
+            return {"specimen_id": variants[0].get("specimen_id"), "strategy": "single",
+                    "ambiguous": False, "variants": 1}
 
+        hint = _normalize_specimen(descmat_hint) if descmat_hint else ""
+        key = (support_test_id, hint)
+
+        hit = exact.get(key) if hint else None
+        if hit:
+            result = {"specimen_id": hit[0], "strategy": "exact", "ambiguous": hit[1] > 1,
+                      "variants": len(variants)}
+            self._report(support_test_id, descmat_hint, result)
+            return result
+
+        with self._memo_lock:
+            result = memo.get(key)
+            if result is not None:
+                memo.move_to_end(key)
+        if result is None:
+            result = self._fuzzy_resolve(variants, hint)
+            with self._memo_lock:
+                memo[key] = result
+                while len(memo) > config.TESTS_RESOLUTION_CACHE_SIZE:
+                    memo.popitem(last=False)
+        self._report(support_test_id, descmat_hint, result)
+        return result
+
+    @staticmethod
+    def _fuzzy_resolve(variants: List[Dict[str, Any]], hint: str) -> Dict[str, Any]:
+        # Verifica se o nome do specimen aparece no DESCMAT OU vice-versa
+        if hint:
+            matches = []
             for variant in variants:
-                specimen_name = (variant.get("specimen_name") or "").lower().strip()
-                # Verifica se o nome do specimen aparece no DESCMAT OU vice-versa
-                if specimen_name and (specimen_name in hint_normalized or hint_normalized in specimen_name):
-                    print(f"[tests] Match encontrado para '{support_test_id}': specimen '{specimen_name}' matches DESCMAT '{descmat_hint}' (normalizado: '{hint_normalized}')")
-                    return variant.get("specimen_id")
+                specimen_name = _normalize_specimen(variant.get("specimen_name"))
+                if specimen_name and (specimen_name in hint or hint in specimen_name):
+                    matches.append(variant)
+            if matches:
+                return {"specimen_id": matches[0].get("specimen_id"), "strategy": "fuzzy",
+                        "ambiguous": len(matches) > 1, "variants": len(variants)}
+        # Se não encontrou match ou não tem hint, usa a primeira variante
+        return {"specimen_id": variants[0].get("specimen_id"), "strategy": "first",
+                "ambiguous": True, "variants": len(variants)}
+
+    def _report(self, support_test_id: str, descmat_hint: Optional[str], result: Dict[str, Any]):
+        """Loga a resolução de um test_id uma única vez (ou quando a estratégia muda)."""
+        previous = self.resolutions.get(support_test_id)
+        if previous and previous.get("strategy") == result["strategy"]:
+            return
+        self.resolutions[support_test_id] = dict(result, descmat=descmat_hint)
+        if result["strategy"] == "first":
+            log.warning(
+                "'%s' tem %d variantes e nenhum material casou com DESCMAT '%s'. Usando a primeira (specimen: %s)",
+                support_test_id, result["variants"], descmat_hint, result["specimen_id"],
+            )
+        else:
+            extra = " (ambíguo)" if result["ambiguous"] else ""
+            log.info("'%s': specimen %s via %s para DESCMAT '%s'%s",
+                     support_test_id, result["specimen_id"], result["strategy"], descmat_hint, extra)
+
+    def resolution_report(self) -> List[Dict[str, Any]]:
+        """Resoluções de testes com múltiplas variantes: [{test_id, specimen_id, strategy, ambiguous, ...}]."""
+        return [dict(r, test_id=tid) for tid, r in sorted(self.resolutions.items())]
 
-        # Se não encontrou match ou não tem hint, usa a primeira variante e avisa
-        print(f"[tests] Aviso: '{support_test_id}' tem {len(variants)} variantes. Usando primeira: {variants[0].get('name')} (specimen: {variants[0].get('specimen_name')})")
-        return variants[0].get("specimen_id")
+    def specimen_for(self, session: Session, support_test_id: Optional[str], descmat_hint: Optional[str] = None) -> Optional[str]:
+        """
+        Retorna specimen_id para um test_id.
+        Se descmat_hint for fornecido e houver múltiplas variantes, tenta matching por nome do material.
+        """
+        result = self.resolve(session, support_test_id, descmat_hint)
+        return result.get("specimen_id") if result else None
 
 _TESTS_INDEX: Optional[TestsIndex] = None
+_TESTS_INDEX_LOCK = threading.Lock()
 def _get_tests_index() -> TestsIndex:
     global _TESTS_INDEX
     if _TESTS_INDEX is None:
-        if not config.TOKEN and not config.DRY_RUN:
-            raise RuntimeError("BEMSOFT_TOKEN não configurado para consultar /tests")
-        _TESTS_INDEX = TestsIndex(config.BASE_URL, config.TOKEN or "", config.TIMEOUT)
+        with _TESTS_INDEX_LOCK:
+            if _TESTS_INDEX is None:
+                if not config.TOKEN and not config.DRY_RUN:
+                    raise RuntimeError("BEMSOFT_TOKEN não configurado para consultar /tests")
+                _TESTS_INDEX = TestsIndex(config.BASE_URL, config.TOKEN or "", config.TIMEOUT)
     return _TESTS_INDEX
 
-_TEST_MAP: Dict[str, str] = {}
-if config._TEST_MAP_PATH and os.path.isfile(config._TEST_MAP_PATH):
-    try:
-        with open(config._TEST_MAP_PATH, "r", encoding="utf-8") as f:
-            _TEST_MAP = {str(k).strip().upper(): str(v).strip() for k, v in (json.load(f) or {}).items()}
-    except Exception:
-        _TEST_MAP = {}
+_TEST_MAP: Optional[Dict[str, str]] = None
+def _get_test_map() -> Dict[str, str]:
+    """Mapa BEMSOFT_TEST_MAP_PATH (CodigoExame -> supportTestId), lido no primeiro uso."""
+    global _TEST_MAP
+    if _TEST_MAP is None:
+        with _TESTS_INDEX_LOCK:
+            if _TEST_MAP is None:
+                mapping: Dict[str, str] = {}
+                path = config.TEST_MAP_PATH
+                if path and os.path.isfile(path):
+                    try:
+                        with open(path, "r", encoding="utf-8") as f:
+                            mapping = {str(k).strip().upper(): str(v).strip() for k, v in (json.load(f) or {}).items()}
+                    except Exception as e:
+                        log.warning("mapa de exames %s inválido, ignorado: %s", path, e)
+                _TEST_MAP = mapping
+    return _TEST_MAP
 
 def _only_digits(s: Optional[str]) -> Optional[str]:
     return "".join(ch for ch in (s or "") if ch.isdigit()) or None
 
-def _split_iso(iso_val: Optional[Any]) -> Tuple[Optional[str], Optional[str]]:
-    """Aceita string ISO ou datetime; retorna (YYYY-MM-DD, HH:MM:SS)"""
-    if not iso_val:
-        return None, None
+# Os itens de uma solicitação (e as solicitações de um mesmo dia) repetem as mesmas datas:
+# a conversão de cada string é feita uma vez (LRU)
+@functools.lru_cache(maxsize=4096)
+def _split_iso_text(text: str) -> Tuple[Optional[str], Optional[str]]:
     try:
-        if isinstance(iso_val, datetime):
-            dt = iso_val
-        else:
-            dt = datetime.fromisoformat(str(iso_val).replace("Z", "+00:00"))
+        dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
     except Exception:
         return None, None
     return dt.strftime("%Y-%m-%d"), dt.strftime("%H:%M:%S")
 
+@functools.lru_cache(maxsize=4096)
+def _normalize_time(text: str) -> Optional[str]:
+    if len(text) == 5:
+        text = text + ":00"
+    try:
+        return datetime.strptime(text, "%H:%M:%S").strftime("%H:%M:%S")
+    except Exception:
+        return None
+
+def _split_iso(iso_val: Optional[Any]) -> Tuple[Optional[str], Optional[str]]:
+    """Aceita string ISO ou datetime; retorna (YYYY-MM-DD, HH:MM:SS)"""
+    if not iso_val:
+        return None, None
+    if isinstance(iso_val, datetime):
+        return iso_val.strftime("%Y-%m-%d"), iso_val.strftime("%H:%M:%S")
+    return _split_iso_text(str(iso_val))
+
 def _choose_date_time(solicitacao: Dict[str, Any], itens: List[Dict[str, Any]]) -> Tuple[str, str]:
     dta = solicitacao.get("dtaentrada")
     hora = solicitacao.get("Hora")
     if dta:
-        try:
-            d = datetime.fromisoformat(str(dta).replace("Z", "+00:00")).strftime("%Y-%m-%d")
-        except Exception:
-            d = None
+        d = _split_iso(dta)[0]
         if d and hora:
-            try:
-                if isinstance(hora, str) and len(hora) == 5:
-                    hora = hora + ":00"
-                t = datetime.strptime(str(hora), "%H:%M:%S").strftime("%H:%M:%S")
+            t = _normalize_time(str(hora))
+            if t:
                 return d, t
-            except Exception:
-                pass
     for it in itens or []:
         d, t = _split_iso(it.get("DataEntrada"))
         if d and t:
@@ -145,8 +408,26 @@ def _choose_date_time(solicitacao: Dict[str, Any], itens: List[Dict[str, Any]])
 def _uuid() -> str:
     return str(uuid.uuid4())
 
-def _idemp_key(codsol: Any) -> str:
-    return f"sol-{codsol}" if codsol is not None else f"sol-{_uuid()}"
+def _idemp_key(codsol: Any, revision: Any = None, lab: Optional[str] = None) -> str:
+    # Reenvio de uma solicitação alterada (SOURCE_DRIVER=changetracking) usa uma chave por revisão;
+    # com `lab`, a order de um laboratório não colide com a dos outros da mesma solicitação
+    if codsol is None:
+        return f"sol-{_uuid()}"
+    key = f"sol-{codsol}-r{revision}" if revision else f"sol-{codsol}"
+    return f"{key}-{lab}" if lab else key
+
+def _id_lab(event: Dict[str, Any]) -> Optional[str]:
+    """Slug que entra nos identificadores enviados à API: só com LAB_SCOPED_IDS=1 (ligar LAB_PIPELINES não muda as chaves)."""
+    return event.get("lab") if config.LAB_SCOPED_IDS else None
+
+def _event_key(event: Dict[str, Any]) -> str:
+    return _idemp_key(event.get("solicitacao", {}).get("codsolicitacao"), event.get("revisao"), _id_lab(event))
+
+def _endpoint(event: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """URL base e token do envio: os do laboratório do evento (LAB_<SLUG>_BASE_URL/_TOKEN) ou os padrões."""
+    override = config.LAB_OVERRIDES.get(event["lab"]) if event.get("lab") else None
+    override = override or {}
+    return override.get("base_url") or config.BASE_URL, override.get("token") or config.TOKEN
 
 def map_support_test(local_code: Optional[str]) -> Optional[str]:
     if not local_code:
@@ -154,32 +435,226 @@ def map_support_test(local_code: Optional[str]) -> Optional[str]:
     key = str(local_code).strip()
     if not key:
         return None
-    mapped = _TEST_MAP.get(key.upper())
+    mapped = _get_test_map().get(key.upper())
     return mapped or key
 
+# ===== Montagem do payload =====
+# O que não muda entre orders é calculado uma vez: o bloco physician (refeito só se a
+# config mudar) e, por CodigoExame, a resolução completa do exame (supportTestId,
+# specimenId e os dados da planilha). O memo vale para uma geração do catálogo /tests e
+# da planilha; quando qualquer um é recarregado, o memo inteiro é descartado. Falhas
+# (specimen ausente) não são memorizadas, para o refresh por test_id desconhecido
+# continuar valendo. Os dicts memorizados são compartilhados entre orders (somente leitura).
+
+class ExamResolution(NamedTuple):
+    support_test_id: str
+    specimen_id: str
+    test_name: Optional[str]
+    descmat: Optional[str]
+    # additionalInformations vindas da planilha (SUPPORT_TEST_NAME, DESCMAT)
+    sheet_info: Tuple[Dict[str, str], ...]
+
+_EXAM_MEMO: Tuple[Tuple[int, int], Dict[Any, ExamResolution]] = ((-1, -1), {})
+_PHYSICIAN: Tuple[Tuple[Any, ...], Optional[Dict[str, Any]]] = ((), None)
+
+def _generations(tests_index: Optional[TestsIndex]) -> Tuple[int, int]:
+    return (tests_index.generation if tests_index is not None else 0), sheets_client.get_generation()
+
+def reset_payload_cache():
+    """Descarta o memo de exames e os caches de datas (benchmark_payload.py --cold)."""
+    global _EXAM_MEMO
+    _EXAM_MEMO = ((-1, -1), {})
+    _split_iso_text.cache_clear()
+    _normalize_time.cache_clear()
+
+def _physician_block() -> Optional[Dict[str, Any]]:
+    """Bloco physician da config (None se incompleto), montado uma vez por configuração."""
+    global _PHYSICIAN
+    values = (config.PHYSICIAN_NAME, config.PHYSICIAN_COUNC, config.PHYSICIAN_NUM, config.PHYSICIAN_UF)
+    if values != _PHYSICIAN[0]:
+        block = None
+        if all(values):
+            block = {
+                "externalId": config.PHYSICIAN_NUM,
+                "name": config.PHYSICIAN_NAME,
+                "councilAbbreviation": config.PHYSICIAN_COUNC,
+                "councilNumber": config.PHYSICIAN_NUM,
+                "councilUf": config.PHYSICIAN_UF,
+            }
+        _PHYSICIAN = (values, block)
+    return _PHYSICIAN[1]
+
+def resolve_exam(codigo: Any, session: Optional[Session], tests_index: Optional[TestsIndex]) -> ExamResolution:
+    """Resolução de um CodigoExame (memorizada por geração do catálogo e da planilha)."""
+    global _EXAM_MEMO
+    if tests_index is not None and tests_index.expired():
+        # Mantém o refresh por TTL, que antes era disparado a cada item
+        session = session or _build_session()
+        tests_index.ensure_loaded(session)
+    gen = _generations(tests_index)
+    memo_gen, memo = _EXAM_MEMO
+    if memo_gen != gen:
+        memo = {}
+        _EXAM_MEMO = (gen, memo)
+    hit = memo.get(codigo)
+    if hit is not None:
+        return hit
+
+    support_test_id = map_support_test(codigo)
+    if not support_test_id:
+        support_test_id = (codigo or "").strip()
+
+    # Busca informações do Google Sheets ANTES de resolver specimen_id
+    test_info = sheets_client.get_test_info(support_test_id)
+    test_name = test_info.get("TEST_NAME") if test_info else None
+    descmat = test_info.get("SUPPORT_LAB_DESCMAT") if test_info else None
+    log.debug("support_test_id='%s', test_info=%s, descmat='%s'", support_test_id, test_info, descmat)
+
+    if tests_index is None:
+        specimen_id = "SPECIMEN-TEST"
+    else:
+        # Passa descmat como hint para resolver ambiguidade de múltiplas variantes
+        specimen_id = tests_index.specimen_for(session or _build_session(), support_test_id, descmat_hint=descmat)
+        log.debug("specimen_id retornado: '%s'", specimen_id)
+        if not specimen_id:
+            raise ValueError(
+                f"supportSpecimenId ausente para supportTestId='{support_test_id}'. "
+                f"Ajuste o mapping (BEMSOFT_TEST_MAP_PATH) ou o catálogo /tests."
+            )
+
+    sheet_info: List[Dict[str, str]] = []
+    if test_name:
+        sheet_info.append({"key": "SUPPORT_TEST_NAME", "value": test_name})
+    if descmat:
+        sheet_info.append({"key": "DESCMAT", "value": descmat})
+
+    result = ExamResolution(support_test_id, specimen_id, test_name, descmat, tuple(sheet_info))
+    # Se o catálogo/planilha mudou durante a resolução (refresh por miss), não memoriza
+    if _generations(tests_index) == gen:
+        memo[codigo] = result
+    return result
+
+class _SendRetry(Retry):
+    """Retry do urllib3 que deixa 429/503 de POST para o Throttle (pausa compartilhada, não uma por thread)."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST" and status_code in ratelimit.THROTTLE_STATUS:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+def _send_workers() -> int:
+    """Workers de envio do processo (com LAB_PIPELINES=1, a soma dos workers dos laboratórios)."""
+    if config.LAB_PIPELINES:
+        overrides = config.LAB_OVERRIDES
+        return sum(
+            (overrides.get(config.lab_slug(lab)) or {}).get("max_workers") or config.MAX_WORKERS
+            for lab in dict.fromkeys(config.TERCEIROS)
+        )
+    return config.MAX_WORKERS
+
 def _build_session() -> Session:
+    if config.HTTP_TRANSPORT == "async":
+        # Mesma interface get/post, servida pelo pool aiohttp compartilhado
+        return async_http.get_transport().session()  # type: ignore[return-value]
     s = requests.Session()
     s.verify = config.VERIFY_TLS
-    retries = Retry(
+    retries = _SendRetry(
         total=config.RETRIES_TOTAL,
         backoff_factor=config.RETRIES_BACKOFF,
         status_forcelist=[502, 503, 504],
         allowed_methods=["GET", "POST"],
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retries, pool_connections=10, pool_maxsize=10)
+    # O pool precisa comportar todos os workers de envio em paralelo (BEMSOFT_MAX_WORKERS);
+    # com LAB_PIPELINES=1 a sessão é compartilhada pelos workers de todos os laboratórios
+    pool_size = max(10, _send_workers())
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=10, pool_maxsize=pool_size)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
     return s
 
-def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> Dict[str, Any]:
+# ===== Freio dos envios =====
+# Um ratelimit.Throttle por endpoint, compartilhado por todos os envios do processo (workers,
+# laboratórios, retentativas, lotes e transporte assíncrono): taxa BEMSOFT_RATE_PER_SECOND,
+# pausa/ritmo pedidos pela API (Retry-After, RateLimit-*) e concorrência AIMD. 429/503 em POST
+# são retentados aqui (até BEMSOFT_RETRIES vezes) depois da pausa, e não pelo urllib3/aiohttp.
+_THROTTLES: Dict[str, ratelimit.Throttle] = {}
+_THROTTLES_LOCK = threading.Lock()
+# Retentativas do transporte assíncrono em POST (429/503 ficam com o Throttle)
+_ASYNC_RETRY_STATUS = tuple(s for s in async_http.RETRY_STATUS if s not in ratelimit.THROTTLE_STATUS)
+
+def _get_throttle(base_url: str) -> ratelimit.Throttle:
+    with _THROTTLES_LOCK:
+        throttle = _THROTTLES.get(base_url)
+        if throttle is None:
+            # Teto de POSTs em voo: o que o transporte comporta (workers no sync, limite por host no async)
+            ceiling = config.HTTP_PER_HOST if config.HTTP_TRANSPORT == "async" else _send_workers()
+            throttle = ratelimit.Throttle(
+                base_url, config.RATE_PER_SECOND, ceiling,
+                latency_target=config.LATENCY_TARGET_MS / 1000.0, adaptive=config.ADAPTIVE_CONCURRENCY,
+            )
+            _THROTTLES[base_url] = throttle
+            metrics.HTTP_CONCURRENCY.set(throttle.concurrency.maximum, endpoint=base_url)
+            log.info("freio de envio para %s: %s", base_url, throttle.describe())
+        return throttle
+
+def _observe(throttle: ratelimit.Throttle, status: Optional[int], latency: float,
+             headers: Any = None, error: bool = False) -> None:
+    reason, _pause = throttle.observe(status, latency, headers, error=error)
+    if reason:
+        metrics.HTTP_THROTTLED.inc(reason=reason)
+    metrics.HTTP_CONCURRENCY.set(int(throttle.concurrency.limit), endpoint=throttle.name)
+
+def _throttled_post(sess: Session, base_url: str, body: bytes,
+                    headers: Dict[str, str]) -> Tuple[requests.Response, float]:
+    """POST /requests (corpo já serializado) pelo freio do endpoint; retorna (resposta, duração da última tentativa)."""
+    throttle = _get_throttle(base_url)
+    url = base_url.rstrip("/") + config.REQS_ENDPOINT
+    waited = throttle.enter()
+    try:
+        attempt = 0
+        while True:
+            waited += throttle.wait()
+            request_start = time.perf_counter()
+            try:
+                resp = sess.post(url, data=body, headers=headers, timeout=config.TIMEOUT)
+            except requests.RequestException:
+                _observe(throttle, None, time.perf_counter() - request_start, error=True)
+                raise
+            request_duration = time.perf_counter() - request_start
+            metrics.POST_SECONDS.observe(request_duration)
+            _observe(throttle, resp.status_code, request_duration, resp.headers)
+            if resp.status_code not in ratelimit.THROTTLE_STATUS or attempt >= config.RETRIES_TOTAL:
+                return resp, request_duration
+            attempt += 1
+            log.debug("POST %s: status %s, retentativa %d/%d após a pausa", config.REQS_ENDPOINT,
+                      resp.status_code, attempt, config.RETRIES_TOTAL)
+    finally:
+        throttle.leave()
+        if waited:
+            metrics.HTTP_THROTTLE_WAIT.inc(waited)
+
+def _exam_code(value: Any) -> Any:
+    # CodigoExame NULL ou vazio vira "XXXX" (mesma regra de main.row_to_item)
+    if not value or str(value).strip() == "":
+        return "XXXX"
+    return value
+
+def build_order(event: Dict[str, Any], session: Optional[Session] = None) -> Tuple[Dict[str, Any], str, str, str]:
+    """
+    Monta o `order` de uma solicitação; retorna (order, batch_id, data, hora).
+    Os itens podem ser as próprias linhas lidas do banco (database.ItemRow) ou dicts
+    (main.row_to_item, arquivos de falha): cada campo é normalizado aqui, ao ser usado.
+    """
     solicitacao = event.get("solicitacao", {}) or {}
     paciente    = event.get("paciente", {}) or {}
     itens       = event.get("itens", []) or []
 
     codsol   = solicitacao.get("codsolicitacao")
-    batch_id = f"sol-{codsol}" if codsol is not None else f"sol-{_uuid()}"
-    order_id = f"order-{codsol}" if codsol is not None else f"order-{_uuid()}"
+    lab      = _id_lab(event)
+    suffix   = f"-{lab}" if lab else ""
+    batch_id = f"sol-{codsol}{suffix}" if codsol is not None else f"sol-{_uuid()}"
+    order_id = f"order-{codsol}{suffix}" if codsol is not None else f"order-{_uuid()}"
     bdate, btime = _choose_date_time(solicitacao, itens)
 
     # patient.externalId
@@ -191,13 +666,7 @@ def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> D
         pat_ext = f"pat-{_uuid()}"
 
     # birthDate
-    birth_date: Optional[str] = None
-    if paciente.get("datanasc"):
-        try:
-            bd = datetime.fromisoformat(str(paciente["datanasc"]).replace("Z", "+00:00"))
-            birth_date = bd.strftime("%Y-%m-%d")
-        except Exception:
-            pass
+    birth_date = _split_iso(paciente.get("datanasc"))[0]
     if not birth_date:
         birth_date = config.DEFAULT_BIRTH
     if not birth_date:
@@ -219,17 +688,8 @@ def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> D
         raise ValueError("gender obrigatório ausente/ inválido (defina paciente.sexo ou DEFAULT_GENDER='M'|'F' no .env).")
 
     # physician opcional - se não tiver dados completos, não inclui no payload
-    physician_data = None
-    if config.PHYSICIAN_NAME and config.PHYSICIAN_COUNC and config.PHYSICIAN_NUM and config.PHYSICIAN_UF:
-        physician_data = {
-            "externalId": config.PHYSICIAN_NUM,
-            "name": config.PHYSICIAN_NAME,
-            "councilAbbreviation": config.PHYSICIAN_COUNC,
-            "councilNumber": config.PHYSICIAN_NUM,
-            "councilUf": config.PHYSICIAN_UF,
-        }
+    physician_data = _physician_block()
 
-    sess = session or (_build_session() if not config.DRY_RUN else None)
     tests_index: Optional[TestsIndex] = None if config.DRY_RUN else _get_tests_index()
 
     tests: List[Dict[str, Any]] = []
@@ -239,53 +699,22 @@ def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> D
         d_col = d_col or bdate
         t_col = t_col or btime
 
-        support_test_id = map_support_test(it.get("CodigoExame"))
-        if not support_test_id:
-            support_test_id = (it.get("CodigoExame") or "").strip()
-
-        # Busca informações do Google Sheets ANTES de resolver specimen_id
-        test_info = sheets_client.get_test_info(support_test_id)
-        descmat = test_info.get("SUPPORT_LAB_DESCMAT") if test_info else None
-
-        print(f"[debug] support_test_id='{support_test_id}', test_info={test_info}, descmat='{descmat}'")
+        exam = resolve_exam(_exam_code(it.get("CodigoExame")), session, tests_index)
 
-        if config.DRY_RUN:
-            specimen_id = "SPECIMEN-TEST"
-        else:
-            # Passa descmat como hint para resolver ambiguidade de múltiplas variantes
-            specimen_id = tests_index.specimen_for(sess, support_test_id, descmat_hint=descmat)
-            print(f"[debug] specimen_id retornado: '{specimen_id}'")
-            if not specimen_id:
-                raise ValueError(
-                    f"supportSpecimenId ausente para supportTestId='{support_test_id}'. "
-                    f"Ajuste o mapping (BEMSOFT_TEST_MAP_PATH) ou o catálogo /tests."
-                )
-
-        # Monta additionalInformations base
+        # additionalInformations base + dados do Google Sheets quando disponível
         additional_info = [
             {"key": "origem", "value": it.get("Origem") or "API"},
             {"key": "descricao", "value": it.get("DescExames") or ""},
             {"key": "observacao_codigo_exame", "value": it.get("ExameDescricao") or ""},
         ]
-
-        # Adiciona dados do Google Sheets quando disponível
-        if test_info:
-            test_name = test_info.get("TEST_NAME")
-
-            if test_name:
-                additional_info.append({"key": "SUPPORT_TEST_NAME", "value": test_name})
-
-            if descmat:
-                additional_info.append({"key": "DESCMAT", "value": descmat})
-
-            print(f"[sheets] Dados encontrados para '{support_test_id}': TEST_NAME='{test_name}', DESCMAT='{descmat}'")
+        additional_info.extend(exam.sheet_info)
 
         tests.append({
             "externalId": item_ext,
             "collectionDate": d_col,
             "collectionTime": t_col,
-            "supportTestId": support_test_id,
-            "supportSpecimenId": specimen_id,
+            "supportTestId": exam.support_test_id,
+            "supportSpecimenId": exam.specimen_id,
             "additionalInformations": additional_info,
             "condition": "",
             "preservative": "",
@@ -315,6 +744,10 @@ def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> D
     if physician_data:
         order_data["physician"] = physician_data
 
+    return order_data, batch_id, bdate, btime
+
+def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> Dict[str, Any]:
+    order_data, batch_id, bdate, btime = build_order(event, session=session)
     payload = {
         "batch": {
             "externalId": batch_id,
@@ -325,6 +758,31 @@ def build_payload(event: Dict[str, Any], session: Optional[Session] = None) -> D
     }
     return payload
 
+def _batch_body(external_id: str, bdate: str, btime: str, orders: List[bytes], single: bool = False) -> bytes:
+    """
+    Corpo do POST a partir de orders já serializadas (jsoncodec.dumps), sem serializá-las de
+    novo: {"batch": {"externalId", "date", "time", "order": ...}} ou {..., "orders": [...]}.
+    """
+    head = jsoncodec.dumps({"externalId": external_id, "date": bdate, "time": btime})
+    if single:
+        return b'{"batch":' + head[:-1] + b',"order":' + orders[0] + b"}}"
+    return b'{"batch":' + head[:-1] + b',"orders":[' + b",".join(orders) + b"]}}"
+
+def _post_body(event: Dict[str, Any], body: bytes, sess: Session, base_url: str, token: str,
+               print_payload: bool = False) -> Dict[str, Any]:
+    """POST /requests de um corpo já serializado, com a Idempotency-Key do evento."""
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+        "Idempotency-Key": _event_key(event),
+    }
+    metrics.PAYLOAD_BYTES.observe(len(body))
+    if print_payload:
+        applog.log_payload(log, "payload enviado", body)
+    resp, request_duration = _throttled_post(sess, base_url, body, headers)
+    log.debug("POST %s concluído em %.3fs (status=%s)", config.REQS_ENDPOINT, request_duration, resp.status_code)
+    return _interpret_response(resp)
+
 def send_to_bemsoft(event: Dict[str, Any], session: Optional[Session] = None, print_payload: bool = False) -> Dict[str, Any]:
     """Transforma e envia POST /requests (ou apenas gera no DRY_RUN)."""
     if config.DRY_RUN:
@@ -332,55 +790,111 @@ def send_to_bemsoft(event: Dict[str, Any], session: Optional[Session] = None, pr
         payload = build_payload(event, session=None)
         payload_end = datetime.now()
         payload_duration = (payload_end - payload_start).total_seconds()
-        print(f"[{payload_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] DRY_RUN ativo. Payload gerado em {payload_duration:.2f}s, não enviado.")
+        metrics.PAYLOAD_BUILD_SECONDS.observe(payload_duration)
+        log.info("DRY_RUN ativo. Payload gerado em %.3fs, não enviado.", payload_duration)
         if print_payload:
-            import json
-            print(f"\n== PAYLOAD ENVIADO ==\n{json.dumps(payload, ensure_ascii=False, indent=2)}\n")
+            applog.log_payload(log, "payload (dry-run)", payload)
         return {"ok": True, "status": 200, "data": {"dryRun": True, "payload": payload}}
 
-    if not config.TOKEN:
+    base_url, token = _endpoint(event)
+    if not token:
         return {"ok": False, "status": 401, "error": "BEMSOFT_TOKEN não configurado (Bearer)"}
 
     sess = session or _build_session()
-    headers = {
-        "Authorization": f"Bearer {config.TOKEN}",
-        "Content-Type": "application/json",
-        "Idempotency-Key": _idemp_key(event.get("solicitacao", {}).get("codsolicitacao")),
-    }
-    url = config.BASE_URL.rstrip("/") + config.REQS_ENDPOINT
 
+    # Montagem e serialização (uma única vez: corpo do POST e log usam os mesmos bytes)
     payload_start = datetime.now()
-    payload = build_payload(event, session=sess)
+    body = jsoncodec.dumps(build_payload(event, session=sess))
     payload_end = datetime.now()
     payload_duration = (payload_end - payload_start).total_seconds()
-    print(f"[{payload_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] Payload construído em {payload_duration:.2f}s")
+    metrics.PAYLOAD_BUILD_SECONDS.observe(payload_duration)
+    log.debug("payload construído em %.3fs (%d bytes)", payload_duration, len(body))
 
+    return _post_body(event, body, sess, base_url, token, print_payload=print_payload)
+
+def submit_to_bemsoft(event: Dict[str, Any], session: Optional[Session] = None,
+                      print_payload: bool = False) -> "concurrent.futures.Future[Dict[str, Any]]":
+    """
+    Versão não bloqueante de send_to_bemsoft para o transporte assíncrono: monta o payload na
+    thread atual e agenda o POST no event loop do transporte. O Future resolve no mesmo dict
+    de resultado de send_to_bemsoft (mesma interpretação de 201/409/400/401). Fora do modo
+    async (ou em DRY_RUN/sem token) executa send_to_bemsoft e devolve um Future já concluído.
+    """
+    transport = getattr(session, "transport", None)
+    base_url, token = _endpoint(event)
+    if config.DRY_RUN or not token or not isinstance(transport, async_http.AsyncTransport):
+        done: "concurrent.futures.Future[Dict[str, Any]]" = concurrent.futures.Future()
+        try:
+            done.set_result(send_to_bemsoft(event, session=session, print_payload=print_payload))
+        except Exception as e:
+            done.set_exception(e)
+        return done
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+        "Idempotency-Key": _event_key(event),
+    }
+    url = base_url.rstrip("/") + config.REQS_ENDPOINT
+
+    payload_start = time.perf_counter()
+    body = jsoncodec.dumps(build_payload(event, session=session))
+    metrics.PAYLOAD_BUILD_SECONDS.observe(time.perf_counter() - payload_start)
+    metrics.PAYLOAD_BYTES.observe(len(body))
     if print_payload:
-        import json as json_module
-        print(f"\n== PAYLOAD ENVIADO ==\n{json_module.dumps(payload, ensure_ascii=False, indent=2)}\n")
+        applog.log_payload(log, "payload enviado", body)
 
-    request_start = datetime.now()
-    resp = sess.post(url, json=payload, headers=headers, timeout=config.TIMEOUT)
-    request_end = datetime.now()
-    request_duration = (request_end - request_start).total_seconds()
-    print(f"[{request_end.strftime('%Y-%m-%d %H:%M:%S')}] [bemsoft] Request HTTP concluído em {request_duration:.2f}s")
+    # A vaga é ocupada aqui (bloqueia quem agenda: contrapressão) e liberada ao fim da corrotina
+    throttle = _get_throttle(base_url)
+    waited = throttle.enter()
+    if waited:
+        metrics.HTTP_THROTTLE_WAIT.inc(waited)
 
+    async def _post() -> Dict[str, Any]:
+        try:
+            attempt = 0
+            while True:
+                delay = throttle.try_acquire()
+                while delay:
+                    metrics.HTTP_THROTTLE_WAIT.inc(delay)
+                    await asyncio.sleep(delay)
+                    delay = throttle.try_acquire()
+                request_start = time.perf_counter()
+                try:
+                    resp = await transport.request("POST", url, headers=headers, data=body,
+                                                   timeout=config.TIMEOUT, retry_status=_ASYNC_RETRY_STATUS)
+                except requests.RequestException:
+                    _observe(throttle, None, time.perf_counter() - request_start, error=True)
+                    raise
+                request_duration = time.perf_counter() - request_start
+                metrics.POST_SECONDS.observe(request_duration)
+                _observe(throttle, resp.status_code, request_duration, resp.headers)
+                if resp.status_code not in ratelimit.THROTTLE_STATUS or attempt >= config.RETRIES_TOTAL:
+                    break
+                attempt += 1
+            log.debug("POST %s concluído em %.3fs (status=%s)", config.REQS_ENDPOINT, request_duration, resp.status_code)
+            return _interpret_response(resp)  # type: ignore[arg-type]
+        finally:
+            throttle.leave()
+
+    try:
+        return transport.submit(_post())
+    except Exception:
+        throttle.leave()
+        raise
+
+def _interpret_response(resp: requests.Response) -> Dict[str, Any]:
+    """Traduz a resposta de POST /requests no dict de resultado ({ok, status, data|error})."""
     status = resp.status_code
     try:
         body = resp.json() if resp.content else None
     except Exception:
         body = resp.text
 
-    # Log detalhado da resposta da API
-    import json as json_log
-    print(f"\n== RESPOSTA DA API BEMSOFT ==")
-    print(f"Status Code: {status}")
-    print(f"Headers: {dict(resp.headers)}")
-    if isinstance(body, dict) or isinstance(body, list):
-        print(f"Body (JSON):\n{json_log.dumps(body, ensure_ascii=False, indent=2)}")
-    else:
-        print(f"Body (Text): {body}")
-    print(f"==========================\n")
+    # Log detalhado da resposta da API (DEBUG, amostrado e truncado)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("resposta Bemsoft status=%s headers=%s", status, dict(resp.headers))
+        applog.log_payload(log, "corpo da resposta", body, status=status)
 
     # 201: Sucesso na criação do request
     if status == 201:
@@ -403,3 +917,137 @@ def send_to_bemsoft(event: Dict[str, Any], session: Optional[Session] = None, pr
         return {"ok": True, "status": status, "data": body}
 
     return {"ok": False, "status": status, "error": body}
+
+def _exception_result(exc: BaseException) -> Dict[str, Any]:
+    """Resultado de um envio que terminou em exceção (a exceção classifica a falha como transitória ou não)."""
+    return {"ok": False, "status": None, "error": str(exc), "exception": exc}
+
+def _with_idempotency_key(order: bytes, key: str) -> bytes:
+    """Order serializada acrescida de `idempotencyKey` (só no corpo de um lote)."""
+    return order[:-1] + b',"idempotencyKey":' + jsoncodec.dumps(key) + b"}"
+
+def _batch_key(keys: List[str]) -> str:
+    """Idempotency-Key (e externalId) de um lote: tamanho fixo, a mesma para o mesmo conjunto de orders."""
+    digest = hashlib.sha256("\n".join(sorted(keys)).encode("utf-8")).hexdigest()
+    return "batch-" + digest[:32]
+
+def _pack_orders(built: List[Tuple[int, bytes]], dates: Optional[Dict[int, str]] = None) -> List[List[Tuple[int, bytes]]]:
+    """
+    Agrupa orders serializadas em lotes limitados por BEMSOFT_BATCH_MAX_ORDERS e
+    BEMSOFT_BATCH_MAX_BYTES. Com `dates` ({idx: data do lote}), um lote só reúne orders
+    da mesma data, na ordem em que aparecem.
+    """
+    chunks: List[List[Tuple[int, bytes]]] = []
+    current: Dict[Optional[str], List[Tuple[int, bytes]]] = {}
+    current_bytes: Dict[Optional[str], int] = {}
+    for idx, order in built:
+        day = dates.get(idx) if dates else None
+        chunk = current.get(day)
+        size = len(order)
+        if chunk is None or len(chunk) >= config.BATCH_MAX_ORDERS or current_bytes[day] + size > config.BATCH_MAX_BYTES:
+            chunk = current[day] = []
+            current_bytes[day] = 0
+            chunks.append(chunk)
+        chunk.append((idx, order))
+        current_bytes[day] += size
+    return chunks
+
+def send_batch_to_bemsoft(events: List[Dict[str, Any]], session: Optional[Session] = None, print_payload: bool = False) -> List[Dict[str, Any]]:
+    """
+    Envia várias solicitações em POSTs multi-order (`batch.orders`), limitados por
+    BEMSOFT_BATCH_MAX_ORDERS e BEMSOFT_BATCH_MAX_BYTES. Retorna um resultado por evento,
+    na mesma ordem de `events`. Se um lote volta 400, cada order é reenviada sozinha
+    (send_to_bemsoft) para que uma order inválida não derrube as demais.
+    Cada order do lote leva `idempotencyKey` com a mesma chave do envio individual
+    (sol-<cod>...): se a API gravou o lote e respondeu 5xx ou estourou o timeout, a
+    retentativa avulsa da order volta 409 em vez de duplicá-la. O campo só entra no corpo
+    do lote; o POST de uma order sozinha sai igual ao de send_to_bemsoft. Uma exceção no
+    POST de um lote vira o resultado só das orders daquele lote; os demais mantêm o seu.
+    Um lote só reúne orders da mesma data: o cabeçalho (`batch.date`/`batch.time`) vem da
+    primeira order, e cada order leva a própria data e hora.
+    """
+    if len(events) <= 1 or config.BATCH_MAX_ORDERS <= 1:
+        return [send_to_bemsoft(ev, session=session, print_payload=print_payload) for ev in events]
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(events)
+    # Um lote sai de um único pipeline: mesmo laboratório, mesmo endpoint
+    base_url, token = _endpoint(events[0])
+    if not config.DRY_RUN and not token:
+        err = {"ok": False, "status": 401, "error": "BEMSOFT_TOKEN não configurado (Bearer)"}
+        return [dict(err) for _ in events]
+
+    sess = session or (_build_session() if not config.DRY_RUN else None)
+
+    # Cada order é serializada uma vez: os bytes compõem o corpo do POST individual
+    # (inclusive no reenvio após um 400) e, com a idempotencyKey, o do lote
+    payload_start = datetime.now()
+    built: List[Tuple[int, bytes]] = []
+    singles: Dict[int, bytes] = {}
+    heads: Dict[int, Tuple[str, str, str]] = {}
+    for idx, ev in enumerate(events):
+        try:
+            order, batch_id, bdate, btime = build_order(ev, session=sess)
+            order_bytes = jsoncodec.dumps(order)
+        except Exception as e:
+            results[idx] = {"ok": False, "status": None, "error": f"falha ao montar payload: {e}"}
+            continue
+        singles[idx] = order_bytes
+        built.append((idx, _with_idempotency_key(order_bytes, _event_key(ev))))
+        heads[idx] = (batch_id, bdate, btime)
+    payload_duration = (datetime.now() - payload_start).total_seconds()
+    metrics.PAYLOAD_BUILD_SECONDS.observe(payload_duration)
+    log.debug("%d order(s) construída(s) em %.3fs", len(built), payload_duration)
+
+    def _send_single(idx: int) -> Dict[str, Any]:
+        try:
+            if config.DRY_RUN:
+                return send_to_bemsoft(events[idx], session=sess, print_payload=print_payload)
+            body = _batch_body(*heads[idx], [singles[idx]], single=True)
+            return _post_body(events[idx], body, sess, base_url, token, print_payload=print_payload)
+        except Exception as e:
+            log.error("envio da order %s falhou: %s", _event_key(events[idx]), e)
+            return _exception_result(e)
+
+    for chunk in _pack_orders(built, {idx: head[1] for idx, head in heads.items()}):
+        if len(chunk) == 1:
+            results[chunk[0][0]] = _send_single(chunk[0][0])
+            continue
+
+        batch_key = _batch_key([_event_key(events[idx]) for idx, _ in chunk])
+        _batch_id, bdate, btime = heads[chunk[0][0]]
+        body = _batch_body(batch_key, bdate, btime, [order for _, order in chunk])
+        if print_payload:
+            applog.log_payload(log, f"payload enviado (lote com {len(chunk)} orders)", body)
+
+        if config.DRY_RUN:
+            for idx, _ in chunk:
+                results[idx] = {"ok": True, "status": 200, "data": {"dryRun": True, "batch": batch_key}}
+            continue
+
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Idempotency-Key": batch_key,
+        }
+        metrics.PAYLOAD_BYTES.observe(len(body))
+        try:
+            resp, request_duration = _throttled_post(sess, base_url, body, headers)
+        except Exception as e:
+            log.error("lote %s com %d orders falhou: %s", batch_key, len(chunk), e)
+            for idx, _ in chunk:
+                results[idx] = dict(_exception_result(e), batch=batch_key)
+            continue
+        log.info("lote com %d orders concluído em %.3fs (status=%s)", len(chunk), request_duration, resp.status_code)
+        batch_result = _interpret_response(resp)
+
+        if batch_result.get("validation_error"):
+            # Uma order inválida não pode envenenar o lote: reenvia uma a uma
+            log.warning("lote %s rejeitado (400); reenviando %d order(s) individualmente", batch_key, len(chunk))
+            for idx, _ in chunk:
+                results[idx] = _send_single(idx)
+            continue
+
+        for idx, _ in chunk:
+            results[idx] = dict(batch_result, batch=batch_key)
+
+    return [r or {"ok": False, "status": None, "error": "sem resultado"} for r in results]
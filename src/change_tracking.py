@@ -0,0 +1,335 @@
+from datetime import datetime
+
+from sqlalchemy import text
+
+import applog
+import config
+import database
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Fonte por Change Tracking (SOURCE_DRIVER=changetracking)
+# =========================
+# Alternativa ao keyset por CodItemSol: lê de CHANGETABLE(CHANGES dbo.ItemSol, @versão)
+# apenas as linhas inseridas ou alteradas desde a versão gravada em dbo._MonitorState
+# (linha 'ItemSolChangeTracking'; a coluna LastItemId guarda a versão). Sem mudanças,
+# o ciclo custa uma única consulta a CHANGE_TRACKING_CURRENT_VERSION().
+# Mesma interface de `database` para o poll_once: bootstrap_state, claim_groups,
+# commit_checkpoint e fetch_lag. A posição de cada item no checkpoint é a versão da
+# mudança (g["positions"]); solicitações com itens alterados (operação 'U') são relidas
+# por completo e recebem g["revisao"] = maior versão alterada, que entra na
+# Idempotency-Key para o reenvio não ser descartado como duplicado (409).
+# Só conta como alteração um 'U' em coluna que vai para o payload (PAYLOAD_COLUMNS, via
+# SYS_CHANGE_COLUMNS, que requer TRACK_COLUMNS_UPDATED = ON); mudar só SituacaoResultado,
+# Valor etc. não gera outro pedido. Sem a máscara de colunas, todo 'U' conta.
+# No SQLite (desenvolvimento, testes, benchmark) o Change Tracking é emulado: triggers no
+# ItemSol registram cada inserção/alteração em dbo._ItemSolChanges (versão autoincremento,
+# operação e colunas alteradas), e {changes} troca CHANGETABLE(CHANGES ...) por uma
+# consulta com as mesmas colunas (a última versão de cada item; 'I' se foi inserido depois
+# de :last; SYS_CHANGE_COLUMNS como ',Coluna,' concatenadas, NULL na inserção).
+
+# Colunas do ItemSol que entram no pedido (CodTExame dá CodigoExame/ExameDescricao;
+# NomeTerceirizado e CodSolicitacao decidem o laboratório e a solicitação)
+PAYLOAD_COLUMNS = ("CodSolicitacao", "DataEntrada", "DescExames", "CodTExame", "NomeTerceirizado", "Origem")
+
+# Emulação no SQLite: tabela de mudanças alimentada por triggers no ItemSol
+SQL_SQLITE_CHANGES_TABLE = text("""
+CREATE TABLE IF NOT EXISTS dbo._ItemSolChanges (
+  Version INTEGER PRIMARY KEY AUTOINCREMENT,
+  CodItemSol INTEGER NOT NULL,
+  Operation TEXT NOT NULL,
+  Columns TEXT NULL,
+  ChangedAt TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime'))
+);""")
+
+SQL_SQLITE_INSERT_TRIGGER = text("""
+CREATE TRIGGER IF NOT EXISTS dbo.TR_ItemSol_ChangeTracking_I AFTER INSERT ON ItemSol
+BEGIN
+  INSERT INTO _ItemSolChanges (CodItemSol, Operation) VALUES (NEW.CodItemSol, 'I');
+END;""")
+
+SQL_SQLITE_ITEMSOL_COLUMNS = text("SELECT name FROM pragma_table_info('ItemSol', 'dbo');")
+
+
+def _sqlite_update_trigger(columns):
+    """Trigger de alteração: grava ',Coluna,' de cada coluna cujo valor mudou."""
+    changed = " || ".join(f"CASE WHEN OLD.{c} IS NOT NEW.{c} THEN ',{c},' ELSE '' END" for c in columns)
+    return text(f"""
+CREATE TRIGGER IF NOT EXISTS dbo.TR_ItemSol_ChangeTracking_U AFTER UPDATE ON ItemSol
+BEGIN
+  INSERT INTO _ItemSolChanges (CodItemSol, Operation, Columns) VALUES (NEW.CodItemSol, 'U', {changed});
+END;""")
+
+
+_CHANGES = {
+    "mssql": "CHANGETABLE(CHANGES dbo.ItemSol, :last)",
+    "sqlite": """(
+    SELECT c.CodItemSol, MAX(c.Version) AS SYS_CHANGE_VERSION,
+           CASE WHEN MAX(c.Operation = 'I') = 1 THEN 'I' ELSE 'U' END AS SYS_CHANGE_OPERATION,
+           CASE WHEN MAX(c.Operation = 'I') = 1 THEN NULL ELSE group_concat(c.Columns, '') END AS SYS_CHANGE_COLUMNS
+      FROM dbo._ItemSolChanges c
+     WHERE c.Version > :last
+     GROUP BY c.CodItemSol)""",
+}
+
+# Alguma coluna de PAYLOAD_COLUMNS na máscara da mudança (máscara NULL: todas as colunas)
+_PAYLOAD_CHANGED = {
+    "mssql": (
+        "CASE WHEN ct.SYS_CHANGE_COLUMNS IS NULL"
+        + "".join(
+            f"\n          OR CHANGE_TRACKING_IS_COLUMN_IN_MASK("
+            f"COLUMNPROPERTY(OBJECT_ID('dbo.ItemSol'), '{col}', 'ColumnId'), ct.SYS_CHANGE_COLUMNS) = 1"
+            for col in PAYLOAD_COLUMNS
+        )
+        + "\n     THEN 1 ELSE 0 END"
+    ),
+    "sqlite": (
+        "CASE WHEN ct.SYS_CHANGE_COLUMNS IS NULL"
+        + "".join(f"\n          OR ct.SYS_CHANGE_COLUMNS LIKE '%,{col},%'" for col in PAYLOAD_COLUMNS)
+        + "\n     THEN 1 ELSE 0 END"
+    ),
+}
+
+
+def _query(template, clause):
+    """Aplica o dialeto, {changes}/{payload_changed} do backend e o filtro de terceirizado."""
+    name = database.backend()
+    return text(database.sql(
+        template, terceiro_clause=clause,
+        changes=_CHANGES.get(name, _CHANGES["mssql"]),
+        payload_changed=_PAYLOAD_CHANGED.get(name, _PAYLOAD_CHANGED["mssql"]),
+    ))
+
+
+# Emulação: sem triggers o "Change Tracking" não está ligado (NULL); a máscara de colunas sempre existe
+SQL_TRACKED = database.per_backend({
+    "mssql": text("""
+SELECT is_track_columns_updated_on
+FROM sys.change_tracking_tables WHERE object_id = OBJECT_ID('dbo.ItemSol');
+"""),
+    "sqlite": text("""
+SELECT CASE WHEN COUNT(*) = 2 THEN 1 END
+FROM dbo.sqlite_master WHERE type = 'trigger' AND name LIKE 'TR_ItemSol_ChangeTracking_%';
+"""),
+})
+
+# Linha de estado própria; começa na versão atual (o histórico anterior é do keyset)
+SQL_BOOTSTRAP = database.per_backend({
+    "mssql": text("""
+IF NOT EXISTS (SELECT 1 FROM dbo._MonitorState WHERE Name = 'ItemSolChangeTracking')
+  INSERT INTO dbo._MonitorState (Name, LastItemId)
+  VALUES ('ItemSolChangeTracking', CHANGE_TRACKING_CURRENT_VERSION());
+"""),
+    "sqlite": text("""
+INSERT OR IGNORE INTO dbo._MonitorState (Name, LastItemId)
+SELECT 'ItemSolChangeTracking', COALESCE(MAX(Version), 0) FROM dbo._ItemSolChanges;
+"""),
+})
+
+SQL_GET_LAST = database.statement("""
+SELECT LastItemId
+FROM dbo._MonitorState{updlock}
+WHERE Name = 'ItemSolChangeTracking';
+""")
+
+# Nunca regride (mesma regra do checkpoint do keyset)
+SQL_SET_LAST = database.statement("""
+UPDATE dbo._MonitorState
+   SET LastItemId = :last, UpdatedAt = {utcnow}
+ WHERE Name = 'ItemSolChangeTracking'
+   AND (LastItemId IS NULL OR LastItemId < :last);
+""")
+
+# Emulação: sem limpeza automática, toda versão continua válida
+SQL_VERSIONS = database.per_backend({
+    "mssql": text("""
+SELECT CHANGE_TRACKING_CURRENT_VERSION() AS CurrentVersion,
+       CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID('dbo.ItemSol')) AS MinValidVersion;
+"""),
+    "sqlite": text("""
+SELECT (SELECT COALESCE(MAX(Version), 0) FROM dbo._ItemSolChanges) AS CurrentVersion,
+       0 AS MinValidVersion;
+"""),
+})
+
+# Limite superior da página: versão da `limit`-ésima mudança elegível. A página sempre
+# contém versões inteiras, então o checkpoint por versão nunca corta uma transação ao meio.
+SQL_UPPER_TEMPLATE = """
+SELECT MAX(v.SYS_CHANGE_VERSION) FROM (
+    SELECT {top}ct.SYS_CHANGE_VERSION
+      FROM {changes} AS ct
+      JOIN dbo.ItemSol i ON i.CodItemSol = ct.CodItemSol
+     WHERE 1 = 1
+{terceiro_clause}     ORDER BY ct.SYS_CHANGE_VERSION ASC{limit}
+) AS v;
+"""
+
+# Exclusões ('D') não têm linha no ItemSol e ficam de fora pelo JOIN
+SQL_CHANGES_TEMPLATE = (
+    "\nSELECT ct.SYS_CHANGE_VERSION AS ChangeVersion, ct.SYS_CHANGE_OPERATION AS ChangeOperation,\n"
+    + "    {payload_changed} AS PayloadChanged,"
+    + database.SQL_FETCH_COLUMNS
+    + """JOIN {changes} AS ct ON ct.CodItemSol = i.CodItemSol
+WHERE ct.SYS_CHANGE_VERSION <= :upper
+{terceiro_clause}
+ORDER BY ct.SYS_CHANGE_VERSION ASC, i.CodItemSol ASC;
+"""
+)
+
+# Lag: versão atual e horário do commit mais antigo ainda não processado
+SQL_LAG = database.per_backend({
+    "mssql": text("""
+SELECT CHANGE_TRACKING_CURRENT_VERSION() AS MaxItemId,
+       (SELECT TOP (1) tc.commit_time
+          FROM sys.dm_tran_commit_table tc
+         WHERE tc.commit_ts > :last
+         ORDER BY tc.commit_ts ASC) AS OldestPending;
+"""),
+    "sqlite": text("""
+SELECT (SELECT COALESCE(MAX(Version), 0) FROM dbo._ItemSolChanges) AS MaxItemId,
+       (SELECT MIN(ChangedAt) FROM dbo._ItemSolChanges WHERE Version > :last) AS OldestPending;
+"""),
+})
+
+
+def _bootstrap_sqlite(conn):
+    """Liga a emulação: tabela de mudanças e triggers de inserção/alteração no ItemSol."""
+    conn.execute(SQL_SQLITE_CHANGES_TABLE)
+    conn.execute(SQL_SQLITE_INSERT_TRIGGER)
+    columns = [r[0] for r in conn.execute(SQL_SQLITE_ITEMSOL_COLUMNS)]
+    conn.execute(_sqlite_update_trigger(columns))
+
+
+def bootstrap_state():
+    database.bootstrap_state()
+    with database.get_engine().begin() as conn:
+        if database.backend() == "sqlite":
+            _bootstrap_sqlite(conn)
+        columns_updated = conn.execute(SQL_TRACKED).scalar()
+        if columns_updated is None:
+            raise RuntimeError(
+                "SOURCE_DRIVER=changetracking requer Change Tracking no ItemSol: "
+                "ALTER DATABASE <banco> SET CHANGE_TRACKING = ON (CHANGE_RETENTION = 7 DAYS, AUTO_CLEANUP = ON); "
+                "ALTER TABLE dbo.ItemSol ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON);"
+            )
+        if not columns_updated:
+            log.warning(
+                "Change Tracking do ItemSol sem TRACK_COLUMNS_UPDATED: toda alteração de item "
+                "(inclusive SituacaoResultado) reenvia a solicitação. Recrie com "
+                "ALTER TABLE dbo.ItemSol DISABLE CHANGE_TRACKING; "
+                "ALTER TABLE dbo.ItemSol ENABLE CHANGE_TRACKING WITH (TRACK_COLUMNS_UPDATED = ON);"
+            )
+        conn.execute(SQL_BOOTSTRAP)
+
+
+def _iter_changes(conn, last, upper, terceiros):
+    """Gera (versão, operação, mudou o payload, ItemRow) das mudanças em (last, upper]."""
+    clause, params = database._build_terceiro_clause(terceiros)
+    stmt = _query(SQL_CHANGES_TEMPLATE, clause)
+    params = dict(params, last=last, upper=upper)
+    result = conn.execution_options(yield_per=config.FETCH_STREAM_CHUNK).execute(stmt, params)
+    keys = tuple(result.keys())
+    version_pos = keys.index("ChangeVersion")
+    op_pos = keys.index("ChangeOperation")
+    payload_pos = keys.index("PayloadChanged")
+    order = [keys.index(c) for c in database.ITEM_COLUMNS]
+    for partition in result.partitions():
+        for row in partition:
+            yield (int(row[version_pos]), row[op_pos], bool(row[payload_pos]),
+                   database.ItemRow(row[i] for i in order))
+
+
+def claim_groups(terceiros, limit=None, item_factory=None):
+    """
+    Mesma interface de database.claim_groups, com a versão do Change Tracking no lugar
+    do CodItemSol: retorna (versão anterior, linhas lidas, {CodSolicitacao: grupo}).
+    Cada grupo traz "positions" (versão de cada mudança) e, se houve alteração de itens
+    já existentes, "revisao" e todos os itens da solicitação. Alterações só em colunas fora
+    do payload são lidas e descartadas; se a página só tem essas, o checkpoint avança direto.
+    """
+    factory = item_factory or (lambda row: row)
+    limit = int(limit or config.FETCH_PAGE_SIZE)
+    clause, params = database._build_terceiro_clause(terceiros)
+    groups = {}
+    count = 0
+    with database.get_engine().begin() as conn:
+        last = conn.execute(SQL_GET_LAST).scalar() or 0
+        versions = conn.execute(SQL_VERSIONS).mappings().first()
+        current = versions["CurrentVersion"]
+        if current is None:
+            raise RuntimeError("Change Tracking desativado no banco (CHANGE_TRACKING_CURRENT_VERSION() é NULL)")
+        current = int(current)
+        min_valid = int(versions["MinValidVersion"] or 0)
+        if last < min_valid:
+            # A limpeza automática já removeu mudanças não lidas: recomeça da versão atual
+            log.error(
+                "versão %s do Change Tracking expirou (mínima válida %s): mudanças perdidas, "
+                "reiniciando em %s. Use SOURCE_DRIVER=watermark para reprocessar por CodItemSol.",
+                last, min_valid, current,
+            )
+            conn.execute(SQL_SET_LAST, {"last": current})
+            return current, 0, {}
+        if current <= last:
+            return last, 0, {}
+
+        upper = conn.execute(
+            _query(SQL_UPPER_TEMPLATE, clause), dict(params, last=last, limit=limit)
+        ).scalar()
+        if upper is None:
+            # Só mudanças de outros terceirizados (ou exclusões): avança direto
+            conn.execute(SQL_SET_LAST, {"last": current})
+            return current, 0, {}
+
+        changed = set()
+        for version, operation, payload_changed, row in _iter_changes(conn, last, int(upper), terceiros):
+            count += 1
+            if operation == "U" and not payload_changed:
+                continue
+            cod = row["CodSolicitacao"]
+            group = groups.get(cod)
+            if group is None:
+                group = groups[cod] = {"head": row, "items": [], "positions": []}
+            group["items"].append(factory(row))
+            group["positions"].append(version)
+            if operation == "U":
+                group["revisao"] = max(group.get("revisao") or 0, version)
+                changed.add(cod)
+
+        if changed:
+            # Reenvio de uma solicitação alterada precisa do pedido completo, não só das linhas mudadas
+            full = {}
+            for row in database.fetch_items_for_solicitacoes(conn, sorted(changed), terceiros):
+                full.setdefault(row["CodSolicitacao"], []).append(row)
+            for cod in changed:
+                rows = full.get(cod)
+                if rows:
+                    groups[cod]["head"] = rows[0]
+                    groups[cod]["items"] = [factory(r) for r in rows]
+
+        if count and not groups:
+            # Página só com alterações fora do payload: nada a enviar, avança direto
+            log.debug("%d alteração(ões) sem efeito no payload até a versão %s", count, upper)
+            conn.execute(SQL_SET_LAST, {"last": int(upper)})
+            return int(upper), 0, {}
+    return last, count, groups
+
+
+def commit_checkpoint(last):
+    with database.get_engine().begin() as conn:
+        conn.execute(SQL_SET_LAST, {"last": last})
+
+
+def fetch_lag(conn, last, terceiros):
+    """Retorna (versão atual, horário do commit pendente mais antigo); atraso em versões."""
+    row = conn.execute(SQL_LAG, {"last": last}).mappings().first()
+    if not row:
+        return None, None
+    oldest = row["OldestPending"]
+    if isinstance(oldest, str):
+        # Emulação no SQLite: subconsulta sem tipo declarado volta como texto
+        try:
+            oldest = datetime.fromisoformat(oldest)
+        except ValueError:
+            oldest = None
+    return row["MaxItemId"], oldest
@@ -1,12 +1,24 @@
 import os
+import re
+import socket
 import sys
+import threading
+import unicodedata
+from dataclasses import dataclass, fields
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
-from dotenv import load_dotenv
+import applog
 
 # =========================
 # Config & utilidades base
 # =========================
+# Carregamento preguiçoso: importar este módulo não lê o .env, não configura o logging
+# nem cria diretórios. O primeiro acesso a uma configuração (config.POLL_SECONDS,
+# get_settings()...) carrega o .env, monta um `Settings` tipado uma única vez e publica
+# cada campo como atributo do módulo, então `config.X` continua valendo em todo o código
+# (e atribuições feitas antes do carregamento, como em scripts e no benchmark, vencem).
 
 # Detecta se está rodando como executável PyInstaller
 def _get_root_dir():
@@ -28,89 +40,388 @@ def _get_root_dir():
 ROOT_DIR = _get_root_dir()
 BASE_DIR = ROOT_DIR / "src" if not getattr(sys, 'frozen', False) else ROOT_DIR
 
-# Debug: mostra informações sobre o ambiente de execução
 _is_frozen = getattr(sys, 'frozen', False)
-print(f"[config] Modo: {'EXECUTAVEL' if _is_frozen else 'DESENVOLVIMENTO'}", flush=True)
-print(f"[config] ROOT_DIR: {ROOT_DIR}", flush=True)
-print(f"[config] BASE_DIR: {BASE_DIR}", flush=True)
 
-# Carrega variáveis de ambiente do arquivo .env
-# No executável, procura .env no mesmo diretório do EXE
+# No executável, procura .env no mesmo diretório do EXE; em desenvolvimento também em src/
 env_path = ROOT_DIR / ".env"
-print(f"[config] Procurando .env em: {env_path}", flush=True)
-print(f"[config] .env existe? {env_path.exists()}", flush=True)
-
-if env_path.exists():
-    load_dotenv(env_path, override=True)
-    print(f"[config] ✓ Carregado .env de: {env_path}", flush=True)
-else:
-    print(f"[config] ✗ AVISO: Arquivo .env não encontrado em: {env_path}", flush=True)
-    print(f"[config] ✗ COPIE o arquivo .env para o mesmo diretório do executável!", flush=True)
-
-# Tenta carregar .env do diretório src também (para compatibilidade em desenvolvimento)
-if not _is_frozen:
-    src_env = BASE_DIR / ".env"
-    if src_env.exists():
-        load_dotenv(src_env, override=True)
-        print(f"[config] ✓ Carregado .env adicional de: {src_env}", flush=True)
+src_env = BASE_DIR / ".env"
 
-# =========================
-# Config do Banco
-# =========================
-SERVER = os.getenv("DB_SERVER", r"localhost\SQLEXPRESS")  # ex: localhost\SQLEXPRESS ou 10.0.0.5\SQLEXPRESS
-DB     = os.getenv("DB_NAME", "Ame-se")
-USER   = os.getenv("DB_USER")
-PWD    = os.getenv("DB_PASS")
-DRIVER = os.getenv("ODBC_DRIVER", "ODBC Driver 18 for SQL Server")
-
-# Debug: mostra configurações críticas do banco
-print(f"[config] DB_SERVER: {SERVER}", flush=True)
-print(f"[config] DB_NAME: {DB}", flush=True)
-print(f"[config] ODBC_DRIVER: {DRIVER}", flush=True)
-print(f"[config] DB_USER definido: {'Sim' if USER else 'Não'}", flush=True)
-
-POLL_SECONDS     = int(os.getenv("POLL_SECONDS", "5"))
-DEBOUNCE_SECONDS = int(os.getenv("DEBOUNCE_SECONDS", "0"))  # 0 desliga
-# Usa caminho absoluto para FAILED_DIR (importante para rodar como serviço Windows)
-_FAILED_DIR_DEFAULT = str(ROOT_DIR / "completo" / "failed_events")
-FAILED_DIR       = os.getenv("FAILED_DIR", _FAILED_DIR_DEFAULT)
-
-_TERCEIROS_RAW = os.getenv("TERCEIROS")
-if _TERCEIROS_RAW:
-    TERCEIROS = [t.strip() for t in _TERCEIROS_RAW.split(",") if t.strip()]
-else:
-    single = os.getenv("TERCEIRO", "DIAGNÓSTICO DO BRASIL - DB")
-    TERCEIROS = [single] if single else []
-
-TERCEIRO = TERCEIROS[0] if TERCEIROS else ""
-
-os.makedirs(FAILED_DIR, exist_ok=True)
+# Lock compartilhado (monitor x retry_failed.py) dentro do diretório de falhas
+FAILED_LOCK_NAME = ".failed.lock"
 
-# =========================
-# Config Bemsoft
-# =========================
-BASE_URL        = os.getenv("BEMSOFT_BASE_URL", "https://bemsoft.ws.wiselab.com.br")
-REQS_ENDPOINT   = os.getenv("BEMSOFT_ENDPOINT", "/requests")
-TOKEN           = os.getenv("BEMSOFT_TOKEN")
-TIMEOUT         = int(os.getenv("BEMSOFT_TIMEOUT", "30"))
-RETRIES_TOTAL   = int(os.getenv("BEMSOFT_RETRIES", "3"))
-RETRIES_BACKOFF = float(os.getenv("BEMSOFT_BACKOFF", "0.5"))
-VERIFY_TLS      = os.getenv("BEMSOFT_VERIFY", "1") != "0"
-DRY_RUN         = os.getenv("BEMSOFT_DRY_RUN", "0") == "1"
+log = applog.get_logger(__name__)
 
-DEFAULT_GENDER  = (os.getenv("DEFAULT_GENDER") or "").strip().upper()  # "M" ou "F"
-DEFAULT_BIRTH   = os.getenv("DEFAULT_BIRTHDATE")  # "YYYY-MM-DD"
 
-PHYSICIAN_NAME  = os.getenv("PHYSICIAN_NAME")      # opcional
-PHYSICIAN_COUNC = os.getenv("PHYSICIAN_COUNCIL")   # ex "CRM"
-PHYSICIAN_NUM   = os.getenv("PHYSICIAN_NUMBER")
-PHYSICIAN_UF    = os.getenv("PHYSICIAN_UF")
+def _text(env: Mapping[str, str], name: str, default: Optional[str] = None) -> Optional[str]:
+    return env.get(name, default)
 
-_TEST_MAP_PATH  = os.getenv("BEMSOFT_TEST_MAP_PATH")
 
-# =========================
-# Config Google Sheets
-# =========================
-GOOGLE_SHEET_ID    = os.getenv("GOOGLE_SHEET_ID")       # ID da planilha Google Sheets
-GOOGLE_SHEET_RANGE = os.getenv("GOOGLE_SHEET_RANGE", "Sheet1!A:C")  # Range das colunas (padrão: Sheet1!A:C)
-GOOGLE_API_KEY     = os.getenv("GOOGLE_API_KEY")        # API Key do Google Cloud
+def _choice(env: Mapping[str, str], name: str, default: str) -> str:
+    return (env.get(name) or default).strip().lower()
+
+
+def _flag(env: Mapping[str, str], name: str, default: str) -> bool:
+    return env.get(name, default) == "1"
+
+
+def _number(env: Mapping[str, str], name: str, default: str, kind=int, minimum=None):
+    raw = env.get(name, default)
+    try:
+        value = kind(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}={raw!r} não é um número válido") from None
+    return value if minimum is None else max(minimum, value)
+
+
+def lab_slug(name: str) -> str:
+    """Nome do laboratório como sufixo de variável: 'DIAGNÓSTICO DO BRASIL - DB' -> 'DIAGNOSTICO_DO_BRASIL_DB'."""
+    plain = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^A-Z0-9]+", "_", plain.upper()).strip("_")
+
+
+def _lab_overrides(env: Mapping[str, str], labs: List[str]) -> Dict[str, Dict[str, Any]]:
+    overrides = {}
+    for lab in labs:
+        slug = lab_slug(lab)
+        prefix = f"LAB_{slug}_"
+        workers = env.get(prefix + "MAX_WORKERS")
+        rate = env.get(prefix + "RATE")
+        overrides[slug] = {
+            "lab": lab,
+            "base_url": _text(env, prefix + "BASE_URL"),
+            "token": _text(env, prefix + "TOKEN"),
+            "max_workers": _number(env, prefix + "MAX_WORKERS", workers, minimum=1) if workers else None,
+            "rate": _number(env, prefix + "RATE", rate, kind=float, minimum=0.0) if rate else None,
+        }
+    return overrides
+
+
+@dataclass
+class Settings:
+    """Configuração do monitor, lida uma única vez das variáveis de ambiente (.env)."""
+
+    # ===== Banco =====
+    SERVER: str                  # ex: localhost\SQLEXPRESS ou 10.0.0.5\SQLEXPRESS
+    DB: str
+    USER: Optional[str]
+    PWD: Optional[str]
+    DRIVER: str
+    # Backend do banco: "mssql" (produção) ou "sqlite" (arquivo local para testes de carga; ver seed_sqlite.py)
+    DB_BACKEND: str
+    SQLITE_PATH: str
+
+    # ===== Leitura/execução =====
+    POLL_SECONDS: int
+    # Tamanho da página de leitura do ItemSol (TOP n, keyset em CodItemSol)
+    FETCH_PAGE_SIZE: int
+    # Catch-up: máximo de páginas lidas em sequência por ciclo enquanto vierem cheias (1 desliga)
+    CATCHUP_MAX_PAGES: int
+    # Linhas entregues por bloco na leitura em streaming da página (yield_per)
+    FETCH_STREAM_CHUNK: int
+    # Origem das mudanças: "watermark" (keyset por CodItemSol) ou "changetracking" (CHANGETABLE, inserções e alterações)
+    SOURCE_DRIVER: str
+    DEBOUNCE_SECONDS: int        # 0 desliga
+    # Outbox durável por solicitação (dbo._MonitorOutbox) no lugar do debounce em memória
+    OUTBOX_ENABLED: bool
+    OUTBOX_RETENTION_DAYS: int
+    # Prazo da reivindicação das linhas selecionadas para envio (outro monitor só as pega depois)
+    OUTBOX_CLAIM_SECONDS: int
+    # Sharding entre processos: "off" ou "hash" (partições por CodSolicitacao % SHARD_COUNT)
+    SHARD_MODE: str
+    SHARD_COUNT: int
+    # Identidade do processo nas leases de dbo._MonitorState (padrão: host-pid)
+    WORKER_ID: str
+    # Lease sem renovação por este tempo = worker morto; as partições dele são redistribuídas
+    SHARD_LEASE_SECONDS: int
+    # Caminho absoluto de FAILED_DIR (importante para rodar como serviço Windows); criado no startup
+    FAILED_DIR: str
+    # Armazenamento de falhas: "files" (um JSON por falha, legado) ou "log" (segmentos JSON-lines com índice)
+    FAILED_STORE: str
+    FAILED_LOG_DIR: str
+    # Tamanho máximo do segmento ativo antes da rotação; segmentos rotacionados podem ser comprimidos (gzip)
+    FAILED_SEGMENT_MAX_BYTES: int
+    FAILED_SEGMENT_COMPRESS: bool
+    TERCEIROS: List[str]
+    TERCEIRO: str
+    # Índice de cobertura da leitura do ItemSol no startup: "off", "check" (verifica e loga o plano) ou "create"
+    ITEMSOL_INDEX_BOOTSTRAP: str
+    # Índice filtrado pelos TERCEIROS (WHERE NomeTerceirizado IN (...)) e criação ONLINE (Enterprise/Azure)
+    ITEMSOL_INDEX_FILTERED: bool
+    ITEMSOL_INDEX_ONLINE: bool
+    # OPTION (RECOMPILE) na leitura da página (necessário para o otimizador usar o índice filtrado)
+    FETCH_RECOMPILE: bool
+    # Endpoint Prometheus /metrics (0 desliga)
+    METRICS_PORT: int
+    METRICS_ADDR: str
+
+    # ===== Bemsoft =====
+    BASE_URL: str
+    REQS_ENDPOINT: str
+    TOKEN: Optional[str]
+    TIMEOUT: int
+    RETRIES_TOTAL: int
+    RETRIES_BACKOFF: float
+    VERIFY_TLS: bool
+    DRY_RUN: bool
+    # Quantidade máxima de solicitações enviadas em paralelo por ciclo (1 = sequencial)
+    MAX_WORKERS: int
+    # Freio dos POSTs por endpoint: taxa máxima (0 = só a que a API pedir nos cabeçalhos),
+    # concorrência adaptativa (AIMD entre 1 e os workers) e alvo de latência (0 = automático)
+    RATE_PER_SECOND: float
+    ADAPTIVE_CONCURRENCY: bool
+    LATENCY_TARGET_MS: float
+    # Transporte HTTP: "sync" (requests) ou "async" (aiohttp em um event loop dedicado)
+    HTTP_TRANSPORT: str
+    # Pool do transporte assíncrono: conexões no total, por host e keep-alive das conexões ociosas
+    HTTP_POOL_SIZE: int
+    HTTP_PER_HOST: int
+    HTTP_KEEPALIVE_SECONDS: float
+    # Lotes multi-order por POST (1 = uma order por requisição)
+    BATCH_MAX_ORDERS: int
+    BATCH_MAX_BYTES: int
+    # Serialização dos payloads e registros de falha: "auto" (orjson se instalado), "orjson" ou "json"
+    JSON_BACKEND: str
+    # Checkpoint incremental: grava LastItemId a cada N solicitações concluídas ou a cada N segundos
+    CHECKPOINT_EVERY_GROUPS: int
+    CHECKPOINT_EVERY_SECONDS: float
+    # Fila de retentativas em memória para falhas transitórias (0 desliga) e backoff exponencial com jitter
+    RETRY_MAX_ATTEMPTS: int
+    RETRY_BASE_SECONDS: float
+    RETRY_MAX_SECONDS: float
+    # Circuit breaker: abre após N falhas transitórias seguidas (0 desliga) e pausa os envios pelo cooldown
+    BREAKER_FAILURE_THRESHOLD: int
+    BREAKER_COOLDOWN_SECONDS: float
+    BREAKER_MAX_COOLDOWN_SECONDS: float
+    # Pipelines por laboratório: cada terceirizado de TERCEIROS com checkpoint, envio e falhas próprios
+    LAB_PIPELINES: bool
+    # Limite padrão de POSTs por segundo de cada laboratório (0 = sem limite)
+    LAB_RATE_PER_SECOND: float
+    # Ajustes por laboratório, pelo slug do nome (LAB_<SLUG>_BASE_URL, _TOKEN, _MAX_WORKERS, _RATE)
+    LAB_OVERRIDES: Dict[str, Dict[str, Any]]
+    # Slug do laboratório na Idempotency-Key e nos externalId (sol-123-LAB_A); muda as chaves já enviadas
+    LAB_SCOPED_IDS: bool
+
+    DEFAULT_GENDER: str          # "M" ou "F"
+    DEFAULT_BIRTH: Optional[str]  # "YYYY-MM-DD"
+
+    PHYSICIAN_NAME: Optional[str]   # opcional
+    PHYSICIAN_COUNC: Optional[str]  # ex "CRM"
+    PHYSICIAN_NUM: Optional[str]
+    PHYSICIAN_UF: Optional[str]
+
+    # Mapa local CodigoExame -> supportTestId (JSON), lido no primeiro uso
+    TEST_MAP_PATH: Optional[str]
+    # Catálogo GET /tests: snapshot local, TTL do refresh em background e
+    # intervalo mínimo entre refreshes disparados por test_id desconhecido
+    TESTS_CACHE_PATH: str
+    TESTS_CACHE_TTL: float
+    TESTS_MISS_REFRESH_SECONDS: float
+    # Tamanho do LRU de resoluções (test_id, DESCMAT) -> specimen no fallback fuzzy
+    TESTS_RESOLUTION_CACHE_SIZE: int
+
+    # ===== Google Sheets =====
+    GOOGLE_SHEET_ID: Optional[str]      # ID da planilha Google Sheets
+    GOOGLE_SHEET_RANGE: str             # Range das colunas (padrão: Sheet1!A:C)
+    GOOGLE_API_KEY: Optional[str]       # API Key do Google Cloud
+    GOOGLE_SHEETS_API_URL: str
+    # Snapshot local da planilha e intervalo (segundos) do refresh em background (0 desliga)
+    GOOGLE_SHEET_CACHE_PATH: str
+    GOOGLE_SHEET_REFRESH_SECONDS: float
+
+    # Arquivos .env efetivamente carregados (para o log de startup)
+    ENV_FILES: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str], env_files: Tuple[str, ...] = ()) -> "Settings":
+        """Monta as configurações a partir de `env`; ValueError aponta a variável inválida."""
+        terceiros_raw = env.get("TERCEIROS")
+        if terceiros_raw:
+            terceiros = [t.strip() for t in terceiros_raw.split(",") if t.strip()]
+        else:
+            single = env.get("TERCEIRO", "DIAGNÓSTICO DO BRASIL - DB")
+            terceiros = [single] if single else []
+        failed_dir = env.get("FAILED_DIR", str(ROOT_DIR / "completo" / "failed_events"))
+        max_workers = _number(env, "BEMSOFT_MAX_WORKERS", "1", minimum=1)
+        index_filtered = _flag(env, "ITEMSOL_INDEX_FILTERED", "0")
+        return cls(
+            SERVER=env.get("DB_SERVER", r"localhost\SQLEXPRESS"),
+            DB=env.get("DB_NAME", "Ame-se"),
+            USER=_text(env, "DB_USER"),
+            PWD=_text(env, "DB_PASS"),
+            DRIVER=env.get("ODBC_DRIVER", "ODBC Driver 18 for SQL Server"),
+            DB_BACKEND=_choice(env, "DB_BACKEND", "mssql"),
+            SQLITE_PATH=env.get("SQLITE_PATH", str(ROOT_DIR / "completo" / "monitor.sqlite")),
+
+            POLL_SECONDS=_number(env, "POLL_SECONDS", "5"),
+            FETCH_PAGE_SIZE=_number(env, "FETCH_PAGE_SIZE", "500", minimum=1),
+            CATCHUP_MAX_PAGES=_number(env, "CATCHUP_MAX_PAGES", "20", minimum=1),
+            FETCH_STREAM_CHUNK=_number(env, "FETCH_STREAM_CHUNK", "100", minimum=1),
+            SOURCE_DRIVER=_choice(env, "SOURCE_DRIVER", "watermark"),
+            DEBOUNCE_SECONDS=_number(env, "DEBOUNCE_SECONDS", "0"),
+            OUTBOX_ENABLED=_flag(env, "OUTBOX_ENABLED", "0"),
+            OUTBOX_RETENTION_DAYS=_number(env, "OUTBOX_RETENTION_DAYS", "30"),
+            OUTBOX_CLAIM_SECONDS=_number(env, "OUTBOX_CLAIM_SECONDS", "600", minimum=1),
+            SHARD_MODE=_choice(env, "SHARD_MODE", "off"),
+            SHARD_COUNT=_number(env, "SHARD_COUNT", "4", minimum=1),
+            WORKER_ID=env.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}",
+            SHARD_LEASE_SECONDS=_number(env, "SHARD_LEASE_SECONDS", "30", minimum=3),
+            FAILED_DIR=failed_dir,
+            FAILED_STORE=_choice(env, "FAILED_STORE", "files"),
+            FAILED_LOG_DIR=env.get("FAILED_LOG_DIR", os.path.join(failed_dir, "log")),
+            FAILED_SEGMENT_MAX_BYTES=_number(env, "FAILED_SEGMENT_MAX_BYTES", str(16 * 1024 * 1024), minimum=64 * 1024),
+            FAILED_SEGMENT_COMPRESS=_flag(env, "FAILED_SEGMENT_COMPRESS", "1"),
+            TERCEIROS=terceiros,
+            TERCEIRO=terceiros[0] if terceiros else "",
+            ITEMSOL_INDEX_BOOTSTRAP=_choice(env, "ITEMSOL_INDEX_BOOTSTRAP", "off"),
+            ITEMSOL_INDEX_FILTERED=index_filtered,
+            ITEMSOL_INDEX_ONLINE=_flag(env, "ITEMSOL_INDEX_ONLINE", "0"),
+            FETCH_RECOMPILE=_flag(env, "FETCH_RECOMPILE", "1" if index_filtered else "0"),
+            METRICS_PORT=_number(env, "METRICS_PORT", "0"),
+            METRICS_ADDR=env.get("METRICS_ADDR", "0.0.0.0"),
+
+            BASE_URL=env.get("BEMSOFT_BASE_URL", "https://bemsoft.ws.wiselab.com.br"),
+            REQS_ENDPOINT=env.get("BEMSOFT_ENDPOINT", "/requests"),
+            TOKEN=_text(env, "BEMSOFT_TOKEN"),
+            TIMEOUT=_number(env, "BEMSOFT_TIMEOUT", "30"),
+            RETRIES_TOTAL=_number(env, "BEMSOFT_RETRIES", "3"),
+            RETRIES_BACKOFF=_number(env, "BEMSOFT_BACKOFF", "0.5", kind=float),
+            VERIFY_TLS=env.get("BEMSOFT_VERIFY", "1") != "0",
+            DRY_RUN=_flag(env, "BEMSOFT_DRY_RUN", "0"),
+            MAX_WORKERS=max_workers,
+            RATE_PER_SECOND=_number(env, "BEMSOFT_RATE_PER_SECOND", "0", kind=float, minimum=0.0),
+            ADAPTIVE_CONCURRENCY=_flag(env, "BEMSOFT_ADAPTIVE_CONCURRENCY", "1"),
+            LATENCY_TARGET_MS=_number(env, "BEMSOFT_LATENCY_TARGET_MS", "0", kind=float, minimum=0.0),
+            HTTP_TRANSPORT=_choice(env, "BEMSOFT_HTTP_TRANSPORT", "sync"),
+            HTTP_POOL_SIZE=_number(env, "BEMSOFT_HTTP_POOL_SIZE", str(max(10, max_workers)), minimum=1),
+            HTTP_PER_HOST=_number(env, "BEMSOFT_HTTP_PER_HOST", "10", minimum=1),
+            HTTP_KEEPALIVE_SECONDS=_number(env, "BEMSOFT_HTTP_KEEPALIVE", "30", kind=float),
+            BATCH_MAX_ORDERS=_number(env, "BEMSOFT_BATCH_MAX_ORDERS", "1", minimum=1),
+            BATCH_MAX_BYTES=_number(env, "BEMSOFT_BATCH_MAX_BYTES", str(512 * 1024)),
+            JSON_BACKEND=_choice(env, "JSON_BACKEND", "auto"),
+            CHECKPOINT_EVERY_GROUPS=_number(env, "CHECKPOINT_EVERY_GROUPS", "10", minimum=1),
+            CHECKPOINT_EVERY_SECONDS=_number(env, "CHECKPOINT_EVERY_SECONDS", "5", kind=float),
+            RETRY_MAX_ATTEMPTS=_number(env, "BEMSOFT_RETRY_MAX_ATTEMPTS", "6", minimum=0),
+            RETRY_BASE_SECONDS=_number(env, "BEMSOFT_RETRY_BASE_SECONDS", "5", kind=float),
+            RETRY_MAX_SECONDS=_number(env, "BEMSOFT_RETRY_MAX_SECONDS", "600", kind=float),
+            BREAKER_FAILURE_THRESHOLD=_number(env, "BEMSOFT_BREAKER_THRESHOLD", "5", minimum=0),
+            BREAKER_COOLDOWN_SECONDS=_number(env, "BEMSOFT_BREAKER_COOLDOWN", "30", kind=float),
+            BREAKER_MAX_COOLDOWN_SECONDS=_number(env, "BEMSOFT_BREAKER_MAX_COOLDOWN", "600", kind=float),
+            LAB_PIPELINES=_flag(env, "LAB_PIPELINES", "0"),
+            LAB_RATE_PER_SECOND=_number(env, "LAB_RATE_PER_SECOND", "0", kind=float, minimum=0.0),
+            LAB_OVERRIDES=_lab_overrides(env, terceiros),
+            LAB_SCOPED_IDS=_flag(env, "LAB_SCOPED_IDS", "0"),
+
+            DEFAULT_GENDER=(env.get("DEFAULT_GENDER") or "").strip().upper(),
+            DEFAULT_BIRTH=_text(env, "DEFAULT_BIRTHDATE"),
+
+            PHYSICIAN_NAME=_text(env, "PHYSICIAN_NAME"),
+            PHYSICIAN_COUNC=_text(env, "PHYSICIAN_COUNCIL"),
+            PHYSICIAN_NUM=_text(env, "PHYSICIAN_NUMBER"),
+            PHYSICIAN_UF=_text(env, "PHYSICIAN_UF"),
+
+            TEST_MAP_PATH=_text(env, "BEMSOFT_TEST_MAP_PATH"),
+            TESTS_CACHE_PATH=env.get("BEMSOFT_TESTS_CACHE_PATH", str(ROOT_DIR / "cache" / "tests_index.json")),
+            TESTS_CACHE_TTL=_number(env, "BEMSOFT_TESTS_CACHE_TTL", "3600", kind=float),
+            TESTS_MISS_REFRESH_SECONDS=_number(env, "BEMSOFT_TESTS_MISS_REFRESH", "300", kind=float),
+            TESTS_RESOLUTION_CACHE_SIZE=_number(env, "BEMSOFT_TESTS_RESOLUTION_CACHE", "4096", minimum=1),
+
+            GOOGLE_SHEET_ID=_text(env, "GOOGLE_SHEET_ID"),
+            GOOGLE_SHEET_RANGE=env.get("GOOGLE_SHEET_RANGE", "Sheet1!A:C"),
+            GOOGLE_API_KEY=_text(env, "GOOGLE_API_KEY"),
+            GOOGLE_SHEETS_API_URL=env.get("GOOGLE_SHEETS_API_URL", "https://sheets.googleapis.com/v4/spreadsheets"),
+            GOOGLE_SHEET_CACHE_PATH=env.get("GOOGLE_SHEET_CACHE_PATH", str(ROOT_DIR / "cache" / "sheets_snapshot.json")),
+            GOOGLE_SHEET_REFRESH_SECONDS=_number(env, "GOOGLE_SHEET_REFRESH_SECONDS", "600", kind=float),
+
+            ENV_FILES=env_files,
+        )
+
+    def validate(self) -> List[str]:
+        """Problemas de configuração que impedem o monitor de rodar (lista vazia = ok)."""
+        problems = []
+        choices = (
+            ("DB_BACKEND", self.DB_BACKEND, ("mssql", "sqlite")),
+            ("SOURCE_DRIVER", self.SOURCE_DRIVER, ("watermark", "changetracking")),
+            ("SHARD_MODE", self.SHARD_MODE, ("off", "hash")),
+            ("FAILED_STORE", self.FAILED_STORE, ("files", "log")),
+            ("BEMSOFT_HTTP_TRANSPORT", self.HTTP_TRANSPORT, ("sync", "async")),
+            ("JSON_BACKEND", self.JSON_BACKEND, ("auto", "orjson", "json")),
+            ("ITEMSOL_INDEX_BOOTSTRAP", self.ITEMSOL_INDEX_BOOTSTRAP, ("off", "check", "create")),
+        )
+        for name, value, allowed in choices:
+            if value not in allowed:
+                problems.append(f"{name}={value!r} inválido (use {' ou '.join(allowed)})")
+        if self.SHARD_MODE == "hash" and (self.SOURCE_DRIVER != "watermark" or self.OUTBOX_ENABLED):
+            problems.append("SHARD_MODE=hash exige SOURCE_DRIVER=watermark e OUTBOX_ENABLED=0")
+        if self.LAB_PIPELINES:
+            if self.SOURCE_DRIVER != "watermark" or self.OUTBOX_ENABLED or self.SHARD_MODE != "off":
+                problems.append("LAB_PIPELINES=1 exige SOURCE_DRIVER=watermark, OUTBOX_ENABLED=0 e SHARD_MODE=off")
+            if not self.TERCEIROS:
+                problems.append("LAB_PIPELINES=1 exige ao menos um laboratório em TERCEIROS")
+            if len(self.LAB_OVERRIDES) != len(set(self.TERCEIROS)):
+                problems.append("TERCEIROS com nomes que geram o mesmo slug (LAB_<SLUG>_...)")
+            endpoints = [(o["base_url"] or self.BASE_URL, o["token"] or self.TOKEN) for o in self.LAB_OVERRIDES.values()]
+            if not self.LAB_SCOPED_IDS and len(set(endpoints)) != len(endpoints):
+                # Solicitação com itens de dois laboratórios vira duas orders: com a mesma chave, a segunda voltaria 409
+                problems.append("LAB_PIPELINES=1 com laboratórios no mesmo endpoint (URL e token) exige LAB_SCOPED_IDS=1")
+        if not self.DRY_RUN and not self.TOKEN:
+            problems.append("BEMSOFT_TOKEN ausente (configure o token ou ative BEMSOFT_DRY_RUN=1)")
+        if self.DEFAULT_GENDER not in ("", "M", "F"):
+            problems.append(f"DEFAULT_GENDER={self.DEFAULT_GENDER!r} inválido (use M ou F)")
+        if self.DEFAULT_BIRTH:
+            try:
+                datetime.strptime(self.DEFAULT_BIRTH, "%Y-%m-%d")
+            except ValueError:
+                problems.append(f"DEFAULT_BIRTHDATE={self.DEFAULT_BIRTH!r} inválido (use YYYY-MM-DD)")
+        if self.TEST_MAP_PATH and not os.path.isfile(self.TEST_MAP_PATH):
+            problems.append(f"BEMSOFT_TEST_MAP_PATH não encontrado: {self.TEST_MAP_PATH}")
+        if bool(self.GOOGLE_SHEET_ID) != bool(self.GOOGLE_API_KEY):
+            problems.append("GOOGLE_SHEET_ID e GOOGLE_API_KEY precisam ser definidos juntos")
+        return problems
+
+
+_SETTINGS: Optional[Settings] = None
+_SETTINGS_LOCK = threading.RLock()
+
+
+def _load_env_files() -> Tuple[str, ...]:
+    """Carrega o .env da raiz (e, em desenvolvimento, o de src/) com override."""
+    candidates = [env_path] + ([src_env] if not _is_frozen else [])
+    found = tuple(str(p) for p in candidates if p.exists())
+    if found:
+        # Import tardio: sem .env (ex.: variáveis do serviço) o python-dotenv nem é carregado
+        from dotenv import load_dotenv
+        for path in found:
+            load_dotenv(path, override=True)
+    return found
+
+
+def get_settings() -> Settings:
+    """Carrega o .env e monta o Settings na primeira chamada; depois devolve o mesmo objeto."""
+    global _SETTINGS
+    if _SETTINGS is not None:
+        return _SETTINGS
+    with _SETTINGS_LOCK:
+        if _SETTINGS is None:
+            env_files = _load_env_files()
+            # Logging só é configurado depois do .env (LOG_LEVEL/LOG_FORMAT podem vir dele)
+            applog.setup_logging()
+            settings = Settings.from_env(os.environ, env_files)
+            # Atribuições anteriores ao carregamento (scripts/benchmark) têm precedência
+            module = globals()
+            for f in fields(settings):
+                module.setdefault(f.name, getattr(settings, f.name))
+            log.debug("Modo: %s | ROOT_DIR: %s | BASE_DIR: %s | .env: %s",
+                      "EXECUTAVEL" if _is_frozen else "DESENVOLVIMENTO", ROOT_DIR, BASE_DIR,
+                      ", ".join(env_files) or "<nenhum>")
+            _SETTINGS = settings
+    return _SETTINGS
+
+
+def __getattr__(name: str):
+    # Só é chamado para nomes ainda não publicados: dispara o carregamento uma vez
+    if name.startswith("__") or name in globals():
+        raise AttributeError(name)
+    get_settings()
+    if name in globals():
+        return globals()[name]
+    raise AttributeError(f"module 'config' has no attribute {name!r}")
@@ -1,35 +1,204 @@
-from sqlalchemy import create_engine, text
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam, create_engine, event, text
 from sqlalchemy.pool import QueuePool
 from urllib.parse import quote_plus
 
 import config
-raw_odbc = (
-    f"DRIVER={config.DRIVER};"
-    f"SERVER={config.SERVER};"                 
-    f"DATABASE={config.DB};"
-    f"UID={config.USER};PWD={config.PWD};"
-    "Encrypt=yes;TrustServerCertificate=yes"
-)
-params = quote_plus(raw_odbc)
-ENGINE = create_engine(
-    f"mssql+pyodbc:///?odbc_connect={params}",
-    poolclass=QueuePool, pool_pre_ping=True,
-    pool_size=5, max_overflow=2, future=True
-)
 
-SQL_GET_LAST = text("""
+# =========================
+# Backend e dialeto
+# =========================
+# DB_BACKEND=mssql (produção, pyodbc) ou sqlite (arquivo local para testes de carga).
+# No SQLite o arquivo é anexado também como schema "dbo", então os nomes `dbo.Tabela`
+# valem nos dois backends; o que muda entre eles (TOP x LIMIT, hints de lock, data UTC,
+# DDL de bootstrap) vem de dialect() e é aplicado por sql().
+# O backend só é lido no primeiro uso (importar o módulo não carrega o .env): os comandos
+# fixos dos módulos são declarados com statement()/per_backend() e montados na primeira
+# execução, com o dialeto do DB_BACKEND configurado naquele momento.
+
+_DIALECTS = {
+    "mssql": {
+        "top": "TOP (:limit) ",
+        "limit": "",
+        "top1": "TOP (1) ",
+        "limit1": "",
+        "updlock": " WITH (UPDLOCK, ROWLOCK)",
+        "readpast": " WITH (UPDLOCK, READPAST, ROWLOCK)",
+        "utcnow": "SYSUTCDATETIME()",
+    },
+    "sqlite": {
+        "top": "",
+        "limit": "\nLIMIT :limit",
+        "top1": "",
+        "limit1": "\n LIMIT 1",
+        "updlock": "",
+        "readpast": "",
+        "utcnow": "CURRENT_TIMESTAMP",
+    },
+}
+
+
+def backend() -> str:
+    """DB_BACKEND configurado (mssql ou sqlite)."""
+    return config.DB_BACKEND
+
+
+def dialect():
+    # Backend inválido só falha ao conectar (get_engine), para o `main.py --check` poder reportá-lo
+    return _DIALECTS.get(backend(), _DIALECTS["mssql"])
+
+
+def sql(template, **kwargs):
+    """Aplica os fragmentos do dialeto ({top}, {limit}, {updlock}, {utcnow}...) ao template."""
+    return template.format(**dialect(), **kwargs)
+
+
+class PerBackend:
+    """
+    Valor que depende do backend (comando SQL ou lista de comandos), montado por `build`
+    no primeiro uso com cada backend. Repassa atributos ao valor montado, então um
+    comando é aceito direto por conn.execute() e uma lista pode ser iterada.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._values = {}
+
+    def get(self):
+        name = backend()
+        value = self._values.get(name)
+        if value is None:
+            value = self._values[name] = self._build()
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __iter__(self):
+        return iter(self.get())
+
+
+def statement(template, *binds, **fragments):
+    """
+    text(sql(template, **fragments)) montado no primeiro uso. Fragmentos que dependem do
+    backend (ago/ahead) vão como funções; `binds` são os bindparam() do comando.
+    """
+    def build():
+        values = {k: (v() if callable(v) else v) for k, v in fragments.items()}
+        stmt = text(sql(template, **values))
+        return stmt.bindparams(*binds) if binds else stmt
+    return PerBackend(build)
+
+
+def per_backend(values):
+    """Escolhe o valor do backend configurado em {backend: valor} (padrão: o do mssql)."""
+    return PerBackend(lambda: values.get(backend(), values["mssql"]))
+
+
+def ago(param, unit):
+    """Expressão SQL para "agora (UTC) menos :param unidades" (unit: SECOND ou DAY)."""
+    if backend() == "sqlite":
+        return f"datetime('now', '-' || :{param} || ' {unit.lower()}s')"
+    return f"DATEADD({unit.upper()}, -:{param}, SYSUTCDATETIME())"
+
+
+def ahead(param, unit):
+    """Expressão SQL para "agora (UTC) mais :param unidades" (prazo de lease do sharding)."""
+    if backend() == "sqlite":
+        return f"datetime('now', '+' || :{param} || ' {unit.lower()}s')"
+    return f"DATEADD({unit.upper()}, :{param}, SYSUTCDATETIME())"
+
+
+def _build_engine():
+    name = backend()
+    if name not in _DIALECTS:
+        raise RuntimeError(f"DB_BACKEND inválido: {name!r} (use mssql ou sqlite)")
+    if name == "sqlite":
+        path = os.path.abspath(config.SQLITE_PATH)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        engine = create_engine(
+            f"sqlite:///{path}",
+            poolclass=QueuePool, pool_size=5, max_overflow=2, future=True,
+            connect_args={"detect_types": sqlite3.PARSE_DECLTYPES, "check_same_thread": False, "timeout": 30},
+        )
+
+        @event.listens_for(engine, "connect")
+        def _attach_dbo(dbapi_conn, _record):
+            dbapi_conn.execute("ATTACH DATABASE ? AS dbo", (path,))
+            dbapi_conn.execute("PRAGMA dbo.journal_mode=WAL")
+
+        return engine
+
+    raw_odbc = (
+        f"DRIVER={config.DRIVER};"
+        f"SERVER={config.SERVER};"
+        f"DATABASE={config.DB};"
+        f"UID={config.USER};PWD={config.PWD};"
+        "Encrypt=yes;TrustServerCertificate=yes"
+    )
+    params = quote_plus(raw_odbc)
+    return create_engine(
+        f"mssql+pyodbc:///?odbc_connect={params}",
+        poolclass=QueuePool, pool_pre_ping=True,
+        pool_size=5, max_overflow=2, future=True
+    )
+
+
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """Engine compartilhado, criado na primeira consulta (importar o módulo não conecta)."""
+    engine = globals().get("ENGINE")
+    if engine is None:
+        with _ENGINE_LOCK:
+            engine = globals().get("ENGINE")
+            if engine is None:
+                engine = globals()["ENGINE"] = _build_engine()
+    return engine
+
+
+def dispose_engine():
+    """Fecha o engine compartilhado; a próxima consulta cria outro (com o config atual)."""
+    with _ENGINE_LOCK:
+        engine = globals().pop("ENGINE", None)
+    if engine is not None:
+        engine.dispose()
+
+
+def __getattr__(name):
+    # `database.ENGINE` continua valendo para quem ainda acessa o atributo diretamente
+    if name == "ENGINE":
+        return get_engine()
+    # BACKEND/DIALECT: lidos do config a cada acesso (não no import)
+    if name == "BACKEND":
+        return backend()
+    if name == "DIALECT":
+        return dialect()
+    raise AttributeError(f"module 'database' has no attribute {name!r}")
+
+SQL_GET_LAST = statement("""
 SELECT LastItemId
-FROM dbo._MonitorState WITH (UPDLOCK, ROWLOCK)
+FROM dbo._MonitorState{updlock}
 WHERE Name = 'ItemSolMonitor';
 """)
 
-SQL_SET_LAST = text("""
+# Nunca regride: checkpoints incrementais podem chegar fora de ordem
+SQL_SET_LAST = statement("""
 UPDATE dbo._MonitorState
-   SET LastItemId = :last, UpdatedAt = SYSUTCDATETIME()
- WHERE Name = 'ItemSolMonitor';
+   SET LastItemId = :last, UpdatedAt = {utcnow}
+ WHERE Name = 'ItemSolMonitor'
+   AND (LastItemId IS NULL OR LastItemId < :last);
 """)
 
-SQL_BOOTSTRAP = [
+_SQL_BOOTSTRAP = {
+    "mssql": [
 text("""
 IF OBJECT_ID('dbo._MonitorState','U') IS NULL
 BEGIN
@@ -42,11 +211,60 @@ END;"""),
 text("""
 IF NOT EXISTS (SELECT 1 FROM dbo._MonitorState WHERE Name='ItemSolMonitor')
   INSERT INTO dbo._MonitorState (Name, LastItemId) VALUES ('ItemSolMonitor', 0);
+"""),
+    ],
+    "sqlite": [
+text("""
+CREATE TABLE IF NOT EXISTS dbo._MonitorState (
+  Name TEXT NOT NULL PRIMARY KEY,
+  LastItemId INTEGER NULL,
+  UpdatedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);"""),
+text("""
+INSERT OR IGNORE INTO dbo._MonitorState (Name, LastItemId) VALUES ('ItemSolMonitor', 0);
+"""),
+    ],
+}
+SQL_BOOTSTRAP = per_backend(_SQL_BOOTSTRAP)
+
+# Checkpoints nomeados (partições do sharding, pipelines por laboratório). Uma linha nova
+# começa no menor checkpoint conhecido (o legado ou de outra divisão): pode reenviar itens
+# já enviados (a API responde 409), nunca pular itens
+_SQL_CREATE_CHECKPOINT = {
+    "mssql": text("""
+IF NOT EXISTS (SELECT 1 FROM dbo._MonitorState WHERE Name = :name)
+  INSERT INTO dbo._MonitorState (Name, LastItemId)
+  SELECT :name, COALESCE(MIN(LastItemId), 0) FROM dbo._MonitorState WHERE Name LIKE 'ItemSolMonitor%';
+"""),
+    "sqlite": text("""
+INSERT OR IGNORE INTO dbo._MonitorState (Name, LastItemId)
+SELECT :name, COALESCE(MIN(LastItemId), 0) FROM dbo._MonitorState WHERE Name LIKE 'ItemSolMonitor%';
+"""),
+}
+SQL_CREATE_CHECKPOINT = per_backend(_SQL_CREATE_CHECKPOINT)
+
+# Menor checkpoint de um conjunto de linhas (laboratórios, partições); Checkpoints conta só as já gravadas
+SQL_MIN_LAST = text("""
+SELECT MIN(LastItemId) AS MinLast, COUNT(LastItemId) AS Checkpoints
+FROM dbo._MonitorState
+WHERE Name IN :names;
+""").bindparams(bindparam("names", expanding=True))
+
+SQL_GET_LAST_NAMED = statement("""
+SELECT LastItemId
+FROM dbo._MonitorState{updlock}
+WHERE Name = :name;
+""")
+
+SQL_SET_LAST_NAMED = statement("""
+UPDATE dbo._MonitorState
+   SET LastItemId = :last, UpdatedAt = {utcnow}
+ WHERE Name = :name
+   AND (LastItemId IS NULL OR LastItemId < :last);
 """)
-]
 
-SQL_FETCH_TEMPLATE = """
-SELECT TOP (500)
+# Colunas/joins compartilhados pelas consultas de itens (página por CodItemSol e outbox)
+SQL_FETCH_COLUMNS = """
     i.CodItemSol, i.CodSolicitacao, i.DataEntrada, i.DescExames, i.CodConvExames,
     i.NomeTerceirizado, i.Valor, i.VlTerceirizado, i.SituacaoResultado, i.Origem,
 
@@ -62,14 +280,92 @@ FROM dbo.ItemSol i
 JOIN dbo.solicitacao s ON s.codsolicitacao = i.CodSolicitacao
 LEFT JOIN dbo.paciente p ON p.codpaciente = s.codpaciente
 LEFT JOIN dbo.texame te ON te.CodTexame = i.CodTExame
-WHERE
+"""
+
+SQL_FETCH_TEMPLATE = "\nSELECT {top}" + SQL_FETCH_COLUMNS + """WHERE
     i.CodItemSol > :last
 {terceiro_clause}
+ORDER BY i.CodItemSol ASC{limit}{query_hint};
+"""
+
+# Itens de um conjunto de solicitações (envio dirigido pelo outbox)
+SQL_FETCH_BY_SOL_TEMPLATE = "\nSELECT" + SQL_FETCH_COLUMNS + """WHERE
+    i.CodSolicitacao IN :sols
+{terceiro_clause}
 ORDER BY i.CodItemSol ASC;
 """
 
 
-def _build_fetch_query(terceiros):
+# Lag do monitor: maior item elegível e data de entrada do item pendente mais antigo
+SQL_LAG_TEMPLATE = """
+SELECT
+    (SELECT MAX(i.CodItemSol)
+       FROM dbo.ItemSol i
+      WHERE 1 = 1
+{terceiro_clause}    ) AS MaxItemId,
+    (SELECT {top1}i.DataEntrada
+       FROM dbo.ItemSol i
+      WHERE i.CodItemSol > :last
+{terceiro_clause}      ORDER BY i.CodItemSol ASC{limit1}) AS OldestPending;
+"""
+
+
+# Ordem das colunas de SQL_FETCH_COLUMNS (posição de cada campo em ItemRow)
+ITEM_COLUMNS = (
+    "CodItemSol", "CodSolicitacao", "DataEntrada", "DescExames", "CodConvExames",
+    "NomeTerceirizado", "Valor", "VlTerceirizado", "SituacaoResultado", "Origem",
+    "codpaciente", "CodConvenio", "Sol_dtaentrada", "Hora", "Valortotal", "TipoPgto", "Obs_Sol",
+    "PacienteNome", "PacienteCPF", "PacienteNascimento",
+    "PacienteFone", "PacienteEmail", "PacienteCidade", "PacienteUF",
+    "PacienteSexo",
+    "CodigoExame", "ExameDescricao",
+)
+_ITEM_INDEX = {name: pos for pos, name in enumerate(ITEM_COLUMNS)}
+
+
+class ItemRow(tuple):
+    """
+    Linha de item compacta: uma tupla (sem __dict__) com acesso por nome de coluna
+    (`row["CodItemSol"]`, `row.get("ExameDescricao")`), como um RowMapping.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return tuple.__getitem__(self, _ITEM_INDEX[key])
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        pos = _ITEM_INDEX.get(key)
+        return default if pos is None else tuple.__getitem__(self, pos)
+
+    def keys(self):
+        return ITEM_COLUMNS
+
+    def as_dict(self):
+        return dict(zip(ITEM_COLUMNS, self))
+
+
+# Parâmetros por lista em `IN :lista` (expanding): o SQL Server aceita até 2100 por comando
+IN_CHUNK = 1000
+
+
+def chunked(values, size=None):
+    """Divide `values` em listas de até `size` (padrão IN_CHUNK) elementos, para consultas `IN :lista`."""
+    values = list(values)
+    size = int(size or IN_CHUNK)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def _build_terceiro_clause(terceiros, shard=None):
+    """
+    Filtro por terceirizado e, opcionalmente, por partição `shard=(índice, total)` do
+    sharding por hash (CodSolicitacao % total = índice: a solicitação inteira cai na mesma).
+    """
     clause = ""
     params = {}
     terceiros = [t for t in (terceiros or []) if t]
@@ -85,18 +381,153 @@ def _build_fetch_query(terceiros):
             clause = (
                 "    AND i.NomeTerceirizado IN (" + ", ".join(placeholders) + ")\n"
             )
-    sql = SQL_FETCH_TEMPLATE.format(terceiro_clause=clause)
-    return text(sql), params
+    if shard:
+        clause += "    AND i.CodSolicitacao % :shard_count = :shard_index\n"
+        params["shard_index"], params["shard_count"] = int(shard[0]), int(shard[1])
+    return clause, params
 
 
-def fetch_items(conn, last, terceiros):
-    stmt, extra_params = _build_fetch_query(terceiros)
-    params = {"last": last}
+def _build_fetch_query(terceiros, shard=None):
+    clause, params = _build_terceiro_clause(terceiros, shard)
+    # Índice filtrado por terceirizado só é usado com o valor dos parâmetros embutido no plano
+    hint = "\nOPTION (RECOMPILE)" if config.FETCH_RECOMPILE and backend() == "mssql" else ""
+    return text(sql(SQL_FETCH_TEMPLATE, terceiro_clause=clause, query_hint=hint)), params
+
+
+def _stream_rows(conn, stmt, params, chunk=None):
+    """
+    Executa a consulta de itens em modo streaming (yield_per: o driver entrega blocos de
+    `chunk` linhas) e gera ItemRow à medida que as linhas chegam, sem materializar a página.
+    """
+    chunk = int(chunk or config.FETCH_STREAM_CHUNK)
+    result = conn.execution_options(yield_per=chunk).execute(stmt, params)
+    keys = tuple(result.keys())
+    order = None if keys == ITEM_COLUMNS else [keys.index(c) for c in ITEM_COLUMNS]
+    for partition in result.partitions():
+        if order is None:
+            for row in partition:
+                yield ItemRow(row)
+        else:
+            for row in partition:
+                yield ItemRow(row[i] for i in order)
+
+
+def iter_items(conn, last, terceiros, limit=None, chunk=None, shard=None):
+    """Gera os itens (ItemRow) de uma página (keyset em CodItemSol) de até `limit` itens após `last`."""
+    stmt, extra_params = _build_fetch_query(terceiros, shard)
+    params = {"last": last, "limit": int(limit or config.FETCH_PAGE_SIZE)}
     params.update(extra_params)
-    return conn.execute(stmt, params).mappings().all()
+    return _stream_rows(conn, stmt, params, chunk)
+
+
+def fetch_items(conn, last, terceiros, limit=None):
+    """Busca uma página (keyset em CodItemSol) de até `limit` itens após `last`."""
+    return list(iter_items(conn, last, terceiros, limit))
+
+
+def fetch_items_for_solicitacoes(conn, sols, terceiros):
+    """
+    Busca todos os itens (filtrados por terceirizado) das solicitações informadas, em
+    ordem de CodItemSol. Listas longas vão em blocos de IN_CHUNK solicitações.
+    """
+    if not sols:
+        return []
+    clause, params = _build_terceiro_clause(terceiros)
+    stmt = text(sql(SQL_FETCH_BY_SOL_TEMPLATE, terceiro_clause=clause)).bindparams(
+        bindparam("sols", expanding=True)
+    )
+    blocks = chunked(sols)
+    rows = []
+    for block in blocks:
+        rows.extend(_stream_rows(conn, stmt, dict(params, sols=block)))
+    if len(blocks) > 1:
+        rows.sort(key=lambda r: r["CodItemSol"])
+    return rows
+
+
+def fetch_lag(conn, last, terceiros, shard=None):
+    """Retorna (MaxItemId, DataEntrada do item pendente mais antigo) para medir o atraso."""
+    clause, params = _build_terceiro_clause(terceiros, shard)
+    stmt = text(sql(SQL_LAG_TEMPLATE, terceiro_clause=clause))
+    params = dict(params, last=last)
+    row = conn.execute(stmt, params).mappings().first()
+    if not row:
+        return None, None
+    oldest = row["OldestPending"]
+    if isinstance(oldest, str):
+        # SQLite não converte colunas de subconsulta (sem tipo declarado)
+        try:
+            oldest = datetime.fromisoformat(oldest)
+        except ValueError:
+            oldest = None
+    return row["MaxItemId"], oldest
+
+
+def claim_page(terceiros, limit=None):
+    """
+    Transação curta: lê o checkpoint (UPDLOCK) e a próxima página de itens e libera a conexão.
+    Nenhum lock ou conexão do pool fica preso durante as chamadas HTTP.
+    """
+    with get_engine().begin() as conn:
+        last = conn.execute(SQL_GET_LAST).scalar() or 0
+        rows = fetch_items(conn, last, terceiros, limit)
+    return last, rows
+
+
+def claim_groups(terceiros, limit=None, item_factory=None):
+    """
+    Como claim_page, mas agrupa por CodSolicitacao enquanto as linhas chegam (streaming).
+    A primeira linha de cada solicitação é o "head"; cada linha entra nos itens como
+    `item_factory(row)` (padrão: o próprio ItemRow, sem cópia). Pelo ORDER BY CodItemSol,
+    os grupos saem na ordem do primeiro item.
+    Retorna (last, linhas lidas, {CodSolicitacao: {"head", "items"}}).
+    """
+    with get_engine().begin() as conn:
+        last = conn.execute(SQL_GET_LAST).scalar() or 0
+        count, groups = group_rows(iter_items(conn, last, terceiros, limit), item_factory)
+    return last, count, groups
+
+
+def group_rows(rows, item_factory=None):
+    """Agrupa linhas por CodSolicitacao na ordem de chegada; retorna (linhas lidas, grupos)."""
+    factory = item_factory or (lambda row: row)
+    groups = {}
+    count = 0
+    for row in rows:
+        count += 1
+        cod = row["CodSolicitacao"]
+        group = groups.get(cod)
+        if group is None:
+            group = groups[cod] = {"head": row, "items": []}
+        group["items"].append(factory(row))
+    return count, groups
+
+
+def commit_checkpoint(last):
+    """Grava o checkpoint em uma transação própria (idempotente e monotônico)."""
+    with get_engine().begin() as conn:
+        conn.execute(SQL_SET_LAST, {"last": last})
 
 
 def bootstrap_state():
-    with ENGINE.begin() as conn:
+    with get_engine().begin() as conn:
         for q in SQL_BOOTSTRAP:
             conn.execute(q)
+
+
+def follow_checkpoints(conn, names):
+    """
+    Avança o checkpoint legado ('ItemSolMonitor') até o menor checkpoint de `names` (só com
+    todas as linhas já gravadas), na transação de `conn`: ao voltar para a leitura única,
+    o monitor continua de onde o fluxo mais atrasado parou.
+    """
+    row = conn.execute(SQL_MIN_LAST, {"names": list(names)}).mappings().first()
+    if row and row["Checkpoints"] == len(names) and row["MinLast"] is not None:
+        conn.execute(SQL_SET_LAST, {"last": row["MinLast"]})
+
+
+def create_checkpoints(names):
+    """Cria (se faltarem) as linhas de checkpoint nomeadas em dbo._MonitorState."""
+    with get_engine().begin() as conn:
+        for name in names:
+            conn.execute(SQL_CREATE_CHECKPOINT, {"name": name})
@@ -0,0 +1,405 @@
+import os
+import gzip
+import json
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+import config
+import applog
+import bemsoft_api
+import jsoncodec
+from filelock import FileLock
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Log de falhas em segmentos
+# =========================
+# Alternativa ao "um arquivo JSON por falha" (FAILED_STORE=log). Cada falha é uma linha
+# JSON compacta anexada ao segmento ativo (failures-000001.jsonl, fsync por escrita).
+# Ao passar de FAILED_SEGMENT_MAX_BYTES o segmento é rotacionado (e comprimido em .gz).
+# Os segmentos são a fonte da verdade; index.json é só um checkpoint do índice em memória
+# {chave da falha -> posição do registro mais recente}, então falhas repetidas da mesma
+# order ocupam uma única entrada (com os itens das falhas anteriores que a nova não tem).
+# A chave (failure_key) é a solicitação, mais a revisão e o laboratório quando houver
+# (mesmo com LAB_SCOPED_IDS=0, em que o laboratório não entra na Idempotency-Key), então as orders de dois laboratórios para a mesma solicitação
+# (LAB_PIPELINES=1) não se substituem. Um envio bem-sucedido grava um registro
+# {"op": "resolve"} que remove a entrada. Monitor e retry_failed.py escrevem no mesmo
+# log sob o lock de arquivo do diretório.
+
+SEGMENT_PREFIX = "failures-"
+SEGMENT_SUFFIX = ".jsonl"
+INDEX_NAME = "index.json"
+INDEX_EVERY = 100  # grava o checkpoint do índice a cada N registros
+
+# Entrada do índice: [segmento, offset, ts, tentativas, motivo]
+_SEG, _OFF, _TS, _COUNT, _REASON = range(5)
+
+
+def failure_key(event: Dict[str, Any]) -> str:
+    """
+    Chave da falha de um evento: "123", "123-r9", "123-LAB_A" (também no nome dos arquivos de falha).
+    Leva sempre o laboratório do pipeline, mesmo quando a Idempotency-Key não o leva (LAB_SCOPED_IDS=0).
+    """
+    solicitacao = event.get("solicitacao", {})
+    if solicitacao.get("codsolicitacao") is None:
+        return "unknown"
+    key = bemsoft_api._idemp_key(solicitacao["codsolicitacao"], event.get("revisao"), event.get("lab"))
+    return key[len("sol-"):]
+
+
+def item_ids(event: Dict[str, Any]) -> Set[str]:
+    """CodItemSol dos itens de um evento (como texto, para comparar eventos lidos de JSON)."""
+    return {str(it.get("CodItemSol")) for it in (event.get("itens") or [])}
+
+
+def merge_events(older: Dict[str, Any], newer: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    `newer` acrescido dos itens de `older` que ele não tem (falhas da mesma solicitação em
+    ciclos diferentes). Sem itens a acrescentar, devolve o próprio `newer`.
+    """
+    known = item_ids(newer)
+    extra = [it for it in (older.get("itens") or []) if str(it.get("CodItemSol")) not in known]
+    if not extra:
+        return newer
+    merged = dict(newer)
+    merged["itens"] = extra + list(newer.get("itens") or [])
+    return merged
+
+
+def _segment_number(name: str) -> Optional[int]:
+    if not name.startswith(SEGMENT_PREFIX):
+        return None
+    rest = name[len(SEGMENT_PREFIX):]
+    if rest.endswith(".gz"):
+        rest = rest[:-3]
+    if not rest.endswith(SEGMENT_SUFFIX):
+        return None
+    digits = rest[:-len(SEGMENT_SUFFIX)]
+    return int(digits) if digits.isdigit() else None
+
+
+class FailureLog:
+    def __init__(self, directory: Optional[str] = None, max_bytes: Optional[int] = None,
+                 compress: Optional[bool] = None):
+        self.dir = directory or config.FAILED_LOG_DIR
+        self.max_bytes = max_bytes or config.FAILED_SEGMENT_MAX_BYTES
+        self.compress = config.FAILED_SEGMENT_COMPRESS if compress is None else compress
+        os.makedirs(self.dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._flock = FileLock(os.path.join(self.dir, config.FAILED_LOCK_NAME))
+        self._entries: Dict[str, List[Any]] = {}
+        self._seg = 0   # segmento ativo conhecido
+        self._pos = 0   # bytes já aplicados do segmento ativo
+        self._dirty = 0
+        with self._locked():
+            self._load_index()
+
+    # ===== Segmentos =====
+    def _path(self, seg: int, compressed: bool = False) -> str:
+        name = f"{SEGMENT_PREFIX}{seg:06d}{SEGMENT_SUFFIX}"
+        return os.path.join(self.dir, name + (".gz" if compressed else ""))
+
+    def _existing_path(self, seg: int) -> Optional[str]:
+        for compressed in (False, True):
+            path = self._path(seg, compressed)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _segments(self) -> List[int]:
+        numbers = {_segment_number(n) for n in os.listdir(self.dir)}
+        numbers.discard(None)
+        return sorted(numbers)  # type: ignore[arg-type]
+
+    def _open_read(self, path: str):
+        return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+    def _scan(self, seg: int, start: int) -> int:
+        """Aplica os registros de `seg` a partir de `start`; retorna o offset do fim consistente."""
+        path = self._existing_path(seg)
+        if path is None:
+            return start
+        pos = start
+        with self._open_read(path) as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # escrita interrompida: a linha parcial é ignorada
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    log.warning("registro inválido em %s@%d ignorado", os.path.basename(path), pos)
+                else:
+                    self._apply(rec, seg, pos)
+                pos += len(line)
+        return pos
+
+    def _apply(self, rec: Dict[str, Any], seg: int, offset: int):
+        cod = str(rec.get("cod"))
+        if rec.get("op") == "resolve":
+            entry = self._entries.get(cod)
+            if entry is not None and entry[_TS] == rec.get("ts"):
+                del self._entries[cod]
+            return
+        self._entries[cod] = [seg, offset, rec.get("ts"), rec.get("count") or 1, rec.get("reason")]
+
+    def _reset(self):
+        self._entries = {}
+        self._seg = 0
+        self._pos = 0
+
+    def _sync(self):
+        """Alcança o que outro processo anexou/rotacionou desde a última leitura."""
+        segments = self._segments()
+        if self._seg and self._seg not in segments and any(s > self._seg for s in segments):
+            # Segmento conhecido sumiu (compactação por outro processo): relê tudo
+            self._reset()
+        for seg in segments:
+            if seg < self._seg:
+                continue
+            start = self._pos if seg == self._seg else 0
+            self._pos = self._scan(seg, start)
+            self._seg = seg
+        if not segments:
+            self._seg, self._pos = 1, 0
+            open(self._path(1), "ab").close()
+            return
+        self._truncate_partial()
+
+    def _truncate_partial(self):
+        """
+        Descarta a linha parcial no fim do segmento ativo (escrita interrompida por um crash).
+        Sem isso o próximo registro seria anexado depois do fragmento e ficaria ilegível.
+        """
+        path = self._path(self._seg)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        if size > self._pos:
+            log.warning("linha parcial de %d byte(s) descartada no fim de %s", size - self._pos, os.path.basename(path))
+            with open(path, "r+b") as f:
+                f.truncate(self._pos)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # ===== Índice =====
+    def _load_index(self):
+        path = os.path.join(self.dir, INDEX_NAME)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if self._existing_path(int(data["segment"])) is None:
+                raise ValueError("segmento do índice não existe mais")
+            self._entries = {str(k): list(v) for k, v in data["entries"].items()}
+            self._seg = int(data["segment"])
+            self._pos = int(data["offset"])
+        except FileNotFoundError:
+            self._reset()
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("índice de falhas inválido (%s); reconstruindo a partir dos segmentos", e)
+            self._reset()
+        self._sync()
+
+    def _save_index(self):
+        path = os.path.join(self.dir, INDEX_NAME)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "segment": self._seg, "offset": self._pos, "entries": self._entries},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)
+        self._dirty = 0
+
+    @contextmanager
+    def _locked(self):
+        # Lock de thread antes do lock de arquivo: o FileLock não é reentrante entre threads
+        with self._lock, self._flock:
+            yield
+
+    # ===== Escrita =====
+    def _write(self, rec: Dict[str, Any], default: Optional[Callable[[Any], Any]] = None):
+        line = jsoncodec.dumps(rec, default=default) + b"\n"
+        self._sync()
+        if self._pos > 0 and self._pos + len(line) > self.max_bytes:
+            self._rotate()
+        with open(self._path(self._seg), "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._apply(rec, self._seg, self._pos)
+        self._pos += len(line)
+        self._dirty += 1
+        if self._dirty >= INDEX_EVERY:
+            self._save_index()
+
+    def _rotate(self):
+        old = self._seg
+        if self.compress:
+            src = self._path(old)
+            dst = self._path(old, compressed=True)
+            with open(src, "rb") as fin, gzip.open(dst + ".tmp", "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+            os.replace(dst + ".tmp", dst)
+            os.remove(src)
+        self._seg, self._pos = old + 1, 0
+        open(self._path(self._seg), "ab").close()
+        self._drop_dead_prefix()
+        self._save_index()
+        log.info("log de falhas rotacionado: segmento %d -> %d", old, self._seg)
+
+    def _drop_dead_prefix(self):
+        # Só remove segmentos antigos em sequência: um "resolve" num segmento posterior
+        # ainda precisa existir enquanto houver segmentos anteriores no replay
+        live = {e[_SEG] for e in self._entries.values()}
+        for seg in self._segments():
+            if seg >= self._seg or seg in live:
+                break
+            path = self._existing_path(seg)
+            if path:
+                os.remove(path)
+
+    # ===== API =====
+    def append(self, event: Dict[str, Any], reason: str = "",
+               default: Optional[Callable[[Any], Any]] = None) -> str:
+        """
+        Registra (ou atualiza) a falha da order do evento (failure_key). Retorna o ts do registro.
+        Se a falha anterior em aberto tem itens que o evento não tem (itens chegados em ciclos
+        diferentes), eles são acrescentados ao evento: a entrada substituída não perde itens.
+        """
+        cod = failure_key(event)
+        ts = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        with self._locked():
+            self._sync()
+            previous = self._entries.get(str(cod))
+            if previous is not None:
+                older = self._read_at(previous[_SEG], previous[_OFF])
+                if older is not None:
+                    event = merge_events(older.get("event") or {}, event)
+            # O número de tentativas vai no próprio registro: o replay não depende de segmentos já removidos
+            count = (previous[_COUNT] if previous else 0) + 1
+            rec = {"ts": ts, "cod": str(cod), "count": count, "reason": reason, "event": event}
+            self._write(rec, default=default)
+        return ts
+
+    def resolve(self, cod: Any, ts: str, items: Optional[Set[str]] = None) -> bool:
+        """
+        Remove a falha se ainda for a versão `ts` (não houve falha mais nova no meio) e, se
+        `items` (CodItemSol entregues) for informado, se o registro não tiver outros itens.
+        """
+        with self._locked():
+            self._sync()
+            entry = self._entries.get(str(cod))
+            if entry is None or entry[_TS] != ts:
+                return False
+            if items is not None:
+                rec = self._read_at(entry[_SEG], entry[_OFF])
+                if rec is not None and not item_ids(rec.get("event") or {}) <= set(items):
+                    log.info("falha %s mantida: o registro tem itens de falhas anteriores não reenviados", cod)
+                    return False
+            self._write({"op": "resolve", "cod": str(cod), "ts": ts})
+            return True
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """Falhas em aberto (uma por chave de falha), da mais antiga para a mais nova."""
+        with self._locked():
+            self._sync()
+            items = [
+                {"cod": cod, "ts": e[_TS], "count": e[_COUNT], "reason": e[_REASON]}
+                for cod, e in self._entries.items()
+            ]
+        return sorted(items, key=lambda x: x["ts"] or "")
+
+    def read(self, cod: Any) -> Optional[Dict[str, Any]]:
+        """Registro completo mais recente da chave `cod` ({ts, cod, reason, event, count})."""
+        with self._locked():
+            self._sync()
+            entry = self._entries.get(str(cod))
+            if entry is None:
+                return None
+            rec = self._read_at(entry[_SEG], entry[_OFF])
+        if rec is not None:
+            rec["count"] = entry[_COUNT]
+        return rec
+
+    def _read_at(self, seg: int, offset: int) -> Optional[Dict[str, Any]]:
+        path = self._existing_path(seg)
+        if path is None:
+            return None
+        with self._open_read(path) as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def __len__(self) -> int:
+        with self._locked():
+            self._sync()
+            return len(self._entries)
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        for item in self.pending():
+            rec = self.read(item["cod"])
+            if rec is not None:
+                yield rec
+
+    def compact(self) -> int:
+        """Reescreve só as entradas vivas em um segmento novo e apaga os anteriores."""
+        with self._locked():
+            self._sync()
+            target = self._seg + 1
+            path = self._path(target)
+            new_entries: Dict[str, List[Any]] = {}
+            pos = 0
+            with open(path, "wb") as f:
+                for cod, e in sorted(self._entries.items(), key=lambda kv: kv[1][_TS] or ""):
+                    rec = self._read_at(e[_SEG], e[_OFF])
+                    if rec is None:
+                        continue
+                    line = jsoncodec.dumps(rec) + b"\n"
+                    f.write(line)
+                    new_entries[cod] = [target, pos, e[_TS], e[_COUNT], e[_REASON]]
+                    pos += len(line)
+                f.flush()
+                os.fsync(f.fileno())
+            for seg in self._segments():
+                if seg < target:
+                    os.remove(self._existing_path(seg))  # type: ignore[arg-type]
+            self._entries, self._seg, self._pos = new_entries, target, pos
+            self._save_index()
+            log.info("log de falhas compactado: %d entrada(s) no segmento %d", len(new_entries), target)
+            return len(new_entries)
+
+    def export_legacy(self, dest_dir: str, resolve: bool = False) -> int:
+        """Exporta cada falha aberta no formato legado (<ts>_<cod>.json com reason/event)."""
+        os.makedirs(dest_dir, exist_ok=True)
+        exported = 0
+        for rec in self.records():
+            path = os.path.join(dest_dir, f"{rec['ts']}_{rec['cod']}.json")
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"reason": rec.get("reason", ""), "event": rec.get("event")},
+                                   ensure_ascii=False, indent=2))
+            os.replace(tmp, path)
+            if resolve:
+                self.resolve(rec["cod"], rec["ts"])
+            exported += 1
+        return exported
+
+    def close(self):
+        with self._locked():
+            if self._dirty:
+                self._save_index()
+
+
+_STORE: Optional[FailureLog] = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store() -> FailureLog:
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None:
+            _STORE = FailureLog()
+        return _STORE
@@ -0,0 +1,88 @@
+import os
+import time
+from typing import Optional
+
+# =========================
+# Lock de arquivo entre processos (Windows e POSIX)
+# =========================
+# Usado para coordenar o monitor (que grava falhas em FAILED_DIR) e o
+# reprocessador retry_failed.py (que lê, reenvia e move esses arquivos).
+
+if os.name == "nt":
+    import msvcrt
+
+    def _lock(fd: int, blocking: bool) -> bool:
+        mode = msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, mode, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _lock(fd: int, blocking: bool) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    """
+    Lock exclusivo baseado em arquivo. Uso:
+
+        with FileLock(path):            # bloqueia até `timeout` segundos
+            ...
+        lock = FileLock(path)
+        if lock.acquire(blocking=False):  # tenta uma vez
+            ...
+    """
+
+    def __init__(self, path: str, timeout: Optional[float] = 30.0, poll: float = 0.05):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self._fd: Optional[int] = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            if _lock(fd, blocking=False):
+                self._fd = fd
+                return True
+            if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                os.close(fd)
+                return False
+            time.sleep(self.poll)
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            _unlock(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError(f"não foi possível obter o lock {self.path}")
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
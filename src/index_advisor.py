@@ -0,0 +1,240 @@
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+
+import applog
+import config
+import database
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Índice de cobertura do ItemSol e plano da consulta de leitura
+# =========================
+# A leitura do monitor filtra `CodItemSol > :last AND NomeTerceirizado IN (...)` e faz
+# join com solicitacao/paciente/texame. O índice (NomeTerceirizado, CodItemSol) INCLUDE
+# (demais colunas lidas do ItemSol) transforma essa leitura em seeks por terceirizado,
+# sem key lookup. Opcionalmente o índice é filtrado pelos TERCEIROS configurados; nesse
+# caso a consulta usa OPTION (RECOMPILE), porque o otimizador só casa um índice filtrado
+# com predicados literais (não com parâmetros).
+# `explain_fetch()` executa a leitura com SET STATISTICS XML ON e resume o plano real.
+
+INDEX_NAME = "IX_ItemSol_Monitor_Terceirizado"
+KEY_COLUMNS = ("NomeTerceirizado", "CodItemSol")
+INCLUDE_COLUMNS = (
+    "CodSolicitacao", "DataEntrada", "DescExames", "CodConvExames", "Valor",
+    "VlTerceirizado", "SituacaoResultado", "Origem", "CodTExame",
+)
+
+SHOWPLAN_NS = {"p": "http://schemas.microsoft.com/sqlserver/2004/07/showplan"}
+
+# Índices do ItemSol cuja chave começa por (NomeTerceirizado, CodItemSol)
+SQL_FIND_INDEXES = text("""
+SELECT ix.name AS IndexName, ix.has_filter AS HasFilter, ix.filter_definition AS FilterDefinition,
+       STUFF((SELECT ',' + c.name
+                FROM sys.index_columns ic
+                JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+               WHERE ic.object_id = ix.object_id AND ic.index_id = ix.index_id AND ic.is_included_column = 0
+               ORDER BY ic.key_ordinal
+                 FOR XML PATH('')), 1, 1, '') AS KeyColumns,
+       STUFF((SELECT ',' + c.name
+                FROM sys.index_columns ic
+                JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+               WHERE ic.object_id = ix.object_id AND ic.index_id = ix.index_id AND ic.is_included_column = 1
+                 FOR XML PATH('')), 1, 1, '') AS IncludedColumns
+FROM sys.indexes ix
+WHERE ix.object_id = OBJECT_ID('dbo.ItemSol') AND ix.type IN (1, 2);
+""")
+
+
+def _quote(value: str) -> str:
+    return "N'" + value.replace("'", "''") + "'"
+
+
+def build_create_index(terceiros: Sequence[str], filtered: Optional[bool] = None, online: Optional[bool] = None) -> str:
+    """DDL do índice de cobertura (filtrado pelos terceirizados se `filtered`)."""
+    filtered = config.ITEMSOL_INDEX_FILTERED if filtered is None else filtered
+    online = config.ITEMSOL_INDEX_ONLINE if online is None else online
+    terceiros = [t for t in (terceiros or []) if t]
+    sql = (
+        f"CREATE NONCLUSTERED INDEX {INDEX_NAME}\n"
+        f"    ON dbo.ItemSol ({', '.join(KEY_COLUMNS)})\n"
+        f"    INCLUDE ({', '.join(INCLUDE_COLUMNS)})"
+    )
+    if filtered and terceiros:
+        sql += f"\n    WHERE NomeTerceirizado IN ({', '.join(_quote(t) for t in terceiros)})"
+    if online:
+        sql += "\n    WITH (ONLINE = ON)"
+    return sql + ";"
+
+
+def find_indexes(conn) -> List[Dict[str, Any]]:
+    """Índices do ItemSol que servem à leitura: chave começando por (NomeTerceirizado, CodItemSol)."""
+    found = []
+    for row in conn.execute(SQL_FIND_INDEXES).mappings():
+        keys = [k for k in (row["KeyColumns"] or "").split(",") if k]
+        if [k.lower() for k in keys[:2]] != [k.lower() for k in KEY_COLUMNS]:
+            continue
+        included = {c.lower() for c in (row["IncludedColumns"] or "").split(",") if c}
+        missing = [c for c in INCLUDE_COLUMNS if c.lower() not in included and c.lower() not in {k.lower() for k in keys}]
+        found.append({
+            "name": row["IndexName"],
+            "keys": keys,
+            "filter": row["FilterDefinition"] if row["HasFilter"] else None,
+            "missing_includes": missing,
+        })
+    return found
+
+
+def ensure_index(create: bool = False, terceiros: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    """
+    Verifica se existe um índice de cobertura para a leitura e, com `create`, cria o índice
+    sugerido. Retorna {"covered", "indexes", "created", "ddl"}.
+    """
+    terceiros = config.TERCEIROS if terceiros is None else terceiros
+    ddl = build_create_index(terceiros)
+    with database.get_engine().connect() as conn:
+        indexes = find_indexes(conn)
+    covered = any(not ix["missing_includes"] for ix in indexes)
+    created = False
+    if not covered:
+        if indexes:
+            log.warning("índice(s) %s no ItemSol sem cobrir as colunas %s (haverá key lookup)",
+                        [ix["name"] for ix in indexes], indexes[0]["missing_includes"])
+        if create:
+            log.info("criando índice de cobertura no ItemSol:\n%s", ddl)
+            with database.get_engine().begin() as conn:
+                conn.execute(text(ddl))
+            created = covered = True
+        else:
+            log.warning("nenhum índice de cobertura para a leitura do ItemSol; sugestão:\n%s", ddl)
+    else:
+        log.info("índice de cobertura da leitura presente: %s", [ix["name"] for ix in indexes if not ix["missing_includes"]])
+    return {"covered": covered, "indexes": indexes, "created": created, "ddl": ddl}
+
+
+# ===== Plano de execução =====
+def _float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def summarize_plan(plan_xml: str) -> Dict[str, Any]:
+    """
+    Resume um showplan XML real: custo estimado do statement, tempos e, por operador que
+    acessa tabela/índice, tipo físico, objeto, linhas reais e leituras lógicas.
+    `seek` é True se o ItemSol só é acessado por seek.
+    """
+    root = ET.fromstring(plan_xml)
+    stmt = root.find(".//p:StmtSimple", SHOWPLAN_NS)
+    summary: Dict[str, Any] = {
+        "statement_cost": _float(stmt.get("StatementSubTreeCost")) if stmt is not None else None,
+        "cpu_ms": None,
+        "elapsed_ms": None,
+        "operators": [],
+        "seek": False,
+    }
+    times = root.find(".//p:QueryTimeStats", SHOWPLAN_NS)
+    if times is not None:
+        summary["cpu_ms"] = _float(times.get("CpuTime"))
+        summary["elapsed_ms"] = _float(times.get("ElapsedTime"))
+
+    itemsol_ops = []
+    for relop in root.iter(f"{{{SHOWPLAN_NS['p']}}}RelOp"):
+        obj = None
+        for child in relop:
+            obj = child.find("p:Object", SHOWPLAN_NS)
+            if obj is not None:
+                break
+        if obj is None:
+            continue
+        actual_rows = 0.0
+        logical_reads = 0.0
+        for counters in relop.findall("p:RunTimeInformation/p:RunTimeCountersPerThread", SHOWPLAN_NS):
+            actual_rows += _float(counters.get("ActualRows")) or 0.0
+            logical_reads += _float(counters.get("ActualLogicalReads")) or 0.0
+        op = {
+            "physical_op": relop.get("PhysicalOp"),
+            "table": (obj.get("Table") or "").strip("[]"),
+            "index": (obj.get("Index") or "").strip("[]") or None,
+            "estimated_cost": _float(relop.get("EstimatedTotalSubtreeCost")),
+            "estimated_rows": _float(relop.get("EstimateRows")),
+            "actual_rows": actual_rows,
+            "logical_reads": logical_reads,
+        }
+        summary["operators"].append(op)
+        if op["table"].lower() == "itemsol":
+            itemsol_ops.append(op)
+    summary["seek"] = bool(itemsol_ops) and all("Seek" in (op["physical_op"] or "") for op in itemsol_ops)
+    return summary
+
+
+def explain_fetch(last: Optional[int] = None, terceiros: Optional[Sequence[str]] = None,
+                  limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Executa a leitura da página com SET STATISTICS XML ON (plano real) a partir de `last`
+    (padrão: checkpoint atual) e devolve summarize_plan() + linhas lidas.
+    """
+    terceiros = config.TERCEIROS if terceiros is None else terceiros
+    stmt, params = database._build_fetch_query(terceiros)
+    with database.get_engine().connect() as conn:
+        if last is None:
+            last = conn.execute(text("SELECT LastItemId FROM dbo._MonitorState WHERE Name = 'ItemSolMonitor';")).scalar() or 0
+        params = dict(params, last=last, limit=int(limit or config.FETCH_PAGE_SIZE))
+        compiled = stmt.compile(dialect=database.get_engine().dialect)
+        bound = compiled.construct_params(params)
+        args = [bound[name] for name in compiled.positiontup] if compiled.positional else bound
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("SET STATISTICS XML ON;")
+            cursor.execute(str(compiled), args)
+            rows = len(cursor.fetchall())
+            plan_xml = None
+            while cursor.nextset():
+                row = cursor.fetchone()
+                if row and isinstance(row[0], str) and "ShowPlanXML" in row[0]:
+                    plan_xml = row[0]
+                    break
+            cursor.execute("SET STATISTICS XML OFF;")
+        finally:
+            cursor.close()
+
+    if not plan_xml:
+        raise RuntimeError("o servidor não retornou o plano de execução (SET STATISTICS XML)")
+    summary = summarize_plan(plan_xml)
+    summary["rows"] = rows
+    summary["last"] = last
+    return summary
+
+
+def log_plan(summary: Dict[str, Any]):
+    log.info(
+        "plano da leitura: custo=%.4f cpu=%sms tempo=%sms linhas=%d (last=%s) -> %s",
+        summary["statement_cost"] or 0.0, summary["cpu_ms"], summary["elapsed_ms"],
+        summary["rows"], summary["last"], "SEEK" if summary["seek"] else "SCAN/LOOKUP",
+        extra={"fields": {"plan": summary}},
+    )
+    for op in summary["operators"]:
+        log.info(
+            "  %-22s %-14s %-40s linhas=%.0f (est. %.0f) leituras=%.0f custo=%.4f",
+            op["physical_op"], op["table"], op["index"] or "-", op["actual_rows"],
+            op["estimated_rows"] or 0.0, op["logical_reads"], op["estimated_cost"] or 0.0,
+        )
+    if not summary["seek"]:
+        log.warning("a leitura do ItemSol não está usando seek; verifique o índice %s", INDEX_NAME)
+
+
+def bootstrap(create: bool = False):
+    """Passo opcional do bootstrap (ITEMSOL_INDEX_BOOTSTRAP=check|create): índice + plano real."""
+    if database.BACKEND != "mssql":
+        log.info("verificação de índice ignorada: DB_BACKEND=%s", database.BACKEND)
+        return
+    ensure_index(create=create)
+    try:
+        log_plan(explain_fetch())
+    except Exception as e:
+        log.warning("não foi possível obter o plano da leitura: %s", e)
@@ -0,0 +1,68 @@
+import json
+from typing import Any, Callable, Optional, Tuple
+
+import applog
+import config
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Serialização JSON (payloads e registros de falha)
+# =========================
+# `dumps()` gera bytes UTF-8 compactos (sem espaços, sem escapar acentos). Cada order é
+# serializada uma única vez: os mesmos bytes vão no corpo do POST, no log do payload e no
+# cálculo do tamanho dos lotes. Com JSON_BACKEND=auto (padrão) usa o orjson quando está
+# instalado; `json` força a biblioteca padrão. Datas, Decimal e afins passam pelo `default`
+# nos dois casos (o orjson não serializa datetime por conta própria), então o JSON sai
+# igual; se o orjson recusar um valor (inteiro acima de 64 bits, por exemplo), a
+# biblioteca padrão serializa o objeto.
+
+Default = Optional[Callable[[Any], Any]]
+
+_SELECTED: Optional[Tuple[str, Any]] = None
+
+
+def _select() -> Tuple[str, Any]:
+    global _SELECTED
+    if _SELECTED is None:
+        choice = config.JSON_BACKEND
+        selected: Tuple[str, Any] = ("json", None)
+        if choice != "json":
+            try:
+                import orjson
+                selected = ("orjson", orjson)
+            except ImportError as e:
+                if choice == "orjson":
+                    raise RuntimeError("JSON_BACKEND=orjson requer o pacote orjson (pip install orjson)") from e
+        _SELECTED = selected
+        log.debug("serialização JSON via %s", selected[0])
+    return _SELECTED
+
+
+def backend() -> str:
+    """Biblioteca em uso: "orjson" ou "json"."""
+    return _select()[0]
+
+
+def reset():
+    """Escolhe a biblioteca de novo no próximo dumps() (após mudar config.JSON_BACKEND)."""
+    global _SELECTED
+    _SELECTED = None
+
+
+def _dumps_std(obj: Any, default: Default = None) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+
+def dumps(obj: Any, default: Default = None) -> bytes:
+    """Serializa `obj` em bytes UTF-8 compactos."""
+    _name, orjson = _select()
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, default=default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        except TypeError:
+            pass
+    return _dumps_std(obj, default)
@@ -0,0 +1,283 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import applog
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Métricas (formato texto do Prometheus)
+# =========================
+# Registro mínimo em memória (sem dependências) com contadores, gauges e histogramas
+# com labels. `start_server()` expõe GET /metrics em uma thread daemon quando
+# METRICS_PORT > 0.
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.label_names, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Gauge com valor explícito (`set`) ou calculado no momento do scrape (`set_function`)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelKey, float] = {}
+        self._func: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def set_function(self, func: Callable[[], Optional[float]]):
+        self._func = func
+
+    def _samples(self) -> List[str]:
+        if self._func is not None:
+            try:
+                value = self._func()
+            except Exception as e:
+                log.debug("gauge %s falhou: %s", self.name, e)
+                return []
+            return [] if value is None else [f"{self.name} {_fmt_value(value)}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.label_names, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = _DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # {labels: [contagens por bucket..., soma, total]}
+        self._values: Dict[LabelKey, List[float]] = {}
+        # Amostras brutas (benchmark.py): só guardadas enquanto capture() estiver ativo
+        self._samples_sink: Optional[List[float]] = None
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+            if self._samples_sink is not None:
+                self._samples_sink.append(value)
+
+    def time(self, **labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def capture(self, sink: Optional[List[float]]):
+        """Passa a guardar cada valor observado em `sink` (None desliga); para percentis exatos."""
+        with self._lock:
+            self._samples_sink = sink
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines: List[str] = []
+        for key, data in items:
+            cumulative = 0.0
+            for i, bound in enumerate(self.buckets):
+                cumulative += data[i]
+                le = ("le", _fmt_value(bound) if bound != float("inf") else "+Inf")
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, le)} {_fmt_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {_fmt_value(data[-2])}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {_fmt_value(data[-1])}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))  # type: ignore[return-value]
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))  # type: ignore[return-value]
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = _DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))  # type: ignore[return-value]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ===== Métricas do monitor =====
+FETCH_SECONDS = REGISTRY.histogram("bemsoft_fetch_seconds", "Latência da leitura de uma página do ItemSol")
+PAYLOAD_BUILD_SECONDS = REGISTRY.histogram("bemsoft_payload_build_seconds", "Latência da montagem de payload por envio")
+POST_SECONDS = REGISTRY.histogram("bemsoft_post_seconds", "Latência do POST /requests")
+PAYLOAD_BYTES = REGISTRY.histogram(
+    "bemsoft_payload_bytes", "Tamanho (bytes) do corpo de cada POST /requests",
+    buckets=(512, 1024, 2048, 4096, 8192, 16384, 65536, 262144, 1048576),
+)
+ITEMS_FETCHED = REGISTRY.counter("bemsoft_items_fetched_total", "Itens lidos do ItemSol")
+GROUPS_SENT = REGISTRY.counter("bemsoft_groups_sent_total", "Solicitações processadas por resultado", ["result"])
+SEND_STATUS = REGISTRY.counter(
+    "bemsoft_send_status_total",
+    "Respostas de envio por status (201, 409, 400, 401, 5xx, other, exception)",
+    ["status"],
+)
+DEBOUNCE_QUEUE = REGISTRY.gauge("bemsoft_debounce_queue_size", "Solicitações aguardando a janela de debounce")
+LAG_ITEMS = REGISTRY.gauge("bemsoft_checkpoint_lag_items", "Itens elegíveis após o checkpoint (MaxItemId - LastItemId)")
+LAG_SECONDS = REGISTRY.gauge("bemsoft_checkpoint_lag_seconds", "Idade do item pendente mais antigo")
+CHECKPOINT = REGISTRY.gauge("bemsoft_checkpoint_last_item_id", "LastItemId atual")
+FAILED_BACKLOG = REGISTRY.gauge("bemsoft_failed_backlog_files", "Arquivos aguardando reprocessamento em FAILED_DIR")
+RETRY_QUEUE_SIZE = REGISTRY.gauge("bemsoft_retry_queue_size", "Solicitações aguardando retentativa em memória")
+RETRIES = REGISTRY.counter("bemsoft_retries_total", "Retentativas por resultado (ok, retry, gave_up, failed)", ["result"])
+BREAKER_STATE = REGISTRY.gauge("bemsoft_circuit_state", "Estado do circuit breaker (0 fechado, 1 meio-aberto, 2 aberto)")
+SHEETS_AGE = REGISTRY.gauge("bemsoft_sheets_snapshot_age_seconds", "Idade dos dados do Google Sheets em uso")
+STARTUP_SECONDS = REGISTRY.gauge("bemsoft_startup_seconds", "Tempo do início do processo até o primeiro ciclo")
+HTTP_CONCURRENCY = REGISTRY.gauge("bemsoft_http_concurrency_limit", "Limite atual de POSTs em voo (AIMD), por endpoint", ["endpoint"])
+HTTP_THROTTLED = REGISTRY.counter(
+    "bemsoft_http_throttled_total",
+    "Freios aplicados aos envios por motivo (retry_after, quota, overload, latency)",
+    ["reason"],
+)
+HTTP_THROTTLE_WAIT = REGISTRY.counter("bemsoft_http_throttle_wait_seconds_total", "Tempo de espera por taxa, pausa ou vaga antes dos POSTs")
+LAB_CHECKPOINT = REGISTRY.gauge("bemsoft_lab_checkpoint_last_item_id", "LastItemId por laboratório (LAB_PIPELINES=1)", ["lab"])
+LAB_LAG_ITEMS = REGISTRY.gauge("bemsoft_lab_checkpoint_lag_items", "Itens elegíveis após o checkpoint, por laboratório", ["lab"])
+LAB_LAG_SECONDS = REGISTRY.gauge("bemsoft_lab_checkpoint_lag_seconds", "Idade do item pendente mais antigo, por laboratório", ["lab"])
+LAB_BREAKER_STATE = REGISTRY.gauge("bemsoft_lab_circuit_state", "Estado do circuit breaker por laboratório", ["lab"])
+
+
+def status_label(status: Optional[int]) -> str:
+    """Normaliza um status HTTP para o label de SEND_STATUS."""
+    if status is None:
+        return "exception"
+    if status in (200, 201, 400, 401, 409, 429):
+        return str(status)
+    if 500 <= status < 600:
+        return "5xx"
+    return "other"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("metrics: " + format, *args)
+
+
+def start_server(port: int, addr: str = "0.0.0.0") -> Optional[ThreadingHTTPServer]:
+    """Sobe o endpoint /metrics em uma thread daemon (port <= 0 desliga)."""
+    if port <= 0:
+        return None
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    log.info("endpoint de métricas em http://%s:%d/metrics", addr, server.server_port)
+    return server
@@ -0,0 +1,287 @@
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+import applog
+import synthetic
+
+log = applog.get_logger(__name__)
+
+# =========================
+# API Bemsoft simulada (benchmark.py)
+# =========================
+# Servidor HTTP local com as rotas usadas pelo monitor:
+#   GET  /tests                          catálogo (códigos EX0001.. do synthetic)
+#   POST /requests                       order única ou lote (`batch.orders`)
+#   GET  /sheets/{id}/values/{range}     planilha no formato da Google Sheets API v4
+#   GET  /__stats                        contadores do servidor (para o relatório)
+# Latência, erros 500, conflitos 409 e rajadas de 503 são configuráveis; Idempotency-Key
+# repetida devolve 409 como a API real. Opcionalmente simula cota por segundo (429 com
+# Retry-After e cabeçalhos RateLimit-*) e capacidade limitada (a latência cresce na
+# proporção dos POSTs em voo acima de `capacity`).
+# Cada order tem a própria chave (a `idempotencyKey` da order no lote ou, numa order única,
+# a Idempotency-Key do POST): uma order já gravada não é gravada de novo, e um POST só com
+# orders já gravadas volta 409. `commit_error_rate` simula a API que grava o pedido e
+# responde 500; /__stats conta em `duplicate_orders` as orders gravadas de novo com o mesmo
+# externalId. Roda em um processo separado para não disputar o GIL com o pipeline medido.
+# Para os testes: `invalid_external_ids` faz o POST com alguma dessas orders voltar 400, e
+# `record_posts` guarda cada POST (cabeçalho Idempotency-Key, corpo e status) em `State.requests`.
+
+DEFAULT_OPTIONS: Dict[str, Any] = {
+    "exams": 200,            # testes no catálogo /tests (e linhas na planilha)
+    "latency_ms": 20.0,      # latência base de cada POST /requests
+    "jitter_ms": 5.0,        # variação uniforme somada à latência
+    "error_rate": 0.0,       # fração de POSTs que respondem 500
+    "commit_error_rate": 0.0,  # fração de POSTs gravados que mesmo assim respondem 500
+    "conflict_rate": 0.0,    # fração de POSTs que respondem 409 (já processado)
+    "burst_every": 0,        # a cada N POSTs começa uma rajada de 503 (0 desliga)
+    "burst_len": 0,          # POSTs em cada rajada de 503
+    "rate_limit": 0,         # POSTs aceitos por segundo (janela fixa de 1s); acima disso 429 (0 desliga)
+    "capacity": 0,           # POSTs em voo sem degradar a latência (0 = ilimitado)
+    "invalid_external_ids": (),  # externalId de orders rejeitadas com 400 (validação)
+    "record_posts": False,   # guarda os POSTs em State.requests
+    "seed": 42,
+}
+
+SHEETS_PREFIX = "/sheets"
+
+
+def catalog(exams: int) -> Dict[str, Any]:
+    """Catálogo GET /tests; um a cada 5 exames tem duas variantes de material (soro/plasma)."""
+    tests = []
+    for n in range(1, exams + 1):
+        code = synthetic.exam_code(n)
+        tests.append({"id": code, "name": f"EXAME SINTETICO {n}", "specimen": {"id": f"SP-{code}-S", "name": "SORO"}})
+        if n % 5 == 0:
+            tests.append({"id": code, "name": f"EXAME SINTETICO {n}", "specimen": {"id": f"SP-{code}-P", "name": "PLASMA"}})
+    return {"tests": tests}
+
+
+def sheet_values(exams: int) -> Dict[str, Any]:
+    """Planilha TEST_ID/TEST_NAME/SUPPORT_LAB_DESCMAT; o DESCMAT desempata as variantes do /tests."""
+    rows = [["TEST_ID", "TEST_NAME", "SUPPORT_LAB_DESCMAT"]]
+    for n in range(1, exams + 1):
+        rows.append([synthetic.exam_code(n), f"EXAME SINTETICO {n}", "PLASMA EDTA" if n % 10 == 0 else "SORO"])
+    return {"values": rows}
+
+
+class _State:
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        self.rng = random.Random(options.get("seed"))
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.order_keys = set()
+        self.external_ids = set()
+        self.posts = 0
+        self.orders = 0
+        self.duplicate_orders = 0
+        self.status: Dict[str, int] = {}
+        self.requests: List[Dict[str, Any]] = []
+        self.invalid = set(options.get("invalid_external_ids") or ())
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.window = 0
+        self.window_posts = 0
+        self.tests_body = json.dumps(catalog(options["exams"])).encode("utf-8")
+        self.sheet_body = json.dumps(sheet_values(options["exams"])).encode("utf-8")
+
+    def _commit(self, orders: List[Tuple[Optional[str], Optional[str]]]):
+        """Grava as orders [(chave, externalId)] ainda não gravadas; conta externalId repetido."""
+        for order_key, external_id in orders:
+            if order_key and order_key in self.order_keys:
+                continue
+            if order_key:
+                self.order_keys.add(order_key)
+            if external_id and external_id in self.external_ids:
+                self.duplicate_orders += 1
+            self.external_ids.add(external_id)
+            self.orders += 1
+
+    def decide(self, key: Optional[str], orders: List[Tuple[Optional[str], Optional[str]]]) -> Tuple[int, float, Dict[str, str]]:
+        """
+        Sorteia (status, atraso em segundos, cabeçalhos extras) de um POST com as orders
+        [(chave, externalId)], na ordem: cota (429), rajada, 500, duplicado (POST ou todas as
+        orders), 409, gravado com 500. Chamar com o POST já contado em `in_flight`.
+        """
+        opts = self.options
+        headers: Dict[str, str] = {}
+        with self.lock:
+            n = self.posts
+            self.posts += 1
+            delay = max(0.0, opts["latency_ms"] + self.rng.uniform(-opts["jitter_ms"], opts["jitter_ms"])) / 1000.0
+            capacity = int(opts.get("capacity") or 0)
+            if capacity > 0 and self.in_flight > capacity:
+                delay *= self.in_flight / capacity
+            limit = int(opts.get("rate_limit") or 0)
+            over_quota = False
+            if limit > 0:
+                now = time.time()
+                window = int(now)
+                if window != self.window:
+                    self.window, self.window_posts = window, 0
+                self.window_posts += 1
+                over_quota = self.window_posts > limit
+                headers = {
+                    "RateLimit-Limit": str(limit),
+                    "RateLimit-Remaining": str(max(0, limit - self.window_posts)),
+                    "RateLimit-Reset": str(max(1, int(window + 1 - now + 0.999))),
+                }
+                if over_quota:
+                    headers["Retry-After"] = headers["RateLimit-Reset"]
+            every, length = int(opts["burst_every"]), int(opts["burst_len"])
+            if over_quota:
+                status = 429
+                delay = 0.001
+            elif every > 0 and length > 0 and n % every >= every - length:
+                status = 503
+            elif self.rng.random() < opts["error_rate"]:
+                status = 500
+            elif key and key in self.keys:
+                status = 409
+            elif orders and all(k and k in self.order_keys for k, _ in orders):
+                status = 409
+            elif self.rng.random() < opts["conflict_rate"]:
+                status = 409
+            elif self.rng.random() < opts.get("commit_error_rate", 0.0):
+                self._commit(orders)
+                status = 500
+            else:
+                status = 201
+            if status in (201, 409) and key:
+                self.keys.add(key)
+            if status == 201:
+                self._commit(orders)
+            self.status[str(status)] = self.status.get(str(status), 0) + 1
+        return status, delay, headers
+
+    def reject(self):
+        """Conta um POST rejeitado por validação (400)."""
+        with self.lock:
+            self.posts += 1
+            self.status["400"] = self.status.get("400", 0) + 1
+
+    def record(self, key: Optional[str], body: Dict[str, Any], status: int):
+        if self.options.get("record_posts"):
+            with self.lock:
+                self.requests.append({"key": key, "body": body, "status": status})
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"posts": self.posts, "orders": self.orders, "duplicate_orders": self.duplicate_orders,
+                    "status": dict(self.status), "peak_in_flight": self.peak_in_flight}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeçalho e corpo saem em writes separados; sem isso o ACK atrasado soma ~40ms por POST
+    disable_nagle_algorithm = True
+    state: _State
+
+    def _send(self, status: int, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802 (nome exigido pelo http.server)
+        path = unquote(urlsplit(self.path).path)
+        if path == "/tests":
+            self._send(200, self.state.tests_body)
+        elif path.startswith(SHEETS_PREFIX + "/") and "/values/" in path:
+            self._send(200, self.state.sheet_body)
+        elif path == "/__stats":
+            self._send(200, json.dumps(self.state.stats()).encode("utf-8"))
+        else:
+            self._send(404, b'{"message":"not found"}')
+
+    def do_POST(self):  # noqa: N802
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if urlsplit(self.path).path != "/requests":
+            self._send(404, b'{"message":"not found"}')
+            return
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            self._send(401, b'{"message":"unauthorized"}')
+            return
+        key = self.headers.get("Idempotency-Key")
+        try:
+            body = json.loads(raw or b"{}")
+            batch = body.get("batch") or {}
+            single = batch.get("order")
+            # Chave de cada order: a do corpo (lote) ou, numa order única sem chave, a do POST
+            orders = [
+                (o.get("idempotencyKey") or (key if single is not None else None), o.get("externalId"))
+                for o in (batch.get("orders") or [single or {}])
+            ]
+        except (ValueError, AttributeError):
+            self._send(400, b'{"message":"invalid json"}')
+            return
+        if self.state.invalid and any(ext in self.state.invalid for _, ext in orders):
+            self.state.reject()
+            self.state.record(key, body, 400)
+            self._send(400, b'{"message":"invalid order"}')
+            return
+        self.state.enter()
+        try:
+            status, delay, headers = self.state.decide(key, orders)
+            if delay:
+                time.sleep(delay)
+        finally:
+            self.state.leave()
+        self.state.record(key, body, status)
+        if status == 201:
+            body = json.dumps({"id": key, "orders": len(orders)}).encode("utf-8")
+            self._send(201, body, headers)
+        elif status == 409:
+            self._send(409, b'{"message":"request already processed"}', headers)
+        elif status == 429:
+            self._send(429, b'{"message":"too many requests"}', headers)
+        else:
+            self._send(status, b'{"message":"simulated failure"}', headers)
+
+    def log_message(self, format, *args):  # silencia o log de acesso
+        pass
+
+
+def make_server(options: Optional[Dict[str, Any]] = None, port: int = 0, addr: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Cria o servidor simulado (porta 0 = livre) sem iniciá-lo."""
+    opts = dict(DEFAULT_OPTIONS, **(options or {}))
+    handler = type("MockBemsoftHandler", (_Handler,), {"state": _State(opts)})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def _serve(options: Dict[str, Any], ports: "multiprocessing.Queue"):
+    server = make_server(options)
+    ports.put(server.server_address[1])
+    server.serve_forever(poll_interval=0.2)
+
+
+def start_process(options: Optional[Dict[str, Any]] = None, timeout: float = 10.0) -> Tuple[multiprocessing.Process, str]:
+    """Sobe o servidor em um processo filho; retorna (processo, URL base). Encerre com terminate()."""
+    ports: "multiprocessing.Queue" = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_serve, args=(dict(options or {}), ports), name="mock-bemsoft", daemon=True)
+    proc.start()
+    port = ports.get(timeout=timeout)
+    url = f"http://127.0.0.1:{port}"
+    log.info("API Bemsoft simulada em %s (pid %s)", url, proc.pid)
+    return proc, url
@@ -0,0 +1,378 @@
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, text
+
+import config
+import database
+import retryq
+
+# =========================
+# Outbox por solicitação
+# =========================
+# Cada CodSolicitacao vira uma linha em dbo._MonitorOutbox com o conjunto de itens,
+# o momento em que foi vista pela primeira vez (debounce durável) e o status de envio.
+# Revision conta as mudanças do conjunto de itens e entra na Idempotency-Key (event["revisao"]):
+# itens que chegam depois de um envio saem com chave nova em vez de voltarem 409.
+# A ingestão (página do ItemSol + upsert no outbox + LastItemId) é uma única transação
+# curta; o envio é dirigido pela tabela, então grupos que atravessam páginas são
+# reunidos antes de ficarem prontos e um restart não perde as janelas de debounce.
+# Falha transitória (5xx, 429, timeout) deixa a linha 'failed' com NextAttemptAt (backoff
+# exponencial com jitter de BEMSOFT_RETRY_*): ela volta a ser selecionada quando vence,
+# também depois de um restart. Erro permanente (400/401) fica 'failed' sem NextAttemptAt.
+# A seleção reivindica as linhas (ClaimedBy/ClaimedUntil, com UPDLOCK/READPAST no SQL
+# Server): dois monitores no mesmo banco não enviam a mesma solicitação; a reivindicação de
+# um monitor que morreu vence depois de OUTBOX_CLAIM_SECONDS.
+
+STATUS_PENDING = "pending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+_SQL_BOOTSTRAP = {
+    "mssql": [
+text("""
+IF OBJECT_ID('dbo._MonitorOutbox','U') IS NULL
+BEGIN
+  CREATE TABLE dbo._MonitorOutbox (
+    CodSolicitacao BIGINT NOT NULL PRIMARY KEY,
+    ItemIds NVARCHAR(MAX) NOT NULL,
+    MinItemId BIGINT NOT NULL,
+    MaxItemId BIGINT NOT NULL,
+    FirstSeen datetime2 NOT NULL DEFAULT SYSUTCDATETIME(),
+    Status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    Attempts INT NOT NULL DEFAULT 0,
+    LastStatus INT NULL,
+    LastError NVARCHAR(1000) NULL,
+    SentAt datetime2 NULL,
+    UpdatedAt datetime2 NOT NULL DEFAULT SYSUTCDATETIME(),
+    Revision INT NOT NULL DEFAULT 0,
+    NextAttemptAt datetime2 NULL,
+    ClaimedBy NVARCHAR(200) NULL,
+    ClaimedUntil datetime2 NULL
+  );
+END;"""),
+text("""
+IF COL_LENGTH('dbo._MonitorOutbox', 'Revision') IS NULL
+  ALTER TABLE dbo._MonitorOutbox ADD Revision INT NOT NULL DEFAULT 0;
+"""),
+text("""
+IF COL_LENGTH('dbo._MonitorOutbox', 'NextAttemptAt') IS NULL
+  ALTER TABLE dbo._MonitorOutbox ADD NextAttemptAt datetime2 NULL, ClaimedBy NVARCHAR(200) NULL,
+                                     ClaimedUntil datetime2 NULL;
+"""),
+text("""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes
+               WHERE name = 'IX_MonitorOutbox_Pending' AND object_id = OBJECT_ID('dbo._MonitorOutbox'))
+  CREATE INDEX IX_MonitorOutbox_Pending
+      ON dbo._MonitorOutbox (FirstSeen, MinItemId)
+   WHERE Status = 'pending';
+"""),
+text("""
+IF NOT EXISTS (SELECT 1 FROM sys.indexes
+               WHERE name = 'IX_MonitorOutbox_Retry' AND object_id = OBJECT_ID('dbo._MonitorOutbox'))
+  CREATE INDEX IX_MonitorOutbox_Retry
+      ON dbo._MonitorOutbox (NextAttemptAt, MinItemId)
+   WHERE Status = 'failed' AND NextAttemptAt IS NOT NULL;
+"""),
+    ],
+    "sqlite": [
+text("""
+CREATE TABLE IF NOT EXISTS dbo._MonitorOutbox (
+  CodSolicitacao INTEGER NOT NULL PRIMARY KEY,
+  ItemIds TEXT NOT NULL,
+  MinItemId INTEGER NOT NULL,
+  MaxItemId INTEGER NOT NULL,
+  FirstSeen TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  Status TEXT NOT NULL DEFAULT 'pending',
+  Attempts INTEGER NOT NULL DEFAULT 0,
+  LastStatus INTEGER NULL,
+  LastError TEXT NULL,
+  SentAt TIMESTAMP NULL,
+  UpdatedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  Revision INTEGER NOT NULL DEFAULT 0,
+  NextAttemptAt TIMESTAMP NULL,
+  ClaimedBy TEXT NULL,
+  ClaimedUntil TIMESTAMP NULL
+);"""),
+text("""
+CREATE INDEX IF NOT EXISTS dbo.IX_MonitorOutbox_Pending
+    ON _MonitorOutbox (FirstSeen, MinItemId)
+ WHERE Status = 'pending';
+"""),
+    ],
+}
+SQL_BOOTSTRAP = database.per_backend(_SQL_BOOTSTRAP)
+
+# Tabelas criadas antes das colunas novas (no SQL Server os ALTER já estão em SQL_BOOTSTRAP)
+SQL_SQLITE_COLUMNS = text("SELECT name FROM pragma_table_info('_MonitorOutbox', 'dbo');")
+SQL_SQLITE_ADD_COLUMNS = {
+    "Revision": text("ALTER TABLE dbo._MonitorOutbox ADD COLUMN Revision INTEGER NOT NULL DEFAULT 0;"),
+    "NextAttemptAt": text("ALTER TABLE dbo._MonitorOutbox ADD COLUMN NextAttemptAt TIMESTAMP NULL;"),
+    "ClaimedBy": text("ALTER TABLE dbo._MonitorOutbox ADD COLUMN ClaimedBy TEXT NULL;"),
+    "ClaimedUntil": text("ALTER TABLE dbo._MonitorOutbox ADD COLUMN ClaimedUntil TIMESTAMP NULL;"),
+}
+SQL_SQLITE_RETRY_INDEX = text("""
+CREATE INDEX IF NOT EXISTS dbo.IX_MonitorOutbox_Retry
+    ON _MonitorOutbox (NextAttemptAt, MinItemId)
+ WHERE Status = 'failed' AND NextAttemptAt IS NOT NULL;
+""")
+
+SQL_SELECT_KEYS = database.statement("""
+SELECT CodSolicitacao, ItemIds, Status
+FROM dbo._MonitorOutbox{updlock}
+WHERE CodSolicitacao IN :keys;
+""", bindparam("keys", expanding=True))
+
+SQL_INSERT = text("""
+INSERT INTO dbo._MonitorOutbox (CodSolicitacao, ItemIds, MinItemId, MaxItemId, Status)
+VALUES (:cod, :items, :min_id, :max_id, 'pending');
+""")
+
+# Itens novos de uma solicitação já conhecida: se ainda está pendente mantém o FirstSeen
+# (mesma janela de debounce); se já foi enviada/falhou volta para a fila com nova janela.
+# A revisão sobe a cada mudança do conjunto, inclusive com um envio em voo: o reenvio usa
+# outra Idempotency-Key (com a mesma, a API responderia 409 e os itens novos se perderiam).
+# A nova revisão é outra order: as tentativas (e o backoff) recomeçam.
+SQL_MERGE_ITEMS = database.statement("""
+UPDATE dbo._MonitorOutbox
+   SET ItemIds = :items, MinItemId = :min_id, MaxItemId = :max_id, Revision = Revision + 1,
+       FirstSeen = CASE WHEN Status = 'pending' THEN FirstSeen ELSE {utcnow} END,
+       Status = 'pending', Attempts = 0, NextAttemptAt = NULL, UpdatedAt = {utcnow}
+ WHERE CodSolicitacao = :cod;
+""")
+
+# Seleção set-based das solicitações prontas: janela de debounce vencida ou retentativa
+# vencida, sem reivindicação válida de outro monitor (READPAST pula as linhas que outro
+# monitor está reivindicando agora)
+SQL_SELECT_READY = database.statement("""
+SELECT {top}CodSolicitacao, ItemIds, Revision, Attempts
+FROM dbo._MonitorOutbox{readpast}
+WHERE ((Status = 'pending' AND FirstSeen <= {since})
+    OR (Status = 'failed' AND NextAttemptAt <= {utcnow}))
+  AND (ClaimedUntil IS NULL OR ClaimedUntil < {utcnow})
+ORDER BY MinItemId ASC{limit};
+""", since=lambda: database.ago("debounce", "SECOND"))
+
+SQL_CLAIM = database.statement("""
+UPDATE dbo._MonitorOutbox
+   SET ClaimedBy = :me, ClaimedUntil = {ahead}
+ WHERE CodSolicitacao IN :keys
+   AND (ClaimedUntil IS NULL OR ClaimedUntil < {utcnow});
+""", bindparam("keys", expanding=True), ahead=lambda: database.ahead("claim", "SECOND"))
+
+SQL_CLAIMED = text("""
+SELECT CodSolicitacao
+FROM dbo._MonitorOutbox
+WHERE CodSolicitacao IN :keys
+  AND ClaimedBy = :me;
+""").bindparams(bindparam("keys", expanding=True))
+
+SQL_RELEASE = text("""
+UPDATE dbo._MonitorOutbox
+   SET ClaimedBy = NULL, ClaimedUntil = NULL
+ WHERE CodSolicitacao = :cod
+   AND ClaimedBy = :me;
+""")
+
+SQL_COUNT_PENDING = text("""
+SELECT COUNT(*) FROM dbo._MonitorOutbox WHERE Status = 'pending';
+""")
+
+# Falhas transitórias com retentativa agendada
+SQL_COUNT_RETRYING = text("""
+SELECT COUNT(*) FROM dbo._MonitorOutbox WHERE Status = 'failed' AND NextAttemptAt IS NOT NULL;
+""")
+
+# Só fecha a linha se o conjunto de itens não mudou durante o envio; :retry_in (segundos)
+# agenda a retentativa de uma falha transitória (NULL = sem retentativa)
+SQL_MARK = database.statement("""
+UPDATE dbo._MonitorOutbox
+   SET Status = :status, Attempts = Attempts + 1, LastStatus = :http_status,
+       LastError = :error,
+       SentAt = CASE WHEN :status = 'sent' THEN {utcnow} ELSE SentAt END,
+       NextAttemptAt = CASE WHEN :retry_in IS NULL THEN NULL ELSE {ahead} END,
+       UpdatedAt = {utcnow}
+ WHERE CodSolicitacao = :cod AND ItemIds = :items;
+""", ahead=lambda: database.ahead("retry_in", "SECOND"))
+
+SQL_PURGE = database.statement("""
+DELETE FROM dbo._MonitorOutbox
+ WHERE Status = 'sent'
+   AND SentAt < {since};
+""", since=lambda: database.ago("days", "DAY"))
+
+
+def _encode_items(ids: Iterable[int]) -> str:
+    return ",".join(str(i) for i in sorted(set(int(i) for i in ids)))
+
+
+def _decode_items(raw: Optional[str]) -> List[int]:
+    return [int(x) for x in (raw or "").split(",") if x]
+
+
+def bootstrap():
+    with database.get_engine().begin() as conn:
+        for q in SQL_BOOTSTRAP:
+            conn.execute(q)
+        if database.BACKEND == "sqlite":
+            columns = {r[0] for r in conn.execute(SQL_SQLITE_COLUMNS)}
+            for column, stmt in SQL_SQLITE_ADD_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(stmt)
+            conn.execute(SQL_SQLITE_RETRY_INDEX)
+
+
+def retry_delay(attempts: int, transient: bool) -> Optional[int]:
+    """
+    Segundos até retentar uma solicitação cujo envio falhou agora, depois de `attempts` envios
+    anteriores da mesma revisão; None se a falha não é transitória ou as retentativas
+    (BEMSOFT_RETRY_MAX_ATTEMPTS) acabaram.
+    """
+    if not transient or attempts >= config.RETRY_MAX_ATTEMPTS:
+        return None
+    delay = retryq.backoff_delay(attempts + 1, config.RETRY_BASE_SECONDS, config.RETRY_MAX_SECONDS)
+    return max(1, int(round(delay)))
+
+
+def ingest_page(terceiros, limit=None) -> Tuple[int, int, int]:
+    """
+    Lê a próxima página do ItemSol e registra/atualiza as solicitações no outbox,
+    avançando LastItemId na mesma transação curta.
+    Retorna (last anterior, linhas lidas, novo last).
+    """
+    with database.get_engine().begin() as conn:
+        last = conn.execute(database.SQL_GET_LAST).scalar() or 0
+        # Só os ids interessam aqui: agrupa enquanto as linhas chegam, sem guardar a página
+        incoming: Dict[Any, set] = {}
+        count = 0
+        new_last = last
+        for r in database.iter_items(conn, last, terceiros, limit):
+            item_id = int(r["CodItemSol"])
+            incoming.setdefault(r["CodSolicitacao"], set()).add(item_id)
+            new_last = max(new_last, item_id)
+            count += 1
+        if not count:
+            return last, 0, last
+
+        # Em blocos: o SQL Server aceita no máximo 2100 parâmetros por comando
+        existing = {
+            row["CodSolicitacao"]: row
+            for keys in database.chunked(list(incoming))
+            for row in conn.execute(SQL_SELECT_KEYS, {"keys": keys}).mappings().all()
+        }
+
+        inserts: List[Dict[str, Any]] = []
+        merges: List[Dict[str, Any]] = []
+        for cod, ids in incoming.items():
+            current = existing.get(cod)
+            if current is None:
+                inserts.append({"cod": cod, "items": _encode_items(ids), "min_id": min(ids), "max_id": max(ids)})
+                continue
+            known = set(_decode_items(current["ItemIds"]))
+            if ids <= known:
+                continue
+            merged = known | ids
+            merges.append({"cod": cod, "items": _encode_items(merged), "min_id": min(merged), "max_id": max(merged)})
+
+        if inserts:
+            conn.execute(SQL_INSERT, inserts)
+        if merges:
+            conn.execute(SQL_MERGE_ITEMS, merges)
+
+        conn.execute(database.SQL_SET_LAST, {"last": new_last})
+    return last, count, new_last
+
+
+def claim_ready(limit: int, debounce_seconds: int) -> List[Any]:
+    """
+    Seleciona e reivindica (OUTBOX_CLAIM_SECONDS) as solicitações prontas em uma transação
+    curta; retorna só as linhas que este monitor conseguiu reivindicar.
+    """
+    me = config.WORKER_ID
+    with database.get_engine().begin() as conn:
+        ready = conn.execute(
+            SQL_SELECT_READY, {"limit": int(limit), "debounce": int(debounce_seconds)}
+        ).mappings().all()
+        if not ready:
+            return []
+        claimed = set()
+        for keys in database.chunked([r["CodSolicitacao"] for r in ready]):
+            conn.execute(SQL_CLAIM, {"keys": keys, "me": me, "claim": int(config.OUTBOX_CLAIM_SECONDS)})
+            # Outro monitor pode ter reivindicado entre a seleção e o UPDATE (SQLite)
+            claimed.update(r[0] for r in conn.execute(SQL_CLAIMED, {"keys": keys, "me": me}))
+    return [r for r in ready if r["CodSolicitacao"] in claimed]
+
+
+def load_ready(terceiros, limit: int, debounce_seconds: int) -> List[Tuple[Any, str, int, int, List[Any]]]:
+    """
+    Reivindica as solicitações prontas (debounce ou retentativa vencidos) e carrega as linhas
+    correspondentes do ItemSol.
+    Retorna [(CodSolicitacao, ItemIds, Revision, Attempts, rows)] em ordem de MinItemId; cada
+    uma fica reivindicada até mark_results() ou release().
+    """
+    ready = claim_ready(limit, debounce_seconds)
+    if not ready:
+        return []
+    with database.get_engine().connect() as conn:
+        rows = database.fetch_items_for_solicitacoes(
+            conn, [r["CodSolicitacao"] for r in ready], terceiros
+        )
+
+    by_sol: Dict[Any, List[Any]] = {}
+    for r in rows:
+        by_sol.setdefault(r["CodSolicitacao"], []).append(r)
+
+    result: List[Tuple[Any, str, int, int, List[Any]]] = []
+    for r in ready:
+        cod = r["CodSolicitacao"]
+        wanted = set(_decode_items(r["ItemIds"]))
+        sol_rows = [x for x in by_sol.get(cod, []) if int(x["CodItemSol"]) in wanted]
+        result.append((cod, r["ItemIds"], int(r["Revision"] or 0), int(r["Attempts"] or 0), sol_rows))
+    return result
+
+
+def mark_results(results: Sequence[Dict[str, Any]]):
+    """
+    Grava o resultado do envio e libera a reivindicação:
+    [{cod, items, status, http_status, error, retry_in}].
+    """
+    if not results:
+        return
+    params = [
+        {
+            "cod": r["cod"],
+            "items": r["items"],
+            "status": r["status"],
+            "http_status": r.get("http_status"),
+            "error": (str(r["error"])[:1000] if r.get("error") else None),
+            "retry_in": r.get("retry_in"),
+        }
+        for r in results
+    ]
+    me = config.WORKER_ID
+    with database.get_engine().begin() as conn:
+        conn.execute(SQL_MARK, params)
+        conn.execute(SQL_RELEASE, [{"cod": r["cod"], "me": me} for r in results])
+
+
+def release(cods: Iterable[Any]):
+    """Libera sem resultado as solicitações reivindicadas que não foram enviadas (circuito aberto)."""
+    params = [{"cod": cod, "me": config.WORKER_ID} for cod in cods]
+    if params:
+        with database.get_engine().begin() as conn:
+            conn.execute(SQL_RELEASE, params)
+
+
+def pending_count() -> int:
+    with database.get_engine().connect() as conn:
+        return int(conn.execute(SQL_COUNT_PENDING).scalar() or 0)
+
+
+def retrying_count() -> int:
+    with database.get_engine().connect() as conn:
+        return int(conn.execute(SQL_COUNT_RETRYING).scalar() or 0)
+
+
+def purge(retention_days: Optional[int] = None) -> int:
+    days = config.OUTBOX_RETENTION_DAYS if retention_days is None else retention_days
+    with database.get_engine().begin() as conn:
+        return conn.execute(SQL_PURGE, {"days": int(days)}).rowcount or 0
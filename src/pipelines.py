@@ -0,0 +1,176 @@
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import text
+
+import applog
+import config
+import database
+import ratelimit
+import retryq
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Pipelines por laboratório (LAB_PIPELINES=1)
+# =========================
+# Um Pipeline reúne o estado de envio que o poll_once usa: a origem dos itens, o
+# circuit breaker, a fila de retentativas, o debounce em memória, as métricas de lag,
+# o número de workers e o limite de taxa. O modo padrão roda um único Pipeline sobre
+# todos os TERCEIROS (`main.PIPELINE`). Com LAB_PIPELINES=1 cada laboratório ganha um
+# LabPipeline em thread própria, com checkpoint próprio em dbo._MonitorState
+# ('ItemSolMonitor@<SLUG>'), workers/taxa/endpoint/token próprios (LAB_<SLUG>_...) e
+# falhas isoladas: um laboratório lento ou fora do ar só abre o próprio breaker.
+# Engine (pool de conexões) e sessão HTTP continuam compartilhados.
+# Os grupos saem marcados com g["lab"], que escolhe endpoint/token e separa as falhas por
+# laboratório. A Idempotency-Key e o externalId da order continuam sol-<cod>/order-<cod>:
+# o slug só entra neles com LAB_SCOPED_IDS=1, obrigatório quando dois laboratórios usam o
+# mesmo endpoint (uma solicitação com itens de dois laboratórios vira uma order por
+# laboratório, e a segunda voltaria 409).
+# O checkpoint legado ('ItemSolMonitor') acompanha o menor checkpoint dos laboratórios, e
+# cada laboratório começa no mínimo no legado: desligar e religar LAB_PIPELINES não
+# reprocessa o que o outro modo já enviou.
+
+STATE_PREFIX = "ItemSolMonitor@"
+
+SQL_LABS_AHEAD = text("""
+SELECT COUNT(*) AS Labs, MAX(LastItemId) AS MaxLast
+FROM dbo._MonitorState
+WHERE Name LIKE 'ItemSolMonitor@%' AND LastItemId > :last;
+""")
+
+
+def lab_state_names() -> List[str]:
+    """Linhas de checkpoint dos laboratórios configurados em TERCEIROS."""
+    return [STATE_PREFIX + config.lab_slug(lab) for lab in dict.fromkeys(config.TERCEIROS)]
+
+
+def warn_if_downgraded():
+    """
+    Com LAB_PIPELINES desligado: avisa se algum laboratório está à frente do checkpoint
+    legado (os itens desse intervalo, já enviados em uma order por laboratório, vão de
+    novo em uma order única).
+    """
+    with database.get_engine().connect() as conn:
+        last = conn.execute(database.SQL_GET_LAST).scalar() or 0
+        row = conn.execute(SQL_LABS_AHEAD, {"last": last}).mappings().first()
+    if row and row["Labs"]:
+        log.warning(
+            "LAB_PIPELINES desligado com %d laboratório(s) à frente do checkpoint legado (%s até %s): "
+            "itens desse intervalo já enviados por laboratório podem ser reenviados como outra order. "
+            "Para evitar, religue LAB_PIPELINES até os pipelines se alinharem.",
+            row["Labs"], last, row["MaxLast"],
+        )
+
+
+def new_lag_metrics() -> Dict[str, Any]:
+    return {
+        "last_id": 0,          # checkpoint atual (LastItemId)
+        "max_item_id": 0,      # maior CodItemSol elegível no banco
+        "lag_items": 0,        # max_item_id - last_id
+        "lag_seconds": 0.0,    # idade do item pendente mais antigo
+        "page_rows": 0,        # linhas da última página lida
+        "advanced": False,     # se a última página avançou o checkpoint
+        "sheets_snapshot_age": None,  # idade (s) dos dados do Google Sheets em uso
+    }
+
+
+def new_breaker() -> retryq.CircuitBreaker:
+    return retryq.CircuitBreaker(
+        config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_COOLDOWN_SECONDS, config.BREAKER_MAX_COOLDOWN_SECONDS,
+    )
+
+
+def new_retry_queue() -> retryq.RetryQueue:
+    return retryq.RetryQueue(config.RETRY_MAX_ATTEMPTS, config.RETRY_BASE_SECONDS, config.RETRY_MAX_SECONDS)
+
+
+class Pipeline:
+    """Contexto de envio de um fluxo de leitura (origem, breaker, retentativas, debounce, lag, limites)."""
+
+    def __init__(self, name: str, source: Any, breaker: retryq.CircuitBreaker, retry_queue: retryq.RetryQueue,
+                 pending: Dict[Any, float], lag: Dict[str, Any], terceiros: Optional[List[str]] = None,
+                 max_workers: Optional[int] = None, limiter: Optional[ratelimit.TokenBucket] = None):
+        self.name = name
+        self.source = source
+        self.breaker = breaker
+        self.retry_queue = retry_queue
+        self.pending = pending
+        self.lag = lag
+        self._terceiros = terceiros
+        self._max_workers = max_workers
+        self.limiter = limiter
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name!r})"
+
+    @property
+    def terceiros(self) -> List[str]:
+        return self._terceiros if self._terceiros is not None else config.TERCEIROS
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers or config.MAX_WORKERS
+
+    def throttle(self) -> None:
+        """Aguarda a vez no limite de taxa do pipeline (um POST)."""
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+
+class LabPipeline(Pipeline):
+    """Pipeline de um laboratório; também é a origem dos itens (interface de `database`)."""
+
+    def __init__(self, lab: str, override: Optional[Dict[str, Any]] = None):
+        override = override or {}
+        self.lab = lab
+        self.slug = config.lab_slug(lab)
+        self.state_name = STATE_PREFIX + self.slug
+        self.last = 0
+        rate = override.get("rate")
+        rate = config.LAB_RATE_PER_SECOND if rate is None else rate
+        super().__init__(
+            self.slug, self, new_breaker(), new_retry_queue(), {}, new_lag_metrics(), terceiros=[lab],
+            max_workers=override.get("max_workers"), limiter=ratelimit.TokenBucket(rate) if rate > 0 else None,
+        )
+        self.base_url = override.get("base_url")
+
+    def describe(self) -> str:
+        rate = f"{self.limiter.rate:g}/s" if self.limiter else "sem limite"
+        endpoint = self.base_url or "padrão"
+        return f"{self.lab} [{self.slug}] workers={self.max_workers} taxa={rate} endpoint={endpoint}"
+
+    # ---- origem (mesma interface de `database`) ----
+
+    def bootstrap_state(self):
+        database.create_checkpoints([self.state_name])
+        # Depois de rodar com LAB_PIPELINES desligado, o legado já enviou até o checkpoint dele
+        with database.get_engine().begin() as conn:
+            legacy = conn.execute(database.SQL_GET_LAST).scalar() or 0
+            conn.execute(database.SQL_SET_LAST_NAMED, {"name": self.state_name, "last": legacy})
+
+    def claim_groups(self, terceiros, limit=None, item_factory=None):
+        """Como database.claim_groups, restrito ao laboratório e ao checkpoint dele."""
+        with database.get_engine().begin() as conn:
+            last = conn.execute(database.SQL_GET_LAST_NAMED, {"name": self.state_name}).scalar() or 0
+            rows = database.iter_items(conn, last, self.terceiros, limit)
+            count, groups = database.group_rows(rows, item_factory)
+        for group in groups.values():
+            group["lab"] = self.slug
+        self.last = last
+        return last, count, groups
+
+    def commit_checkpoint(self, last):
+        with database.get_engine().begin() as conn:
+            conn.execute(database.SQL_SET_LAST_NAMED, {"name": self.state_name, "last": last})
+            # Legado no menor checkpoint dos laboratórios
+            database.follow_checkpoints(conn, lab_state_names())
+        self.last = max(self.last, last)
+
+    def fetch_lag(self, conn, last, terceiros):
+        return database.fetch_lag(conn, last, self.terceiros)
+
+
+def build_lab_pipelines() -> List[LabPipeline]:
+    """Um LabPipeline por laboratório de TERCEIROS (na ordem configurada)."""
+    overrides = config.LAB_OVERRIDES
+    return [LabPipeline(lab, overrides.get(config.lab_slug(lab))) for lab in dict.fromkeys(config.TERCEIROS)]
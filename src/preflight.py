@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from sqlalchemy import text
+
+import applog
+import config
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Verificação de startup (main.py --check)
+# =========================
+# Valida a configuração e a conectividade (banco, API Bemsoft, Google Sheets e
+# FAILED_DIR) sem ler páginas nem enviar nada, e devolve um resultado por etapa com a
+# duração. Cada verificação só importa/cria o que usa, então o tempo medido é o mesmo
+# custo que o monitor paga no primeiro ciclo.
+
+STATUS_OK = "ok"
+STATUS_FAIL = "falha"
+STATUS_SKIP = "ignorado"
+
+
+def _check_config() -> str:
+    problems = config.get_settings().validate()
+    if problems:
+        raise RuntimeError("; ".join(problems))
+    files = config.get_settings().ENV_FILES
+    return f".env: {', '.join(files)}" if files else "sem .env (somente variáveis de ambiente)"
+
+
+def _check_database() -> str:
+    import database
+
+    with database.get_engine().connect() as conn:
+        conn.execute(text("SELECT 1")).scalar()
+        try:
+            last = conn.execute(database.SQL_GET_LAST).scalar()
+        except Exception:
+            return f"{database.BACKEND}: conectado (dbo._MonitorState ainda não existe; criado no primeiro start)"
+    return f"{database.BACKEND}: conectado, checkpoint LastItemId={last}"
+
+
+def _check_bemsoft() -> str:
+    if config.DRY_RUN:
+        return STATUS_SKIP + ": BEMSOFT_DRY_RUN=1"
+    import bemsoft_api
+
+    sess = bemsoft_api._build_session()
+    url = config.BASE_URL.rstrip("/") + "/tests"
+    resp = sess.get(url, headers={"Authorization": f"Bearer {config.TOKEN}"}, timeout=config.TIMEOUT)
+    if resp.status_code == 401:
+        raise RuntimeError("token recusado (401) em GET /tests")
+    if resp.status_code != 200:
+        raise RuntimeError(f"GET /tests respondeu {resp.status_code}")
+    tests = (resp.json() or {}).get("tests") or []
+    return f"GET /tests ok ({len(tests)} testes no catálogo)"
+
+
+def _check_sheets() -> str:
+    if not config.GOOGLE_SHEET_ID or not config.GOOGLE_API_KEY:
+        return STATUS_SKIP + ": GOOGLE_SHEET_ID/GOOGLE_API_KEY não configurados"
+    import sheets_client
+
+    url = sheets_client.SheetsCache(config.GOOGLE_SHEET_ID, config.GOOGLE_SHEET_RANGE, config.GOOGLE_API_KEY,
+                                    snapshot_path="", refresh_seconds=0)._build_url()
+    resp = requests.get(url, timeout=30)
+    if resp.status_code != 200:
+        raise RuntimeError(f"planilha respondeu {resp.status_code}")
+    rows = (resp.json() or {}).get("values") or []
+    return f"planilha ok ({max(0, len(rows) - 1)} linhas)"
+
+
+def _check_failed_dir() -> str:
+    path = config.FAILED_LOG_DIR if config.FAILED_STORE == "log" else config.FAILED_DIR
+    os.makedirs(path, exist_ok=True)
+    probe = os.path.join(path, f".check-{uuid.uuid4().hex}")
+    with open(probe, "w", encoding="utf-8") as f:
+        f.write("ok")
+    os.remove(probe)
+    return f"{path} gravável"
+
+
+CHECKS: List[tuple] = [
+    ("config", _check_config),
+    ("banco", _check_database),
+    ("bemsoft", _check_bemsoft),
+    ("sheets", _check_sheets),
+    ("falhas", _check_failed_dir),
+]
+
+
+def run(checks: Optional[List[tuple]] = None) -> List[Dict[str, Any]]:
+    """Executa as verificações em ordem; uma falha de config interrompe as demais."""
+    results = []
+    for name, fn in (checks or CHECKS):
+        started = time.perf_counter()
+        try:
+            detail = fn()
+            status = STATUS_SKIP if detail.startswith(STATUS_SKIP) else STATUS_OK
+        except Exception as e:
+            detail, status = str(e) or e.__class__.__name__, STATUS_FAIL
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        results.append({"check": name, "status": status, "detail": detail, "ms": round(elapsed_ms, 1)})
+        if name == "config" and status == STATUS_FAIL:
+            break
+    return results
+
+
+def report(results: List[Dict[str, Any]], printer: Callable[[str], Any] = print) -> bool:
+    """Imprime uma linha por verificação; retorna True se nenhuma falhou."""
+    for r in results:
+        printer(f"[{r['status']:>8}] {r['check']:<8} {r['ms']:>8.1f} ms  {r['detail']}")
+    return all(r["status"] != STATUS_FAIL for r in results)
@@ -0,0 +1,331 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Mapping, Optional, Tuple
+
+import applog
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Limite de taxa dos envios (token bucket)
+# =========================
+# Cada POST consome uma ficha; as fichas voltam a `rate` por segundo até o limite
+# `burst`. Sem ficha disponível, acquire() bloqueia a thread de envio até a próxima,
+# então os workers de um pipeline nunca passam de `rate` POSTs/s somados.
+#
+# Throttle (um por endpoint da Bemsoft, compartilhado por todos os envios) junta três
+# freios: o token bucket (BEMSOFT_RATE_PER_SECOND), a pausa/ritmo pedidos pela API
+# (Retry-After e cabeçalhos RateLimit-*/X-RateLimit-*) e um limite de POSTs em voo
+# ajustado em AIMD: +1 a cada `limite` respostas rápidas, x0.7 em 429/503/502/504,
+# timeout/erro de conexão ou latência acima do alvo (no máximo uma redução por
+# latência observada). O limite começa em 1 e fica entre 1 e o número de workers; até
+# a primeira redução ele dobra a cada rodada de respostas rápidas (+1 por resposta,
+# "slow start"), então chega ao teto em log2(workers) rodadas em vez de ~workers²/2.
+
+# Status em que a API pede para desacelerar (retentados pelo Throttle, com pausa compartilhada)
+THROTTLE_STATUS = (429, 503)
+# Status que indicam sobrecarga do upstream (reduzem a concorrência)
+OVERLOAD_STATUS = (429, 502, 503, 504)
+
+AIMD_DECREASE = 0.7
+# Latência-base (menor EWMA observada) sobe até 1% por segundo para acompanhar mudanças duradouras
+BASELINE_DRIFT_PER_SECOND = 0.01
+EWMA_ALPHA = 0.2
+MAX_PAUSE_SECONDS = 300.0
+# Espera máxima antes de conferir de novo a taxa/pausa (que podem mudar enquanto se espera)
+MAX_WAIT_STEP = 0.25
+
+
+class TokenBucket:
+    """Token bucket thread-safe; rate <= 0 desliga o limite (a pausa continua valendo)."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, self.rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float) -> None:
+        """Troca a taxa mantendo as fichas acumuladas (limitadas ao novo burst)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+            self.burst = max(1.0, self.rate)
+            self._tokens = min(self._tokens, self.burst) if self.rate > 0 else self.burst
+
+    def pause(self, seconds: float) -> None:
+        """Segura todos os envios por `seconds` (Retry-After, cota esgotada)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + min(seconds, MAX_PAUSE_SECONDS))
+
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Consome `tokens` se houver (retorna 0) ou retorna quanto falta esperar (s) sem consumir;
+        não bloqueia. Quem espera deve tentar de novo: a taxa e a pausa podem mudar no meio.
+        """
+        with self._lock:
+            now = time.monotonic()
+            pause = self._paused_until - now
+            if pause > 0:
+                return pause
+            if not self.enabled:
+                return 0.0
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Bloqueia até haver `tokens` fichas e as consome; retorna o tempo esperado (s)."""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return waited
+            delay = min(delay, MAX_WAIT_STEP)
+            time.sleep(delay)
+            waited += delay
+
+
+def parse_retry_after(value: Optional[str], now: Optional[datetime] = None) -> Optional[float]:
+    """Retry-After em segundos ou data HTTP -> segundos a esperar."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - (now or datetime.now(timezone.utc))).total_seconds())
+
+
+def _header(headers: Mapping[str, str], *names: str) -> Optional[str]:
+    for name in names:
+        value = headers.get(name)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def parse_rate_limit(headers: Mapping[str, str]) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (restantes, segundos até renovar) dos cabeçalhos RateLimit-Remaining/-Reset ou
+    X-RateLimit-Remaining/-Reset; Reset acima de 10^9 é tratado como epoch.
+    """
+    remaining = _header(headers, "RateLimit-Remaining", "X-RateLimit-Remaining")
+    reset = _header(headers, "RateLimit-Reset", "X-RateLimit-Reset")
+    try:
+        remaining_f = float(remaining.split(",")[0]) if remaining is not None else None
+    except ValueError:
+        remaining_f = None
+    try:
+        reset_f = float(reset.split(",")[0]) if reset is not None else None
+    except ValueError:
+        reset_f = None
+    if reset_f is not None and reset_f > 1e9:
+        reset_f = reset_f - time.time()
+    if reset_f is not None:
+        reset_f = max(0.0, reset_f)
+    return remaining_f, reset_f
+
+
+class AdaptiveConcurrency:
+    """Limite de requisições em voo com ajuste AIMD por latência e erros."""
+
+    def __init__(self, maximum: int, minimum: int = 1, latency_target: float = 0.0, adaptive: bool = True):
+        self.maximum = max(1, int(maximum))
+        self.minimum = max(1, min(int(minimum), self.maximum))
+        self.adaptive = adaptive
+        self.latency_target = latency_target
+        # Adaptativo começa no mínimo e sobe: a latência-base é medida sem fila no servidor
+        self.limit = float(self.minimum if adaptive else self.maximum)
+        # Slow start até a primeira redução: +1 por resposta rápida (dobra a cada rodada)
+        self.slow_start = adaptive
+        self.in_flight = 0
+        self.ewma: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self._baseline_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> float:
+        """Bloqueia até haver vaga abaixo do limite atual; retorna o tempo esperado (s)."""
+        start = time.monotonic()
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def target(self) -> Optional[float]:
+        if self.latency_target > 0:
+            return self.latency_target
+        if self.baseline is None:
+            return None
+        return max(2 * self.baseline, self.baseline + 0.05)
+
+    def observe(self, latency: Optional[float], overloaded: bool) -> Optional[str]:
+        """Ajusta o limite; retorna o motivo de uma redução ("overload"/"latency") ou None."""
+        if not self.adaptive:
+            return None
+        with self._cond:
+            now = time.monotonic()
+            if latency is not None:
+                self.ewma = latency if self.ewma is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+                if self.baseline is None:
+                    self.baseline = self.ewma
+                else:
+                    drift = 1 + BASELINE_DRIFT_PER_SECOND * (now - self._baseline_at)
+                    self.baseline = min(self.ewma, self.baseline * drift)
+                self._baseline_at = now
+            target = self.target()
+            slow = latency is not None and target is not None and self.ewma is not None and self.ewma > target
+            if overloaded or slow:
+                # Uma redução por "janela" (a latência atual): respostas da mesma rajada não somam cortes
+                if now - self._last_decrease < max(self.ewma or 0.0, 0.1):
+                    return None
+                self._last_decrease = now
+                self.slow_start = False
+                previous = int(self.limit)
+                self.limit = max(float(self.minimum), self.limit * AIMD_DECREASE)
+                if int(self.limit) != previous:
+                    log.info("concorrência reduzida %d -> %d (%s, latência média %.0f ms)",
+                             previous, int(self.limit), "sobrecarga" if overloaded else "latência",
+                             (self.ewma or 0.0) * 1000)
+                return "overload" if overloaded else "latency"
+            if self.limit < self.maximum:
+                before = int(self.limit)
+                step = 1.0 if self.slow_start else 1.0 / self.limit
+                self.limit = min(float(self.maximum), self.limit + step)
+                if int(self.limit) > before:
+                    log.debug("concorrência aumentada para %d", int(self.limit))
+                    self._cond.notify()
+            return None
+
+
+class Throttle:
+    """Freio compartilhado dos envios a um endpoint: taxa, pausa/ritmo da API e concorrência AIMD."""
+
+    def __init__(self, name: str, rate: float, max_in_flight: int, latency_target: float = 0.0,
+                 adaptive: bool = True):
+        self.name = name
+        self.configured_rate = float(rate)
+        self.bucket = TokenBucket(rate)
+        self.concurrency = AdaptiveConcurrency(max_in_flight, latency_target=latency_target, adaptive=adaptive)
+        self._header_rate_until = 0.0
+        self._lock = threading.Lock()
+
+    def describe(self) -> str:
+        rate = f"{self.configured_rate:g}/s" if self.configured_rate > 0 else "sem limite"
+        mode = "adaptativa" if self.concurrency.adaptive else "fixa"
+        return f"taxa={rate} concorrência {mode} 1..{self.concurrency.maximum}"
+
+    # ---- vaga e ficha ----
+
+    def enter(self) -> float:
+        """Ocupa uma vaga de requisição em voo (bloqueia); retorna o tempo esperado (s)."""
+        return self.concurrency.acquire()
+
+    def leave(self) -> None:
+        self.concurrency.release()
+
+    def try_acquire(self) -> float:
+        """Ficha para um POST: 0 se liberado, senão quanto esperar antes de tentar de novo (s); não bloqueia."""
+        self._expire_header_rate()
+        delay = self.bucket.try_acquire()
+        return min(delay, MAX_WAIT_STEP) if delay else 0.0
+
+    def wait(self) -> float:
+        """Bloqueia até a ficha do próximo POST; retorna o tempo esperado (s)."""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    # ---- resposta ----
+
+    def observe(self, status: Optional[int], latency: Optional[float],
+                headers: Optional[Mapping[str, Any]] = None, error: bool = False) -> Tuple[Optional[str], float]:
+        """
+        Registra o resultado de um POST: aplica Retry-After/RateLimit-* e ajusta a concorrência.
+        Retorna (motivo do freio ou None, pausa aplicada em s).
+        """
+        reason = None
+        pause = 0.0
+        headers = headers or {}
+        retry_after = parse_retry_after(headers.get("Retry-After")) if status in OVERLOAD_STATUS else None
+        if retry_after is not None:
+            pause = retry_after
+            reason = "retry_after"
+        remaining, reset = parse_rate_limit(headers)
+        if remaining is not None and reset is not None:
+            if remaining <= 0:
+                if reset > pause:
+                    pause, reason = reset, "quota"
+            else:
+                self._pace(remaining, reset)
+        if status in THROTTLE_STATUS and not pause:
+            # 429/503 sem Retry-After: segura todo mundo por uma latência antes de tentar de novo
+            pause, reason = max(self.concurrency.ewma or 0.0, 0.5), "retry_after"
+        if pause:
+            self.bucket.pause(pause)
+            log.info("%s: envios pausados por %.1fs (status=%s, %s)", self.name, pause, status, reason)
+        overloaded = error or status in OVERLOAD_STATUS
+        cut = self.concurrency.observe(None if error else latency, overloaded)
+        return reason or cut, pause
+
+    def _pace(self, remaining: float, reset: float) -> None:
+        """
+        Com a cota quase no fim (menos que o teto de POSTs em voo), distribui o restante até a
+        renovação; com folga, volta à taxa configurada (BEMSOFT_RATE_PER_SECOND).
+        """
+        if remaining >= self.concurrency.maximum:
+            if self._header_rate_until:
+                with self._lock:
+                    self._header_rate_until = 0.0
+                self.bucket.set_rate(self.configured_rate)
+            return
+        rate = remaining / max(reset, 0.1)
+        if self.configured_rate > 0:
+            rate = min(rate, self.configured_rate)
+        with self._lock:
+            self._header_rate_until = time.monotonic() + reset
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+
+    def _expire_header_rate(self) -> None:
+        if self._header_rate_until and time.monotonic() >= self._header_rate_until:
+            with self._lock:
+                self._header_rate_until = 0.0
+            self.bucket.set_rate(self.configured_rate)
@@ -0,0 +1,222 @@
+import heapq
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import applog
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Fila de retentativas e circuit breaker
+# =========================
+# Falhas transitórias (5xx, 429, timeout/conexão) de uma solicitação entram em uma fila
+# em memória ordenada pelo horário da próxima tentativa (heap), com backoff exponencial
+# com jitter por CodSolicitacao. O circuit breaker conta falhas transitórias seguidas e,
+# ao passar do limite, pausa o envio (estado "open") por um cooldown; depois libera uma
+# única tentativa de prova ("half_open") que fecha o circuito ou reabre com cooldown maior.
+
+STATE_CLOSED = "closed"
+STATE_HALF_OPEN = "half_open"
+STATE_OPEN = "open"
+
+# Valor numérico do estado para a métrica
+STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+TRANSIENT_STATUS = {408, 425, 429}
+
+
+def is_transient(status: Optional[int], exc: Optional[BaseException] = None) -> bool:
+    """Falha que vale retentar: 5xx, 408/425/429 ou erro de rede (sem status)."""
+    if status is None:
+        if exc is None:
+            return False
+        # Import tardio: requests só é necessário para classificar exceções de rede
+        import requests
+        return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+    return status in TRANSIENT_STATUS or 500 <= status < 600
+
+
+def backoff_delay(attempt: int, base: float, maximum: float) -> float:
+    """Backoff exponencial com jitter ("equal jitter"): metade fixa, metade aleatória."""
+    delay = min(maximum, base * (2 ** max(0, attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryEntry:
+    __slots__ = ("cod", "group", "attempts", "next_at", "handle", "last_error")
+
+    def __init__(self, cod: Any, group: Dict[str, Any], handle: Any = None):
+        self.cod = cod
+        self.group = group
+        self.attempts = 0
+        self.next_at = 0.0
+        self.handle = handle
+        self.last_error: Any = None
+
+
+class RetryQueue:
+    """Heap por horário da próxima tentativa; no máximo uma entrada por CodSolicitacao."""
+
+    def __init__(self, max_attempts: int, base_seconds: float, max_seconds: float):
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self._heap: List[Any] = []
+        self._entries: Dict[Any, RetryEntry] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_attempts > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, cod: Any) -> bool:
+        return cod in self._entries
+
+    def _push(self, entry: RetryEntry):
+        self._seq += 1
+        heapq.heappush(self._heap, (entry.next_at, self._seq, entry.cod))
+
+    def schedule(self, cod: Any, group: Dict[str, Any], error: Any = None, handle: Any = None) -> RetryEntry:
+        """Agenda a primeira retentativa (ou atualiza o grupo se a solicitação já está na fila)."""
+        with self._lock:
+            entry = self._entries.get(cod)
+            if entry is None:
+                entry = self._entries[cod] = RetryEntry(cod, group, handle)
+            else:
+                # Versão mais nova da mesma solicitação: mantém as tentativas já feitas
+                entry.group = group
+                entry.handle = handle if handle is not None else entry.handle
+            entry.attempts += 1
+            entry.last_error = error
+            entry.next_at = time.monotonic() + backoff_delay(entry.attempts, self.base_seconds, self.max_seconds)
+            self._push(entry)
+            return entry
+
+    def retry_later(self, entry: RetryEntry, error: Any = None) -> bool:
+        """Reagenda após nova falha transitória; False se esgotou as tentativas."""
+        with self._lock:
+            if self._entries.get(entry.cod) is not entry:
+                return False
+            entry.attempts += 1
+            entry.last_error = error
+            if entry.attempts > self.max_attempts:
+                del self._entries[entry.cod]
+                return False
+            entry.next_at = time.monotonic() + backoff_delay(entry.attempts, self.base_seconds, self.max_seconds)
+            self._push(entry)
+            return True
+
+    def defer(self, entry: RetryEntry, until: float):
+        """Adia sem contar tentativa (ex.: circuito aberto)."""
+        with self._lock:
+            if self._entries.get(entry.cod) is not entry:
+                return
+            entry.next_at = max(entry.next_at, until)
+            self._push(entry)
+
+    def pop_due(self, now: Optional[float] = None, limit: Optional[int] = None) -> List[RetryEntry]:
+        """Retira as entradas vencidas (em ordem de vencimento); continuam registradas até done()."""
+        now = time.monotonic() if now is None else now
+        due: List[RetryEntry] = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                next_at, _seq, cod = heapq.heappop(self._heap)
+                entry = self._entries.get(cod)
+                # Itens obsoletos do heap (reagendados ou concluídos) são descartados
+                if entry is None or entry.next_at != next_at or entry in due:
+                    continue
+                due.append(entry)
+        return due
+
+    def done(self, entry: RetryEntry):
+        with self._lock:
+            if self._entries.get(entry.cod) is entry:
+                del self._entries[entry.cod]
+
+    def next_due_in(self) -> Optional[float]:
+        with self._lock:
+            while self._heap:
+                next_at, _seq, cod = self._heap[0]
+                entry = self._entries.get(cod)
+                if entry is not None and entry.next_at == next_at:
+                    return max(0.0, next_at - time.monotonic())
+                heapq.heappop(self._heap)
+        return None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, cooldown_seconds: float, max_cooldown_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown_seconds
+        self.max_cooldown = max(cooldown_seconds, max_cooldown_seconds)
+        self.state = STATE_CLOSED
+        self.cooldown = cooldown_seconds
+        self.opened_until = 0.0
+        self._failures = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def allow(self) -> bool:
+        """True se um envio pode sair agora (no half_open, só uma prova por vez)."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_OPEN:
+                if time.monotonic() < self.opened_until:
+                    return False
+                self.state = STATE_HALF_OPEN
+                self._probe_in_flight = False
+                log.info("circuito meio-aberto: liberando um envio de prova")
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def is_open(self) -> bool:
+        """Circuito aberto e ainda em cooldown (nem a prova pode sair)."""
+        return self.enabled and self.state == STATE_OPEN and time.monotonic() < self.opened_until
+
+    def record_success(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                log.info("circuito fechado: Bemsoft respondendo novamente")
+            self.state = STATE_CLOSED
+            self.cooldown = self.base_cooldown
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._failures += 1
+            if self.state == STATE_HALF_OPEN:
+                # Prova falhou: reabre com cooldown dobrado
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self._open()
+            elif self.state == STATE_CLOSED and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.state = STATE_OPEN
+        self.opened_until = time.monotonic() + self.cooldown
+        self._probe_in_flight = False
+        log.warning("circuito aberto após %d falha(s) seguida(s): envios pausados por %.0fs",
+                    self._failures, self.cooldown)
+
+    def state_value(self) -> int:
+        return STATE_VALUES[self.state]
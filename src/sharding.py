@@ -0,0 +1,313 @@
+import math
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, text
+
+import applog
+import config
+import database
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Sharding entre processos (SHARD_MODE=hash)
+# =========================
+# Várias instâncias do main.py dividem o ItemSol em SHARD_COUNT partições fixas por
+# CodSolicitacao % SHARD_COUNT: a solicitação inteira cai na mesma partição, então o
+# envio continua sendo 1 order por solicitação (partir por laboratório separaria os itens
+# de uma solicitação mista em duas orders com a mesma Idempotency-Key, e a segunda seria
+# descartada como 409). Cada partição tem a própria linha de checkpoint em
+# dbo._MonitorState ('ItemSolMonitor#0/4', ...) e uma lease (LeaseOwner/LeaseExpiresAt, no relógio do banco). Cada worker registra a própria
+# linha 'ItemSolWorker:<id>' com heartbeat; a cada ciclo calcula sua cota (partições
+# divididas igualmente entre os workers vivos, por ordem de id), libera o excedente e
+# assume partições livres ou com lease vencida (worker morto).
+# Sem envio duplicado: a leitura e o checkpoint só valem com LeaseOwner = este worker
+# (fencing), então um worker que perdeu a lease não avança o checkpoint do novo dono;
+# o que ele ainda tinha em voo chega à API com a mesma Idempotency-Key e volta 409.
+# O checkpoint legado ('ItemSolMonitor') acompanha o menor checkpoint das partições (como
+# o dos pipelines por laboratório): com SHARD_MODE=off o monitor continua dali.
+# Cada Partition expõe a interface de `database` usada pelo poll_once
+# (bootstrap_state, claim_groups, commit_checkpoint, fetch_lag).
+
+STATE_PREFIX = "ItemSolMonitor"
+WORKER_PREFIX = "ItemSolWorker:"
+
+_SQL_ADD_LEASE = {
+    "mssql": [text("""
+IF COL_LENGTH('dbo._MonitorState', 'LeaseOwner') IS NULL
+  ALTER TABLE dbo._MonitorState ADD LeaseOwner NVARCHAR(200) NULL, LeaseExpiresAt DATETIME2 NULL;
+""")],
+    "sqlite": [
+        text("ALTER TABLE dbo._MonitorState ADD COLUMN LeaseOwner TEXT NULL;"),
+        text("ALTER TABLE dbo._MonitorState ADD COLUMN LeaseExpiresAt TIMESTAMP NULL;"),
+    ],
+}
+
+SQL_SQLITE_COLUMNS = text("SELECT name FROM pragma_table_info('_MonitorState', 'dbo');")
+
+SQL_TOUCH_WORKER = database.statement("""
+UPDATE dbo._MonitorState
+   SET LeaseOwner = :me, LeaseExpiresAt = {ahead}, UpdatedAt = {utcnow}
+ WHERE Name = :name;
+""", ahead=lambda: database.ahead("lease", "SECOND"))
+
+SQL_INSERT_WORKER = database.statement("""
+INSERT INTO dbo._MonitorState (Name, LastItemId, LeaseOwner, LeaseExpiresAt)
+VALUES (:name, NULL, :me, {ahead});
+""", ahead=lambda: database.ahead("lease", "SECOND"))
+
+SQL_DELETE_WORKER = text("DELETE FROM dbo._MonitorState WHERE Name = :name AND LeaseOwner = :me;")
+
+SQL_LIVE_WORKERS = database.statement("""
+SELECT LeaseOwner
+  FROM dbo._MonitorState
+ WHERE Name LIKE 'ItemSolWorker:%'
+   AND LeaseExpiresAt > {utcnow};
+""")
+
+SQL_PARTITIONS = database.statement("""
+SELECT Name, LeaseOwner, CASE WHEN LeaseExpiresAt > {utcnow} THEN 1 ELSE 0 END AS Active
+  FROM dbo._MonitorState
+ WHERE Name IN :names;
+""", bindparam("names", expanding=True))
+
+# Lease atômica: só assume se livre, já é deste worker ou venceu
+SQL_ACQUIRE = database.statement("""
+UPDATE dbo._MonitorState
+   SET LeaseOwner = :me, LeaseExpiresAt = {ahead}
+ WHERE Name = :name
+   AND (LeaseOwner IS NULL OR LeaseOwner = :me OR LeaseExpiresAt IS NULL OR LeaseExpiresAt < {utcnow});
+""", ahead=lambda: database.ahead("lease", "SECOND"))
+
+SQL_RENEW = database.statement("""
+UPDATE dbo._MonitorState
+   SET LeaseExpiresAt = {ahead}
+ WHERE Name IN :names
+   AND LeaseOwner = :me;
+""", bindparam("names", expanding=True), ahead=lambda: database.ahead("lease", "SECOND"))
+
+SQL_RELEASE = text("""
+UPDATE dbo._MonitorState
+   SET LeaseOwner = NULL, LeaseExpiresAt = NULL
+ WHERE Name = :name
+   AND LeaseOwner = :me;
+""")
+
+# Checkpoint da partição: só com a lease (fencing); nunca regride
+SQL_GET_LAST = database.statement("""
+SELECT LastItemId
+FROM dbo._MonitorState{updlock}
+WHERE Name = :name
+  AND LeaseOwner = :me;
+""")
+
+SQL_SET_LAST = database.statement("""
+UPDATE dbo._MonitorState
+   SET LastItemId = CASE WHEN LastItemId IS NULL OR LastItemId < :last THEN :last ELSE LastItemId END,
+       UpdatedAt = {utcnow}
+ WHERE Name = :name
+   AND LeaseOwner = :me;
+""")
+
+
+class Partition:
+    """Uma fatia do ItemSol com checkpoint próprio; usada pelo poll_once no lugar de `database`."""
+
+    def __init__(self, coordinator: "Coordinator", name: str, shard: Tuple[int, int]):
+        self.coordinator = coordinator
+        self.name = name
+        self.shard = shard
+        self.last = 0
+        # Debounce em memória por partição (o poll de uma não descarta as pendências da outra)
+        self.pending: Dict[Any, float] = {}
+
+    def __repr__(self) -> str:
+        return f"Partition({self.name!r})"
+
+    def bootstrap_state(self):
+        self.coordinator.bootstrap()
+
+    def claim_groups(self, terceiros, limit=None, item_factory=None):
+        """Como database.claim_groups, restrito à partição e ao checkpoint dela."""
+        params = {"name": self.name, "me": self.coordinator.worker_id}
+        with database.get_engine().begin() as conn:
+            row = conn.execute(SQL_GET_LAST, params).first()
+            if row is None:
+                self.coordinator.lost(self)
+                return self.last, 0, {}
+            last = row[0] or 0
+            rows = database.iter_items(conn, last, terceiros, limit, shard=self.shard)
+            count, groups = database.group_rows(rows, item_factory)
+        self.last = last
+        return last, count, groups
+
+    def commit_checkpoint(self, last):
+        params = {"name": self.name, "me": self.coordinator.worker_id, "last": last}
+        with database.get_engine().begin() as conn:
+            updated = conn.execute(SQL_SET_LAST, params).rowcount
+            if updated:
+                # Legado no menor checkpoint das partições: desligar o sharding não pula itens
+                database.follow_checkpoints(conn, self.coordinator._names)
+        if not updated:
+            self.coordinator.lost(self)
+            return
+        self.last = max(self.last, last)
+
+    def fetch_lag(self, conn, last, terceiros):
+        return database.fetch_lag(conn, last, terceiros, shard=self.shard)
+
+
+class Coordinator:
+    """Registro do worker, heartbeat das leases e rebalanceamento das partições."""
+
+    def __init__(self, worker_id: str, count: int, lease_seconds: int):
+        self.worker_id = worker_id
+        self.lease_seconds = int(lease_seconds)
+        self.partitions = [Partition(self, f"{STATE_PREFIX}#{i}/{count}", (i, count)) for i in range(count)]
+        self._names = [p.name for p in self.partitions]
+        self._owned: Dict[str, Partition] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._bootstrapped = False
+
+    @classmethod
+    def from_config(cls) -> "Coordinator":
+        return cls(config.WORKER_ID, config.SHARD_COUNT, config.SHARD_LEASE_SECONDS)
+
+    def describe(self) -> str:
+        return f"hash ({len(self.partitions)} partições, worker {self.worker_id})"
+
+    def owned(self) -> List[Partition]:
+        with self._lock:
+            return [p for p in self.partitions if p.name in self._owned]
+
+    # ---- estado no banco ----
+
+    def bootstrap(self):
+        """Colunas de lease em dbo._MonitorState e uma linha de checkpoint por partição."""
+        if self._bootstrapped:
+            return
+        backend = database.BACKEND
+        with database.get_engine().begin() as conn:
+            if backend == "sqlite":
+                columns = {r[0] for r in conn.execute(SQL_SQLITE_COLUMNS)}
+                for stmt, column in zip(_SQL_ADD_LEASE["sqlite"], ("LeaseOwner", "LeaseExpiresAt")):
+                    if column not in columns:
+                        conn.execute(stmt)
+            else:
+                for stmt in _SQL_ADD_LEASE["mssql"]:
+                    conn.execute(stmt)
+        database.create_checkpoints(self._names)
+        self._bootstrapped = True
+
+    def heartbeat(self):
+        """Renova o registro do worker e as leases das partições que ele detém."""
+        me, lease = self.worker_id, self.lease_seconds
+        name = WORKER_PREFIX + me
+        owned = list(self._owned)
+        with database.get_engine().begin() as conn:
+            if not conn.execute(SQL_TOUCH_WORKER, {"name": name, "me": me, "lease": lease}).rowcount:
+                conn.execute(SQL_INSERT_WORKER, {"name": name, "me": me, "lease": lease})
+            renewed = conn.execute(SQL_RENEW, {"names": owned, "me": me, "lease": lease}).rowcount if owned else 0
+            rows = conn.execute(SQL_PARTITIONS, {"names": owned}).all() if renewed < len(owned) else []
+        for row in rows:
+            if row.LeaseOwner != me:
+                self.lost(self._owned.get(row.Name))
+
+    def lost(self, part: Optional[Partition]):
+        if part is None:
+            return
+        with self._lock:
+            if self._owned.pop(part.name, None) is None:
+                return
+        part.pending.clear()
+        log.warning("lease da partição %s perdida (assumida por outro worker)", part.name)
+
+    def rebalance(self) -> List[Partition]:
+        """
+        Calcula a cota deste worker (partições / workers vivos, o resto para os primeiros
+        ids), libera o excedente e assume partições livres ou vencidas até a cota.
+        Retorna as partições que este worker deve processar neste ciclo.
+        """
+        self.heartbeat()
+        me = self.worker_id
+        with database.get_engine().connect() as conn:
+            live = sorted({r[0] for r in conn.execute(SQL_LIVE_WORKERS)} | {me})
+            states = {r.Name: r for r in conn.execute(SQL_PARTITIONS, {"names": self._names})}
+        base, extra = divmod(len(self.partitions), len(live))
+        quota = base + (1 if live.index(me) < extra else 0)
+
+        with self._lock:
+            for name in list(self._owned):
+                state = states.get(name)
+                if state is None or state.LeaseOwner != me:
+                    self._owned.pop(name)
+        excess = len(self._owned) - quota
+        if excess > 0:
+            for part in [p for p in reversed(self.partitions) if p.name in self._owned][:excess]:
+                self.release(part, "rebalanceamento")
+        elif excess < 0:
+            # Começa por um ponto diferente em cada worker para reduzir disputa pela mesma lease
+            start = live.index(me) * max(1, math.ceil(len(self.partitions) / len(live)))
+            order = self.partitions[start:] + self.partitions[:start]
+            for part in order:
+                if len(self._owned) >= quota:
+                    break
+                state = states.get(part.name)
+                if part.name in self._owned or (state is not None and state.Active and state.LeaseOwner
+                                                and state.LeaseOwner != me):
+                    continue
+                self.acquire(part)
+        return self.owned()
+
+    def acquire(self, part: Partition) -> bool:
+        params = {"name": part.name, "me": self.worker_id, "lease": self.lease_seconds}
+        with database.get_engine().begin() as conn:
+            if not conn.execute(SQL_ACQUIRE, params).rowcount:
+                return False
+        with self._lock:
+            self._owned[part.name] = part
+        part.pending.clear()
+        log.info("partição %s assumida por %s", part.name, self.worker_id)
+        return True
+
+    def release(self, part: Partition, reason: str):
+        with database.get_engine().begin() as conn:
+            conn.execute(SQL_RELEASE, {"name": part.name, "me": self.worker_id})
+        with self._lock:
+            self._owned.pop(part.name, None)
+        part.pending.clear()
+        log.info("partição %s liberada por %s (%s)", part.name, self.worker_id, reason)
+
+    # ---- ciclo de vida ----
+
+    def start(self):
+        """Bootstrap, primeira distribuição e thread de heartbeat (renova as leases a cada 1/3 do prazo)."""
+        self.bootstrap()
+        self.rebalance()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="shard-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _heartbeat_loop(self):
+        interval = max(1.0, self.lease_seconds / 3.0)
+        while not self._stop.wait(interval):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                log.warning("falha no heartbeat do sharding: %s", e)
+
+    def stop(self):
+        """Libera as partições e remove o registro do worker (os demais assumem no próximo ciclo)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            for part in self.owned():
+                self.release(part, "encerramento")
+            with database.get_engine().begin() as conn:
+                conn.execute(SQL_DELETE_WORKER, {"name": WORKER_PREFIX + self.worker_id, "me": self.worker_id})
+        except Exception as e:
+            log.warning("falha ao liberar as partições do sharding: %s", e)
@@ -1,37 +1,141 @@
 import os
 import json
+import threading
+import time
 from typing import Dict, Optional, Any
 from pathlib import Path
 
 import requests
 
+import applog
+import async_http
 import config
 
+log = applog.get_logger(__name__)
+
 
 class SheetsCache:
-    """Cache para dados do Google Sheets com informações de materiais (DESCMAT)."""
+    """
+    Cache para dados do Google Sheets com informações de materiais (DESCMAT).
+    Os dados são salvos em um snapshot local (carregado no start) e atualizados
+    periodicamente por uma thread em background; se o Google estiver fora do ar,
+    o último snapshot bom continua em uso.
+    """
 
-    def __init__(self, sheet_id: str, range_name: str, api_key: str):
+    def __init__(self, sheet_id: str, range_name: str, api_key: str,
+                 snapshot_path: Optional[str] = None, refresh_seconds: Optional[float] = None):
         self.sheet_id = sheet_id
         self.range_name = range_name
         self.api_key = api_key
+        self.snapshot_path = snapshot_path if snapshot_path is not None else config.GOOGLE_SHEET_CACHE_PATH
+        self.refresh_seconds = config.GOOGLE_SHEET_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
         # Cache: {TEST_ID: {"TEST_NAME": "...", "SUPPORT_LAB_DESCMAT": "..."}}
-        self.cache: Dict[str, Dict[str, str]] = {}
+        self._cache: Dict[str, Dict[str, str]] = {}
+        # Incrementado a cada publicação do cache (invalida memos de quem usa os dados)
+        self.generation = 0
+        self.loaded_at = 0.0  # epoch dos dados em uso (download ou snapshot)
         self._loaded = False
+        self._lock = threading.Lock()
+        if config.HTTP_TRANSPORT == "async":
+            self._session = async_http.get_transport().session()
+        else:
+            self._session = requests.Session()
+        self._bg_thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def cache(self) -> Dict[str, Dict[str, str]]:
+        return self._cache
+
+    @cache.setter
+    def cache(self, value: Dict[str, Dict[str, str]]):
+        self._cache = value
+        self.generation += 1
 
     def _build_url(self) -> str:
         """Constrói URL da Google Sheets API v4."""
-        base = "https://sheets.googleapis.com/v4/spreadsheets"
+        base = config.GOOGLE_SHEETS_API_URL.rstrip("/")
         return f"{base}/{self.sheet_id}/values/{self.range_name}?key={self.api_key}"
 
     def ensure_loaded(self):
-        """Carrega dados do Google Sheets se ainda não foram carregados."""
+        """Carrega dados (snapshot local ou Google Sheets) se ainda não foram carregados."""
         if self._loaded:
             return
 
+        with self._lock:
+            if self._loaded:
+                return
+            if not self._load_snapshot():
+                self._load()
+            self._start_background_refresh()
+
+    def snapshot_age(self) -> Optional[float]:
+        """Idade (segundos) dos dados em uso; None se nada foi carregado."""
+        if not self._loaded or not self.loaded_at:
+            return None
+        return max(0.0, time.time() - self.loaded_at)
+
+    # --- snapshot local ---
+    def _load_snapshot(self) -> bool:
+        if not self.snapshot_path or not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f) or {}
+        except Exception as e:
+            log.warning("snapshot da planilha inválido em %s: %s", self.snapshot_path, e)
+            return False
+        if snap.get("sheet_id") != self.sheet_id or snap.get("range") != self.range_name:
+            return False
+        self.cache = snap.get("rows") or {}
+        self.loaded_at = float(snap.get("fetched_at") or 0)
+        self._loaded = True
+        log.info("Carregado %d exames do snapshot local (idade %.0fs)", len(self.cache), time.time() - self.loaded_at)
+        return True
+
+    def _save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+            tmp = f"{self.snapshot_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({
+                    "sheet_id": self.sheet_id,
+                    "range": self.range_name,
+                    "fetched_at": self.loaded_at,
+                    "rows": self.cache,
+                }, f, ensure_ascii=False)
+            os.replace(tmp, self.snapshot_path)
+        except Exception as e:
+            log.warning("falha ao gravar snapshot da planilha %s: %s", self.snapshot_path, e)
+
+    # --- refresh em background ---
+    def _start_background_refresh(self):
+        if self.refresh_seconds <= 0 or (self._bg_thread and self._bg_thread.is_alive()):
+            return
+        self._bg_thread = threading.Thread(target=self._refresh_loop, name="sheets-refresh", daemon=True)
+        self._bg_thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            age = self.snapshot_age() or 0.0
+            if self._stop.wait(max(0.0, self.refresh_seconds - age)):
+                return
+            try:
+                self._load()
+            except Exception as e:
+                # Mantém o último snapshot bom; tenta de novo no próximo intervalo
+                log.warning("refresh falhou, mantendo dados de %.0fs atrás: %s", self.snapshot_age() or 0, e)
+                self._stop.wait(self.refresh_seconds)
+
+    def stop(self):
+        self._stop.set()
+
+    def _load(self):
         url = self._build_url()
         try:
-            resp = requests.get(url, timeout=30)
+            resp = self._session.get(url, timeout=30)
 
             if resp.status_code != 200:
                 raise RuntimeError(
@@ -42,8 +146,11 @@ class SheetsCache:
             rows = data.get("values", [])
 
             if not rows:
-                print("[sheets] Aviso: Planilha vazia ou sem dados")
+                log.warning("Planilha vazia ou sem dados")
+                self.cache = {}
+                self.loaded_at = time.time()
                 self._loaded = True
+                self._save_snapshot()
                 return
 
             # Assume que a primeira linha é o cabeçalho: TEST_ID, TEST_NAME, SUPPORT_LAB_DESCMAT
@@ -59,7 +166,9 @@ class SheetsCache:
                     f"Cabeçalho da planilha deve conter TEST_ID, TEST_NAME e SUPPORT_LAB_DESCMAT: {e}"
                 )
 
-            # Processa linhas de dados (pula cabeçalho)
+            # Processa linhas de dados (pula cabeçalho) em um dict local;
+            # o cache só é publicado completo, pois outros workers podem estar lendo
+            cache: Dict[str, Dict[str, str]] = {}
             for row in rows[1:]:
                 if len(row) <= max(idx_test_id, idx_test_name, idx_descmat):
                     # Linha incompleta, pula
@@ -72,13 +181,16 @@ class SheetsCache:
                 if not test_id:
                     continue
 
-                self.cache[test_id.upper()] = {
+                cache[test_id.upper()] = {
                     "TEST_NAME": test_name,
                     "SUPPORT_LAB_DESCMAT": descmat
                 }
 
+            self.cache = cache
+            self.loaded_at = time.time()
             self._loaded = True
-            print(f"[sheets] Carregado {len(self.cache)} exames da planilha Google Sheets")
+            self._save_snapshot()
+            log.info("Carregado %d exames da planilha Google Sheets", len(self.cache))
 
         except Exception as e:
             raise RuntimeError(f"Erro ao acessar Google Sheets: {e}")
@@ -117,6 +229,7 @@ class SheetsCache:
 
 # Instância global do cache
 _SHEETS_CACHE: Optional[SheetsCache] = None
+_SHEETS_CACHE_LOCK = threading.Lock()
 
 
 def _get_sheets_cache() -> Optional[SheetsCache]:
@@ -137,7 +250,9 @@ def _get_sheets_cache() -> Optional[SheetsCache]:
     if not range_name:
         range_name = "Sheet1!A:C"  # Default
 
-    _SHEETS_CACHE = SheetsCache(sheet_id, range_name, api_key)
+    with _SHEETS_CACHE_LOCK:
+        if _SHEETS_CACHE is None:
+            _SHEETS_CACHE = SheetsCache(sheet_id, range_name, api_key)
     return _SHEETS_CACHE
 
 
@@ -163,3 +278,27 @@ def get_test_info(test_id: Optional[str]) -> Optional[Dict[str, str]]:
         return None
 
     return cache.get_info(test_id)
+
+
+def get_generation() -> int:
+    """
+    Versão dos dados da planilha em uso (muda a cada carga ou atualização).
+    Retorna 0 se o Google Sheets não está configurado.
+    """
+    cache = _get_sheets_cache()
+    if not cache:
+        return 0
+
+    return cache.generation
+
+
+def get_snapshot_age() -> Optional[float]:
+    """
+    Idade (segundos) dos dados da planilha em uso.
+    Retorna None se o Google Sheets não está configurado ou ainda não foi carregado.
+    """
+    cache = _get_sheets_cache()
+    if not cache:
+        return None
+
+    return cache.snapshot_age()
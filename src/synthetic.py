@@ -0,0 +1,178 @@
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import applog
+
+log = applog.get_logger(__name__)
+
+# =========================
+# Base sintética (SQLite) para testes de carga
+# =========================
+# Cria no arquivo SQLite as tabelas lidas pelo monitor (ItemSol, solicitacao, paciente,
+# texame) com as colunas usadas em database.SQL_FETCH_COLUMNS e as preenche com dados
+# aleatórios reproduzíveis (seed). Com DB_BACKEND=sqlite e SQLITE_PATH apontando para o
+# mesmo arquivo, poll_once roda ponta a ponta sem SQL Server. `append` acrescenta novas
+# solicitações depois dos ids existentes (simula a chegada de itens com o monitor rodando).
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS texame (
+      CodTexame INTEGER PRIMARY KEY,
+      CodigoExame TEXT,
+      descricao TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS paciente (
+      codpaciente INTEGER PRIMARY KEY,
+      nome TEXT, cpf TEXT, datanasc DATE, fone TEXT, EmailPac TEXT,
+      cidade TEXT, uf TEXT, sexo TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS solicitacao (
+      codsolicitacao INTEGER PRIMARY KEY,
+      codpaciente INTEGER, CodConvenio INTEGER, dtaentrada TIMESTAMP, Hora TEXT,
+      Valortotal REAL, TipoPgto TEXT, Obs_Sol TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS ItemSol (
+      CodItemSol INTEGER PRIMARY KEY,
+      CodSolicitacao INTEGER NOT NULL, DataEntrada TIMESTAMP, DescExames TEXT, CodConvExames INTEGER,
+      NomeTerceirizado TEXT, Valor REAL, VlTerceirizado REAL, SituacaoResultado TEXT, Origem TEXT,
+      CodTExame INTEGER
+    )""",
+    # Mesmo índice de cobertura sugerido pelo index_advisor (sem INCLUDE no SQLite)
+    "CREATE INDEX IF NOT EXISTS IX_ItemSol_Monitor_Terceirizado ON ItemSol (NomeTerceirizado, CodItemSol)",
+    "CREATE INDEX IF NOT EXISTS IX_ItemSol_CodSolicitacao ON ItemSol (CodSolicitacao)",
+]
+
+_FIRST_NAMES = ("ANA", "JOSE", "MARIA", "JOAO", "PAULA", "CARLOS", "LUCIA", "PEDRO", "JULIA", "MARCOS")
+_LAST_NAMES = ("SILVA", "SANTOS", "OLIVEIRA", "SOUZA", "LIMA", "PEREIRA", "COSTA", "RODRIGUES", "ALVES", "GOMES")
+_CITIES = (("SAO PAULO", "SP"), ("CAMPINAS", "SP"), ("BELO HORIZONTE", "MG"), ("CURITIBA", "PR"), ("SALVADOR", "BA"))
+_SITUACOES = ("A", "C", "L", "P")
+_ORIGENS = ("API", "BALCAO", "CONVENIO")
+
+
+def exam_code(n: int) -> str:
+    """CodigoExame sintético do texame `n` (1..exams); o benchmark usa os mesmos códigos no /tests."""
+    return f"EX{n:04d}"
+
+
+def connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    return conn
+
+
+def create_schema(conn: sqlite3.Connection, reset: bool = False):
+    if reset:
+        for table in ("ItemSol", "solicitacao", "paciente", "texame", "_MonitorState", "_MonitorOutbox",
+                      "_ItemSolChanges"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+    for ddl in SCHEMA:
+        conn.execute(ddl)
+    conn.commit()
+
+
+def _max_id(conn: sqlite3.Connection, table: str, column: str) -> int:
+    return int(conn.execute(f"SELECT COALESCE(MAX({column}), 0) FROM {table}").fetchone()[0])
+
+
+def _chunks(rows: Iterator[tuple], size: int) -> Iterator[List[tuple]]:
+    batch: List[tuple] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(
+    path: str,
+    solicitacoes: int,
+    items_per_sol: Tuple[int, int] = (1, 5),
+    terceiros: Sequence[str] = ("DIAGNÓSTICO DO BRASIL - DB",),
+    exams: int = 200,
+    foreign_ratio: float = 0.2,
+    days: int = 30,
+    seed: Optional[int] = 42,
+    reset: bool = False,
+    batch_size: int = 10000,
+) -> Dict[str, float]:
+    """
+    Gera `solicitacoes` solicitações (com paciente) e de items_per_sol[0] a items_per_sol[1]
+    itens cada, distribuídos entre `terceiros`; uma fração `foreign_ratio` dos itens vai para
+    um terceirizado fora do filtro (linhas que a leitura precisa descartar). Ids continuam
+    após os existentes. Retorna contagens e o tempo gasto.
+    """
+    rng = random.Random(seed)
+    terceiros = [t for t in terceiros if t] or ["LAB"]
+    lo, hi = items_per_sol
+    started = time.perf_counter()
+    conn = connect(path)
+    try:
+        create_schema(conn, reset=reset)
+        if not _max_id(conn, "texame", "CodTexame"):
+            conn.executemany(
+                "INSERT INTO texame (CodTexame, CodigoExame, descricao) VALUES (?, ?, ?)",
+                [(n, exam_code(n), f"EXAME SINTETICO {n}") for n in range(1, exams + 1)],
+            )
+        exams = _max_id(conn, "texame", "CodTexame")
+
+        first_sol = _max_id(conn, "solicitacao", "codsolicitacao") + 1
+        first_pac = _max_id(conn, "paciente", "codpaciente") + 1
+        first_item = _max_id(conn, "ItemSol", "CodItemSol") + 1
+        now = datetime.now().replace(microsecond=0)
+        counts = {"solicitacoes": 0, "itens": 0}
+
+        def pacientes():
+            for n in range(solicitacoes):
+                cod = first_pac + n
+                nome = f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)} {rng.choice(_LAST_NAMES)}"
+                cidade, uf = rng.choice(_CITIES)
+                nasc = (now - timedelta(days=rng.randint(365, 90 * 365))).date()
+                yield (cod, nome, f"{rng.randint(0, 99999999999):011d}", nasc, f"119{rng.randint(0, 99999999):08d}",
+                       f"paciente{cod}@example.com", cidade, uf, rng.choice("MF"))
+
+        def solicitacoes_rows():
+            for n in range(solicitacoes):
+                entrada = now - timedelta(seconds=rng.randint(0, days * 86400))
+                yield (first_sol + n, first_pac + n, rng.randint(1, 20), entrada, entrada.strftime("%H:%M:%S"),
+                       round(rng.uniform(10, 900), 2), rng.choice(("DINHEIRO", "CARTAO", "CONVENIO")), None)
+
+        def itens():
+            item = first_item
+            for n in range(solicitacoes):
+                entrada = now - timedelta(seconds=rng.randint(0, days * 86400))
+                for _ in range(rng.randint(lo, hi)):
+                    texame = rng.randint(1, exams)
+                    terceiro = "OUTRO LABORATORIO" if rng.random() < foreign_ratio else rng.choice(terceiros)
+                    valor = round(rng.uniform(5, 300), 2)
+                    yield (item, first_sol + n, entrada, f"EXAME SINTETICO {texame}", rng.randint(1, 9999),
+                           terceiro, valor, round(valor * 0.6, 2), rng.choice(_SITUACOES), rng.choice(_ORIGENS), texame)
+                    item += 1
+                    counts["itens"] += 1
+                counts["solicitacoes"] += 1
+
+        for chunk in _chunks(pacientes(), batch_size):
+            conn.executemany("INSERT INTO paciente VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", chunk)
+        for chunk in _chunks(solicitacoes_rows(), batch_size):
+            conn.executemany("INSERT INTO solicitacao VALUES (?, ?, ?, ?, ?, ?, ?, ?)", chunk)
+        for chunk in _chunks(itens(), batch_size):
+            conn.executemany("INSERT INTO ItemSol VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", chunk)
+            conn.commit()
+        conn.commit()
+    finally:
+        conn.close()
+    counts["segundos"] = round(time.perf_counter() - started, 3)
+    counts["primeiro_item"] = first_item
+    log.info("base sintética %s: %d solicitação(ões), %d item(ns) em %.1fs",
+             path, counts["solicitacoes"], counts["itens"], counts["segundos"])
+    return counts
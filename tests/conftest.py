@@ -0,0 +1,105 @@
+import sys
+from pathlib import Path
+
+# Os módulos do monitor ficam em src/ (como no main.py); a raiz tem os scripts (retry_failed.py...)
+ROOT_DIR = Path(__file__).resolve().parents[1]
+for path in (ROOT_DIR, ROOT_DIR / "src"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def set_config(monkeypatch):
+    """Atribui valores em `config` só durante o teste (config.X = valor, desfeito no fim)."""
+    import config
+
+    def apply(**values):
+        for name, value in values.items():
+            monkeypatch.setattr(config, name, value, raising=False)
+    return apply
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, set_config):
+    """DB_BACKEND=sqlite em um arquivo novo por teste (engine recriado no fim)."""
+    import database
+
+    path = str(tmp_path / "monitor.sqlite")
+    database.dispose_engine()
+    set_config(DB_BACKEND="sqlite", SQLITE_PATH=path)
+    yield path
+    database.dispose_engine()
+
+
+@pytest.fixture
+def mock_api(set_config, tmp_path):
+    """
+    Sobe a API simulada (mock_bemsoft) em uma thread e aponta o envio para ela.
+    Retorna start(**opções) -> estado do servidor (contadores e, com record_posts, os POSTs).
+    """
+    import bemsoft_api
+    import mock_bemsoft
+    import sheets_client
+    from benchmark_payload import _load_catalogs
+
+    servers = []
+
+    def start(**options):
+        options.setdefault("latency_ms", 0.0)
+        options.setdefault("jitter_ms", 0.0)
+        options.setdefault("record_posts", True)
+        server = mock_bemsoft.make_server(options)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        servers.append(server)
+        host, port = server.server_address
+        set_config(
+            BASE_URL=f"http://{host}:{port}", REQS_ENDPOINT="/requests", TOKEN="test", DRY_RUN=False,
+            RETRIES_BACKOFF=0.01, RATE_PER_SECOND=0.0, ADAPTIVE_CONCURRENCY=False, HTTP_TRANSPORT="sync",
+            TEST_MAP_PATH="", LAB_OVERRIDES={},
+        )
+        _load_catalogs(int(options.get("exams") or mock_bemsoft.DEFAULT_OPTIONS["exams"]))
+        return server.RequestHandlerClass.state
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    bemsoft_api._TESTS_INDEX = None
+    sheets_client._SHEETS_CACHE = None
+
+
+def make_event(cod, items=None, day="2026-10-01", lab=None):
+    """Evento no formato de main.build_group_event com exames do catálogo simulado (EX0001...)."""
+    items = items or [cod * 10]
+    event = {
+        "solicitacao": {"codsolicitacao": cod, "codpaciente": cod, "CodConvenio": 1,
+                        "dtaentrada": f"{day}T08:00:00", "Hora": "08:00:00"},
+        "paciente": {"codpaciente": cod, "nome": f"PACIENTE {cod}", "datanasc": "1980-01-01", "sexo": "FEMININO"},
+        "itens": [
+            {"CodItemSol": i, "DataEntrada": f"{day}T08:00:00", "DescExames": "EXAME", "CodigoExame": "EX0001",
+             "Origem": "API", "ExameDescricao": "EXAME"}
+            for i in items
+        ],
+    }
+    if lab:
+        event["lab"] = lab
+    return event
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    """main com o estado do processo zerado: configure() monta tudo de novo com o config do teste."""
+    import main
+
+    for name in ("SOURCE", "SHARDS", "RETRY_QUEUE", "BREAKER", "PIPELINE"):
+        monkeypatch.setattr(main, name, None)
+    monkeypatch.setattr(main, "LAB_PIPELINES", [])
+    monkeypatch.setattr(main, "PENDING_SOLICITACOES", {})
+    yield main
+    if main.SHARDS is not None:
+        main.SHARDS.stop()
@@ -0,0 +1,108 @@
+"""send_batch_to_bemsoft contra a API simulada (mock_bemsoft em uma thread)."""
+import bemsoft_api
+from conftest import make_event
+
+
+def _orders(post):
+    batch = post["body"]["batch"]
+    return batch["orders"] if "orders" in batch else [batch["order"]]
+
+
+def test_packs_orders_with_per_order_keys(mock_api, set_config):
+    state = mock_api()
+    set_config(BATCH_MAX_ORDERS=2, BATCH_MAX_BYTES=1 << 20)
+    events = [make_event(cod) for cod in range(1, 6)]
+
+    results = bemsoft_api.send_batch_to_bemsoft(events)
+
+    assert [r["ok"] for r in results] == [True] * 5
+    assert [len(_orders(p)) for p in state.requests] == [2, 2, 1]
+    for post in state.requests[:2]:
+        keys = [o["idempotencyKey"] for o in post["body"]["batch"]["orders"]]
+        assert keys == [f"sol-{o['externalId'].split('-')[1]}" for o in _orders(post)]
+        assert post["key"] == bemsoft_api._batch_key(keys)
+    # A order que sai sozinha leva a chave no cabeçalho, como em send_to_bemsoft
+    single = state.requests[2]
+    assert single["key"] == "sol-5"
+    assert "idempotencyKey" not in single["body"]["batch"]["order"]
+    assert state.stats()["orders"] == 5
+
+
+def test_batch_key_is_fixed_length_and_order_independent():
+    few = bemsoft_api._batch_key(["sol-1", "sol-2"])
+    many = bemsoft_api._batch_key([f"sol-{cod}-r20261001080000-LAB_{cod}" for cod in range(500)])
+    assert len(few) == len(many) <= 64
+    assert few == bemsoft_api._batch_key(["sol-2", "sol-1"])
+    assert few != bemsoft_api._batch_key(["sol-1", "sol-3"])
+
+
+def test_packs_only_orders_of_the_same_date(mock_api, set_config):
+    state = mock_api()
+    set_config(BATCH_MAX_ORDERS=10, BATCH_MAX_BYTES=1 << 20)
+    days = ["2026-10-01", "2026-10-02", "2026-10-01", "2026-10-02", "2026-10-01"]
+    events = [make_event(cod, day=day) for cod, day in enumerate(days, start=1)]
+
+    results = bemsoft_api.send_batch_to_bemsoft(events)
+
+    assert all(r["ok"] for r in results)
+    assert len(state.requests) == 2
+    for post in state.requests:
+        header_date = post["body"]["batch"]["date"]
+        assert {o["date"] for o in _orders(post)} == {header_date}
+    assert sorted(len(_orders(p)) for p in state.requests) == [2, 3]
+
+
+def test_rejected_batch_falls_back_to_single_orders(mock_api, set_config):
+    state = mock_api(invalid_external_ids=["order-2"])
+    set_config(BATCH_MAX_ORDERS=3, BATCH_MAX_BYTES=1 << 20)
+    events = [make_event(cod) for cod in (1, 2, 3)]
+
+    results = bemsoft_api.send_batch_to_bemsoft(events)
+
+    assert [r["ok"] for r in results] == [True, False, True]
+    assert results[1]["status"] == 400
+    first, *singles = state.requests
+    assert first["status"] == 400 and len(_orders(first)) == 3
+    # O reenvio avulso sai igual ao de send_to_bemsoft: chave só no cabeçalho
+    assert [p["key"] for p in singles] == ["sol-1", "sol-2", "sol-3"]
+    for post in singles:
+        assert "order" in post["body"]["batch"]
+        assert "idempotencyKey" not in post["body"]["batch"]["order"]
+
+
+def test_exception_only_fails_its_own_chunk(mock_api, set_config, monkeypatch):
+    mock_api()
+    set_config(BATCH_MAX_ORDERS=2, BATCH_MAX_BYTES=1 << 20)
+    real_post = bemsoft_api._throttled_post
+    calls = []
+
+    def flaky_post(sess, url, body, headers):
+        calls.append(headers["Idempotency-Key"])
+        if len(calls) == 2:
+            raise ConnectionError("conexão recusada")
+        return real_post(sess, url, body, headers)
+
+    monkeypatch.setattr(bemsoft_api, "_throttled_post", flaky_post)
+    events = [make_event(cod) for cod in range(1, 7)]
+
+    results = bemsoft_api.send_batch_to_bemsoft(events)
+
+    assert [r["ok"] for r in results] == [True, True, False, False, True, True]
+    assert results[2]["batch"] == results[3]["batch"] == calls[1]
+
+
+def test_committed_batch_resent_per_order_is_not_duplicated(mock_api, set_config):
+    state = mock_api(commit_error_rate=1.0)
+    set_config(BATCH_MAX_ORDERS=4, BATCH_MAX_BYTES=1 << 20, RETRIES_TOTAL=0)
+    events = [make_event(cod) for cod in range(1, 5)]
+
+    first = bemsoft_api.send_batch_to_bemsoft(events)
+    assert not any(r["ok"] for r in first)
+
+    # A API gravou o lote e respondeu 500: o reenvio avulso de cada order volta 409
+    state.options["commit_error_rate"] = 0.0
+    retried = [bemsoft_api.send_to_bemsoft(ev) for ev in events]
+
+    assert all(r["ok"] and r["status"] == 409 for r in retried)
+    assert state.stats()["orders"] == 4
+    assert state.stats()["duplicate_orders"] == 0
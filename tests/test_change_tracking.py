@@ -0,0 +1,110 @@
+"""SOURCE_DRIVER=changetracking sobre a emulação do Change Tracking no SQLite."""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+import change_tracking
+import config
+import database
+import synthetic
+
+LAB = "DIAGNÓSTICO DO BRASIL - DB"
+CHECKPOINT = text("SELECT LastItemId FROM dbo._MonitorState WHERE Name = 'ItemSolChangeTracking';")
+UPDATE = text("UPDATE dbo.ItemSol SET {column} = :value WHERE CodItemSol = :item;")
+ITEMS = text("SELECT CodItemSol, CodSolicitacao FROM dbo.ItemSol ORDER BY CodItemSol;")
+
+
+@pytest.fixture
+def ct_db(sqlite_db, set_config):
+    synthetic.generate(sqlite_db, 3, items_per_sol=(2, 2), terceiros=[LAB], foreign_ratio=0.0, seed=3, reset=True)
+    set_config(SOURCE_DRIVER="changetracking", TERCEIROS=[LAB], FETCH_PAGE_SIZE=1000)
+    change_tracking.bootstrap_state()
+    return sqlite_db
+
+
+def _checkpoint():
+    with database.get_engine().connect() as conn:
+        return conn.execute(CHECKPOINT).scalar()
+
+
+def _items():
+    with database.get_engine().connect() as conn:
+        return conn.execute(ITEMS).all()
+
+
+def _update(item, column, value):
+    with database.get_engine().begin() as conn:
+        conn.execute(text(UPDATE.text.format(column=column)), {"item": item, "value": value})
+
+
+def _generate(count):
+    synthetic.generate(config.SQLITE_PATH, count, items_per_sol=(2, 2), terceiros=[LAB],
+                       foreign_ratio=0.0, seed=5)
+
+
+def test_bootstrap_starts_at_the_current_version(ct_db):
+    # As linhas anteriores ao startup não são mudanças: o histórico fica com o keyset
+    assert _checkpoint() == 0
+    last, count, groups = change_tracking.claim_groups([LAB])
+    assert (count, groups) == (0, {})
+
+    change_tracking.bootstrap_state()
+    assert _checkpoint() == 0
+
+
+def test_inserted_items_are_grouped_without_revision(ct_db):
+    _generate(2)
+    new = _items()[-4:]
+
+    last, count, groups = change_tracking.claim_groups([LAB])
+    assert (last, count) == (0, 4)
+    assert sorted(groups) == sorted({cod for _item, cod in new})
+    for cod, group in groups.items():
+        assert "revisao" not in group
+        assert [r["CodItemSol"] for r in group["items"]] == [item for item, c in new if c == cod]
+    assert sorted(p for g in groups.values() for p in g["positions"]) == [1, 2, 3, 4]
+
+
+def test_payload_update_rereads_the_whole_solicitacao(ct_db):
+    (item, cod), (other, _cod) = _items()[:2]
+    _update(item, "DescExames", "EXAME ALTERADO")
+
+    last, count, groups = change_tracking.claim_groups([LAB])
+    assert count == 1 and list(groups) == [cod]
+    group = groups[cod]
+    assert group["revisao"] == 1 and group["positions"] == [1]
+    # O pedido reenviado leva todos os itens da solicitação, não só o alterado
+    assert [r["CodItemSol"] for r in group["items"]] == [item, other]
+    assert group["items"][0]["DescExames"] == "EXAME ALTERADO"
+
+
+def test_non_payload_only_page_advances_the_checkpoint(ct_db):
+    item, _cod = _items()[0]
+    _update(item, "SituacaoResultado", "LIBERADO")
+    _update(item, "Valor", 1.5)
+
+    assert change_tracking.claim_groups([LAB]) == (2, 0, {})
+    assert _checkpoint() == 2
+    assert change_tracking.claim_groups([LAB]) == (2, 0, {})
+
+
+def test_page_ends_on_a_whole_version_and_checkpoint_never_regresses(ct_db, set_config):
+    _generate(3)
+    set_config(FETCH_PAGE_SIZE=4)
+
+    last, count, groups = change_tracking.claim_groups([LAB])
+    assert (last, count) == (0, 4)
+    change_tracking.commit_checkpoint(max(p for g in groups.values() for p in g["positions"]))
+    assert _checkpoint() == 4
+
+    last, count, groups = change_tracking.claim_groups([LAB])
+    assert (last, count) == (4, 2)
+    change_tracking.commit_checkpoint(6)
+    change_tracking.commit_checkpoint(3)
+    assert _checkpoint() == 6
+
+    with database.get_engine().connect() as conn:
+        assert change_tracking.fetch_lag(conn, 6, [LAB]) == (6, None)
+        max_version, oldest = change_tracking.fetch_lag(conn, 4, [LAB])
+    assert max_version == 6 and isinstance(oldest, datetime)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import failstore
+
+
+def _event(cod, items, lab=None):
+    event = {"solicitacao": {"codsolicitacao": cod}, "paciente": {}, "itens": [{"CodItemSol": i} for i in items]}
+    if lab:
+        event["lab"] = lab
+    return event
+
+
+def _open(directory):
+    return failstore.FailureLog(str(directory), max_bytes=1 << 20, compress=False)
+
+
+@pytest.mark.parametrize("keep_index", [True, False])
+def test_partial_line_is_discarded_before_next_write(tmp_path, keep_index):
+    store = _open(tmp_path)
+    store.append(_event(1, [10]), "timeout")
+    store.close()
+    # Crash no meio de uma escrita: fragmento sem "\n" no fim do segmento ativo
+    with open(tmp_path / "failures-000001.jsonl", "ab") as f:
+        f.write(b'{"ts": "20260101T000000000000", "cod": "2", "ev')
+    if not keep_index:
+        os.remove(tmp_path / failstore.INDEX_NAME)
+
+    store = _open(tmp_path)
+    store.append(_event(3, [30]), "500")
+    assert failstore.item_ids(store.read("3")["event"]) == {"30"}
+    store.close()
+
+    reopened = _open(tmp_path)
+    assert [p["cod"] for p in reopened.pending()] == ["1", "3"]
+    reopened.append(_event(3, [31]), "500")
+    assert failstore.item_ids(reopened.read("3")["event"]) == {"30", "31"}
+
+
+def test_replaced_entry_keeps_earlier_items(tmp_path):
+    store = _open(tmp_path)
+    ts = store.append(_event(5, [1]), "timeout")
+    newer = store.append(_event(5, [2]), "timeout")
+    assert failstore.item_ids(store.read("5")["event"]) == {"1", "2"}
+    # A retentativa só com os itens novos não resolve a entrada unida
+    assert not store.resolve("5", newer, {"2"})
+    assert not store.resolve("5", ts, {"1", "2"})
+    assert store.resolve("5", newer, {"1", "2"})
+    assert len(store) == 0
+
+
+def test_labs_of_the_same_solicitacao_are_separate_entries(tmp_path):
+    store = _open(tmp_path)
+    store.append(_event(7, [1], lab="LAB_A"), "x")
+    store.append(_event(7, [2], lab="LAB_B"), "y")
+    assert sorted(p["cod"] for p in store.pending()) == ["7-LAB_A", "7-LAB_B"]
@@ -0,0 +1,56 @@
+"""Identificadores enviados à API e chaves de falha com LAB_PIPELINES=1."""
+import bemsoft_api
+import config
+import failstore
+from conftest import make_event
+
+ENV = {
+    "BEMSOFT_TOKEN": "t",
+    "LAB_PIPELINES": "1",
+    "TERCEIROS": "LAB A,LAB B",
+}
+
+
+def test_lab_does_not_change_keys_by_default(mock_api, set_config):
+    mock_api()
+    set_config(LAB_SCOPED_IDS=False)
+    event = make_event(123, lab="LAB_A")
+
+    order, batch_id, _date, _time = bemsoft_api.build_order(event)
+
+    assert bemsoft_api._event_key(event) == batch_id == "sol-123"
+    assert order["externalId"] == "order-123"
+    # O estado local continua separado por laboratório
+    assert failstore.failure_key(event) == "123-LAB_A"
+
+
+def test_scoped_ids_add_the_lab_slug(mock_api, set_config):
+    mock_api()
+    set_config(LAB_SCOPED_IDS=True)
+    event = make_event(123, lab="LAB_A")
+    event["revisao"] = 9
+
+    order, batch_id, _date, _time = bemsoft_api.build_order(event)
+
+    assert bemsoft_api._event_key(event) == "sol-123-r9-LAB_A"
+    assert batch_id == "sol-123-LAB_A" and order["externalId"] == "order-123-LAB_A"
+    assert failstore.failure_key(event) == "123-r9-LAB_A"
+
+
+def test_shared_endpoint_requires_scoped_ids():
+    problems = config.Settings.from_env(ENV).validate()
+    assert any("LAB_SCOPED_IDS=1" in p for p in problems)
+
+    assert config.Settings.from_env(dict(ENV, LAB_SCOPED_IDS="1")).validate() == []
+
+
+def test_separate_endpoints_keep_stable_ids():
+    env = dict(ENV, LAB_LAB_B_BASE_URL="https://lab-b.invalid")
+    assert config.Settings.from_env(env).validate() == []
+
+
+def test_send_workers_add_up_every_lab(set_config):
+    set_config(LAB_PIPELINES=True, TERCEIROS=["LAB A", "LAB B", "LAB C"], MAX_WORKERS=4,
+               LAB_OVERRIDES={"LAB_B": {"max_workers": 2}})
+    # Laboratórios sem override usam BEMSOFT_MAX_WORKERS
+    assert bemsoft_api._send_workers() == 10
@@ -0,0 +1,129 @@
+"""Outbox durável (OUTBOX_ENABLED=1) em SQLite: reivindicação e retentativa das linhas."""
+import os
+
+import pytest
+from sqlalchemy import text
+
+import database
+import outbox
+import synthetic
+
+LAB = "DIAGNÓSTICO DO BRASIL - DB"
+ROWS = text("SELECT CodSolicitacao, Status, Attempts, NextAttemptAt, ClaimedBy FROM dbo._MonitorOutbox;")
+SET_PAST = text("UPDATE dbo._MonitorOutbox SET {column} = '2000-01-01 00:00:00' WHERE CodSolicitacao IN ({cods});")
+
+
+@pytest.fixture
+def outbox_db(sqlite_db, set_config):
+    synthetic.generate(sqlite_db, 12, items_per_sol=(1, 3), terceiros=[LAB], foreign_ratio=0.0, seed=7, reset=True)
+    set_config(
+        TERCEIROS=[LAB], OUTBOX_ENABLED=True, DEBOUNCE_SECONDS=0, FETCH_PAGE_SIZE=1000, WORKER_ID="monitor-a",
+        OUTBOX_CLAIM_SECONDS=600, RETRY_MAX_ATTEMPTS=2, RETRY_BASE_SECONDS=1.0, RETRY_MAX_SECONDS=1.0,
+        ITEMSOL_INDEX_BOOTSTRAP="off",
+    )
+    database.bootstrap_state()
+    outbox.bootstrap()
+    outbox.ingest_page([LAB])
+    return sqlite_db
+
+
+def _rows():
+    with database.get_engine().connect() as conn:
+        return {r.CodSolicitacao: r for r in conn.execute(ROWS)}
+
+
+def _set_past(column, cods):
+    with database.get_engine().begin() as conn:
+        conn.execute(text(SET_PAST.text.format(column=column, cods=",".join(str(c) for c in cods))))
+
+
+def _ready(limit=1000):
+    return [cod for cod, *_ in outbox.load_ready([LAB], limit, 0)]
+
+
+def _mark(cods, status, retry_in=None, http_status=None):
+    with database.get_engine().connect() as conn:
+        items = dict(conn.execute(text("SELECT CodSolicitacao, ItemIds FROM dbo._MonitorOutbox;")).all())
+    outbox.mark_results([{"cod": cod, "items": items[cod], "status": status, "http_status": http_status,
+                          "retry_in": retry_in} for cod in cods])
+
+
+def test_selected_rows_are_claimed(outbox_db, set_config):
+    first = _ready(limit=5)
+    assert len(first) == 5
+    assert {r.ClaimedBy for cod, r in _rows().items() if cod in first} == {"monitor-a"}
+
+    # Outro monitor no mesmo banco só recebe as linhas que ninguém reivindicou
+    set_config(WORKER_ID="monitor-b")
+    second = _ready()
+    assert len(second) == 7 and set(second).isdisjoint(first)
+    assert _ready() == []
+
+    # Reivindicação liberada sem resultado (circuito aberto): volta para a fila
+    set_config(WORKER_ID="monitor-a")
+    outbox.release(first[:2])
+    assert _ready() == first[:2]
+
+
+def test_expired_claim_is_taken_over(outbox_db, set_config):
+    cods = _ready()
+    set_config(WORKER_ID="monitor-b")
+    assert _ready() == []
+    _set_past("ClaimedUntil", cods[:3])
+    assert _ready() == cods[:3]
+
+
+def test_transient_failure_is_retried_after_backoff(outbox_db):
+    cods = _ready()
+    cod = cods[0]
+    _mark([cod], outbox.STATUS_FAILED, retry_in=30, http_status=503)
+    _mark(cods[1:], outbox.STATUS_SENT, http_status=201)
+
+    row = _rows()[cod]
+    assert (row.Status, row.Attempts, row.ClaimedBy) == ("failed", 1, None)
+    assert row.NextAttemptAt is not None
+    assert outbox.retrying_count() == 1
+    assert _ready() == []
+
+    _set_past("NextAttemptAt", [cod])
+    assert outbox.load_ready([LAB], 1000, 0)[0][3] == 1   # Attempts da linha
+    _mark([cod], outbox.STATUS_SENT, http_status=201)
+    row = _rows()[cod]
+    assert (row.Status, row.NextAttemptAt) == ("sent", None)
+    assert _ready() == []
+
+
+def test_permanent_failure_is_not_retried(outbox_db):
+    cods = _ready()
+    _mark(cods, outbox.STATUS_FAILED, http_status=400)
+    _set_past("FirstSeen", cods)
+    assert _ready() == []
+
+
+def test_retry_delay(set_config):
+    set_config(RETRY_MAX_ATTEMPTS=2, RETRY_BASE_SECONDS=4.0, RETRY_MAX_SECONDS=60.0)
+    assert 2 <= outbox.retry_delay(0, True) <= 4
+    assert 4 <= outbox.retry_delay(1, True) <= 8
+    assert outbox.retry_delay(2, True) is None
+    assert outbox.retry_delay(0, False) is None
+
+
+def test_poll_retries_durably_without_failure_files(outbox_db, mock_api, set_config, monitor, tmp_path):
+    state = mock_api(error_rate=1.0)
+    failed_dir = tmp_path / "failed"
+    failed_dir.mkdir()
+    set_config(FAILED_STORE="files", FAILED_DIR=str(failed_dir), RETRIES_TOTAL=0, MAX_WORKERS=1,
+               BATCH_MAX_ORDERS=1, BREAKER_FAILURE_THRESHOLD=0, TERCEIROS=[LAB])
+
+    monitor._poll_outbox(None)
+    rows = _rows()
+    assert {r.Status for r in rows.values()} == {"failed"}
+    assert all(r.NextAttemptAt is not None and r.ClaimedBy is None for r in rows.values())
+    # A retentativa fica na linha do outbox; nada vai para FAILED_DIR
+    assert [n for n in os.listdir(failed_dir) if n.endswith(".json")] == []
+
+    state.options["error_rate"] = 0.0
+    _set_past("NextAttemptAt", list(rows))
+    monitor._poll_outbox(None)
+    assert {r.Status for r in _rows().values()} == {"sent"}
+    assert state.stats()["orders"] == len(rows)
@@ -0,0 +1,128 @@
+"""Freio dos envios (ratelimit): token bucket, cabeçalhos da API e concorrência AIMD."""
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+import ratelimit
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return 1_700_000_000.0 + self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(ratelimit, "time",
+                        types.SimpleNamespace(monotonic=fake.monotonic, sleep=fake.sleep, time=fake.time))
+    return fake
+
+
+def _fast_rounds(conc, rounds, latency=0.02):
+    """Rodadas de respostas rápidas: uma resposta por vaga do limite atual."""
+    for _ in range(rounds):
+        for _ in range(int(conc.limit)):
+            assert conc.observe(latency, overloaded=False) is None
+
+
+def test_token_bucket_limits_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=2.0)
+    assert bucket.try_acquire() == 0.0 and bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(0.5)
+    clock.now += 10
+    # Acumula no máximo `burst` fichas
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, pytest.approx(0.5)]
+
+
+def test_token_bucket_pause_holds_even_without_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=0)
+    assert bucket.try_acquire() == 0.0
+    bucket.pause(3)
+    assert bucket.try_acquire() == pytest.approx(3.0)
+    clock.now += 3
+    assert bucket.try_acquire() == 0.0
+
+
+def test_parse_retry_after():
+    now = datetime(2026, 10, 1, 12, 0, 0, tzinfo=timezone.utc)
+    assert ratelimit.parse_retry_after("7") == 7.0
+    assert ratelimit.parse_retry_after("Thu, 01 Oct 2026 12:00:30 GMT", now=now) == 30.0
+    assert ratelimit.parse_retry_after("amanhã") is None
+    assert ratelimit.parse_retry_after(None) is None
+
+
+def test_parse_rate_limit(clock):
+    assert ratelimit.parse_rate_limit({"RateLimit-Remaining": "3", "RateLimit-Reset": "2"}) == (3.0, 2.0)
+    epoch = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(clock.time() + 5)}
+    assert ratelimit.parse_rate_limit(epoch) == (0.0, pytest.approx(5.0))
+    assert ratelimit.parse_rate_limit({}) == (None, None)
+
+
+def test_adaptive_concurrency_slow_start_doubles_until_first_decrease(clock):
+    conc = ratelimit.AdaptiveConcurrency(maximum=64)
+    assert conc.limit == 1
+    _fast_rounds(conc, 3)
+    assert conc.limit == 8
+    _fast_rounds(conc, 3)
+    assert conc.limit == 64
+
+    assert conc.observe(0.02, overloaded=True) == "overload"
+    assert int(conc.limit) == 44 and not conc.slow_start
+    # Depois da primeira redução, sobe ~1 por rodada
+    _fast_rounds(conc, 2)
+    assert int(conc.limit) == 46
+
+
+def test_adaptive_concurrency_one_decrease_per_window(clock):
+    conc = ratelimit.AdaptiveConcurrency(maximum=10)
+    _fast_rounds(conc, 4)
+    assert conc.limit == 10
+    assert conc.observe(None, overloaded=True) == "overload"
+    assert conc.observe(None, overloaded=True) is None
+    assert conc.limit == 7
+    clock.now += 1
+    assert conc.observe(None, overloaded=True) == "overload"
+    assert int(conc.limit) == 4
+
+
+def test_adaptive_concurrency_reduces_on_latency(clock):
+    conc = ratelimit.AdaptiveConcurrency(maximum=16)
+    _fast_rounds(conc, 4, latency=0.02)
+    assert conc.limit == 16
+    reasons = [conc.observe(1.0, overloaded=False) for _ in range(3)]
+    assert "latency" in reasons and conc.limit < 16
+
+
+def test_fixed_concurrency_starts_at_maximum(clock):
+    conc = ratelimit.AdaptiveConcurrency(maximum=6, adaptive=False)
+    assert conc.limit == 6
+    assert conc.observe(None, overloaded=True) is None and conc.limit == 6
+
+
+def test_throttle_pauses_on_retry_after(clock):
+    throttle = ratelimit.Throttle("teste", rate=0, max_in_flight=4)
+    reason, pause = throttle.observe(429, 0.01, {"Retry-After": "2"})
+    assert (reason, pause) == ("retry_after", 2.0)
+    assert throttle.try_acquire() == ratelimit.MAX_WAIT_STEP
+    assert throttle.wait() == pytest.approx(2.0)
+
+
+def test_throttle_paces_near_quota_end(clock):
+    throttle = ratelimit.Throttle("teste", rate=10, max_in_flight=8)
+    throttle.observe(201, 0.01, {"RateLimit-Remaining": "2", "RateLimit-Reset": "4"})
+    assert throttle.bucket.rate == pytest.approx(0.5)
+    clock.now += 5
+    throttle.try_acquire()
+    assert throttle.bucket.rate == 10
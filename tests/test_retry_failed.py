@@ -0,0 +1,70 @@
+"""retry_failed.py: journal de progresso (compactação) e fechamento do log de falhas."""
+import argparse
+import os
+
+import failstore
+import main
+import retry_failed
+from conftest import make_event
+
+
+def _args(directory, **overrides):
+    values = dict(dir=str(directory), file=None, send=True, move_ok=None, limit=0, workers=1,
+                  source="files", verbose=False)
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
+def _journal_lines(directory):
+    path = directory / retry_failed.JOURNAL_NAME
+    return path.read_text(encoding="utf-8").splitlines() if path.exists() else []
+
+
+def test_compact_keeps_only_entries_that_still_decide(tmp_path):
+    journal = retry_failed.Journal(str(tmp_path / retry_failed.JOURNAL_NAME))
+    journal.record("20260101T000000000000_1.json", "1", "20260101T000000000000", "failed", status=500)
+    journal.record("20260101T000000000000_1.json", "1", "20260101T000000000000", "ok", status=201, items=["10"])
+    journal.record("20260102T000000000000_2.json", "2", "20260102T000000000000", "ok", status=201, items=["20"])
+    journal.record("20260103T000000000000_3.json", "3", "20260103T000000000000", "failed", status=500)
+
+    # Só a falha de 3 continua no diretório, junto com uma falha antiga da chave 2
+    present = {"20260103T000000000000_3.json", "20251231T000000000000_2.json"}
+    assert journal.compact(present) == 2
+
+    reloaded = retry_failed.Journal(journal.path)
+    assert sorted(reloaded.by_file) == ["20260102T000000000000_2.json", "20260103T000000000000_3.json"]
+    # O envio ok de 2 ainda supera a falha mais antiga dela
+    assert reloaded.covers("2", "20251231T000000000000", {"20"})
+    assert reloaded.lines == 2 and reloaded.compact(present) == 0
+
+
+def test_run_prunes_journal_of_moved_files(tmp_path, mock_api, set_config):
+    state = mock_api(error_rate=1.0)
+    failed_dir, ok_dir = tmp_path / "failed", tmp_path / "ok"
+    failed_dir.mkdir()
+    set_config(FAILED_STORE="files", FAILED_DIR=str(failed_dir), RETRIES_TOTAL=0)
+    main.persist_failed(make_event(1), "HTTP 500")
+    main.persist_failed(make_event(2), "HTTP 500")
+
+    assert retry_failed.run(_args(failed_dir, move_ok=str(ok_dir))) == 1
+    # Falharam de novo: continuam no diretório e no journal
+    assert len(_journal_lines(failed_dir)) == 2
+
+    state.options["error_rate"] = 0.0
+    assert retry_failed.run(_args(failed_dir, move_ok=str(ok_dir))) == 0
+    assert len(os.listdir(ok_dir)) == 2
+    # Os dois foram movidos: nada no journal decide mais nada
+    assert _journal_lines(failed_dir) == []
+
+
+def test_run_log_closes_store_when_nothing_is_pending(tmp_path, monkeypatch):
+    closed = []
+    original = failstore.FailureLog.close
+
+    def close(self):
+        closed.append(self.dir)
+        original(self)
+
+    monkeypatch.setattr(failstore.FailureLog, "close", close)
+    assert retry_failed.run_log(_args(tmp_path, source="log")) == 0
+    assert closed == [str(tmp_path)]
@@ -0,0 +1,145 @@
+"""Fila de retentativas e circuit breaker (retryq), com relógio simulado."""
+import os
+import types
+
+import pytest
+
+import retryq
+from conftest import make_event
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(retryq, "time", types.SimpleNamespace(monotonic=fake.monotonic))
+    return fake
+
+
+def test_is_transient():
+    import requests
+
+    assert retryq.is_transient(500) and retryq.is_transient(503) and retryq.is_transient(429)
+    assert not retryq.is_transient(400) and not retryq.is_transient(401) and not retryq.is_transient(409)
+    assert retryq.is_transient(None, requests.ConnectionError("reset"))
+    assert not retryq.is_transient(None, ValueError("payload"))
+    assert not retryq.is_transient(None)
+
+
+@pytest.mark.parametrize("attempt,low,high", [(1, 0.5, 1.0), (3, 2.0, 4.0), (10, 5.0, 10.0)])
+def test_backoff_delay_is_bounded(attempt, low, high):
+    for _ in range(50):
+        assert low <= retryq.backoff_delay(attempt, 1.0, 10.0) <= high
+
+
+def test_queue_pops_due_entries_in_order(clock):
+    queue = retryq.RetryQueue(max_attempts=3, base_seconds=10.0, max_seconds=60.0)
+    queue.schedule(1, {"n": 1})             # vence entre +5s e +10s (jitter)
+    assert queue.pop_due() == []
+    clock.now += 6
+    queue.schedule(2, {"n": 2})             # vence entre +11s e +16s: sempre depois da primeira
+    clock.now += 60
+    assert [e.cod for e in queue.pop_due()] == [1, 2]
+    # Continuam registradas até done()
+    assert len(queue) == 2 and 1 in queue
+
+
+def test_queue_keeps_one_entry_per_cod(clock):
+    queue = retryq.RetryQueue(max_attempts=5, base_seconds=1.0, max_seconds=60.0)
+    first = queue.schedule(7, {"v": 1})
+    second = queue.schedule(7, {"v": 2})
+
+    assert first is second and second.attempts == 2 and second.group == {"v": 2}
+    clock.now += 120
+    assert [e.cod for e in queue.pop_due()] == [7]
+    # O agendamento anterior virou item obsoleto do heap
+    assert queue.pop_due() == []
+    assert queue.next_due_in() is None
+
+
+def test_queue_gives_up_after_max_attempts(clock):
+    queue = retryq.RetryQueue(max_attempts=2, base_seconds=1.0, max_seconds=60.0)
+    entry = queue.schedule(1, {})
+    assert queue.retry_later(entry, error="HTTP 503")
+    assert not queue.retry_later(entry, error="HTTP 503")
+    assert 1 not in queue and len(queue) == 0
+
+
+def test_defer_does_not_count_an_attempt(clock):
+    queue = retryq.RetryQueue(max_attempts=3, base_seconds=1.0, max_seconds=60.0)
+    entry = queue.schedule(1, {})
+    queue.defer(entry, clock.now + 300)
+
+    assert entry.attempts == 1
+    clock.now += 200
+    assert queue.pop_due() == []
+    clock.now += 100
+    assert queue.pop_due() == [entry]
+
+
+def test_breaker_opens_probes_and_closes(clock):
+    breaker = retryq.CircuitBreaker(failure_threshold=3, cooldown_seconds=10.0, max_cooldown_seconds=25.0)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == retryq.STATE_CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == retryq.STATE_OPEN and breaker.is_open() and not breaker.allow()
+
+    clock.now += 10
+    assert breaker.allow()                      # a prova
+    assert breaker.state == retryq.STATE_HALF_OPEN
+    assert not breaker.allow()                  # só uma prova por vez
+
+    breaker.record_failure()                    # prova falhou: cooldown dobra
+    assert breaker.state == retryq.STATE_OPEN and breaker.cooldown == 20.0
+    clock.now += 20
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.cooldown == 25.0             # limitado a max_cooldown
+
+    clock.now += 25
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == retryq.STATE_CLOSED and breaker.cooldown == 10.0 and breaker.allow()
+
+
+def test_disabled_breaker_always_allows(clock):
+    breaker = retryq.CircuitBreaker(failure_threshold=0, cooldown_seconds=10.0, max_cooldown_seconds=10.0)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.allow() and not breaker.is_open() and breaker.state_value() == 0
+
+
+def test_transient_failure_is_retried_and_stored_failure_discarded(mock_api, set_config, tmp_path, clock, monkeypatch):
+    import main
+    import pipelines
+
+    state = mock_api(error_rate=1.0)
+    set_config(FAILED_STORE="files", FAILED_DIR=str(tmp_path), RETRIES_TOTAL=0, MAX_WORKERS=1)
+    pipeline = pipelines.Pipeline(
+        "default", None, retryq.CircuitBreaker(5, 10.0, 10.0), retryq.RetryQueue(3, 1.0, 1.0), {}, {},
+    )
+    # O grupo já traz o evento pronto (sem linhas do banco para montar)
+    monkeypatch.setattr(main, "_group_event", lambda g: g["event"])
+    group = {"items": [], "event": make_event(42)}
+
+    result = main._send_group(42, group, None, pipeline=pipeline)
+    assert not result["ok"] and result["transient"]
+    assert 42 in pipeline.retry_queue
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".json")]) == 1
+
+    state.options["error_rate"] = 0.0
+    clock.now += 5
+    assert main._drain_retry_queue(None, pipeline=pipeline) == 1
+
+    assert 42 not in pipeline.retry_queue
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".json")] == []
+    assert state.stats()["orders"] == 1
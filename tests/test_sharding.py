@@ -0,0 +1,91 @@
+"""Leases e checkpoints das partições (SHARD_MODE=hash) em SQLite."""
+import pytest
+from sqlalchemy import text
+
+import database
+import sharding
+
+EXPIRE = text("UPDATE dbo._MonitorState SET LeaseExpiresAt = '2000-01-01 00:00:00' WHERE Name = :name;")
+CHECKPOINTS = text("SELECT Name, LastItemId FROM dbo._MonitorState WHERE Name LIKE 'ItemSolMonitor%';")
+
+
+@pytest.fixture
+def coordinators(sqlite_db):
+    database.bootstrap_state()
+    workers = {}
+
+    def make(worker_id, count=4):
+        coordinator = workers[worker_id] = sharding.Coordinator(worker_id, count, lease_seconds=60)
+        coordinator.bootstrap()
+        return coordinator
+
+    yield make
+    for coordinator in workers.values():
+        coordinator.stop()
+
+
+def _names(parts):
+    return sorted(p.name for p in parts)
+
+
+def _checkpoints():
+    with database.get_engine().connect() as conn:
+        return {r.Name: r.LastItemId for r in conn.execute(CHECKPOINTS)}
+
+
+def _expire(name):
+    with database.get_engine().begin() as conn:
+        conn.execute(EXPIRE, {"name": name})
+
+
+def test_partitions_are_split_between_live_workers(coordinators):
+    a, b = coordinators("a"), coordinators("b")
+    assert len(a.rebalance()) == 4
+
+    # b registra o heartbeat, mas as leases de a ainda valem
+    assert b.rebalance() == []
+    # a vê dois workers vivos e libera o excedente; b assume o que ficou livre
+    assert len(a.rebalance()) == 2
+    owned_b = b.rebalance()
+    assert len(owned_b) == 2
+    assert set(_names(a.owned())).isdisjoint(_names(owned_b))
+
+
+def test_expired_lease_is_taken_over(coordinators):
+    a, b = coordinators("a"), coordinators("b")
+    a.rebalance()
+    b.rebalance()
+    a.rebalance()
+    b.rebalance()
+    victim = a.owned()[0]
+
+    # a parou de renovar: a partição e o registro do worker vencem
+    _expire(victim.name)
+    _expire(sharding.WORKER_PREFIX + "a")
+    assert victim.name in _names(b.rebalance())
+
+    # Fencing: o checkpoint de a não avança mais e a perde a partição
+    victim.commit_checkpoint(500)
+    assert _checkpoints()[victim.name] != 500
+    assert victim.name not in _names(a.owned())
+
+
+def test_stop_releases_partitions(coordinators):
+    a, b = coordinators("a"), coordinators("b")
+    a.rebalance()
+    a.stop()
+    assert len(b.rebalance()) == 4
+
+
+def test_legacy_checkpoint_follows_the_slowest_partition(coordinators):
+    a = coordinators("a")
+    parts = a.rebalance()
+    for part, last in zip(parts, (40, 10, 30)):
+        part.commit_checkpoint(last)
+    # Uma partição ainda no ponto de partida (0) segura o legado
+    assert _checkpoints()["ItemSolMonitor"] == 0
+
+    parts[3].commit_checkpoint(25)
+    assert _checkpoints()["ItemSolMonitor"] == 10
+    parts[1].commit_checkpoint(50)
+    assert _checkpoints()["ItemSolMonitor"] == 25
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT_DIR
+
+
+def _run(code_or_args, env_extra=None):
+    env = {"PATH": os.environ.get("PATH", ""), "PYTHONPATH": os.pathsep.join([str(ROOT_DIR), str(ROOT_DIR / "src")])}
+    env.update(env_extra or {})
+    return subprocess.run([sys.executable] + code_or_args, cwd=str(ROOT_DIR), env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_import_does_not_load_settings():
+    code = (
+        "import config, database, outbox, sharding, pipelines, change_tracking, main\n"
+        "assert config._SETTINGS is None, 'settings carregados no import'\n"
+        "assert main.PIPELINE is None and main.SOURCE is None\n"
+    )
+    result = _run(["-c", code])
+    assert result.returncode == 0, result.stderr
+
+
+def test_invalid_setting_stops_startup():
+    result = _run(["main.py"], {"SOURCE_DRIVER": "changetraking", "BEMSOFT_DRY_RUN": "1", "METRICS_PORT": "0"})
+    assert result.returncode == 1
+    assert "SOURCE_DRIVER='changetraking' inválido" in result.stdout + result.stderr